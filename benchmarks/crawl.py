@@ -0,0 +1,281 @@
+"""
+This file contains the offline end-to-end benchmark of the crawler: an `Agent` crawls a site
+farm (see `benchmarks.farm`) served from this machine, with all of its stages except the
+browser, which is replaced by a stub (with an optional rendering time). Pages are written into
+the configured PostgreSQL database, which is TRUNCATED first, so use a local one.
+
+Reported are the pages per second, the latency of pages (from entering the crawl until they
+are finished, see `crawler.metrics`) and of the stages, the CPU time (of this process, incl.
+the farm's server, and of its child processes, e.g. the analysis workers) and the memory (RSS).
+
+Example usage (from the crawler directory, as the crawler itself is run):
+
+> cd crawler
+> python ../benchmarks/crawl.py --sites 5 --pages 200 --latency 0.05 --workers 8
+> python ../benchmarks/crawl.py --recorded ../crawl_9_sites --crawl-delay 0 --pipeline --output bench.json
+[Benchmark] 1000 pages in 12.3 s (81.3 pages/s), page latency p50 45.2 ms, p99 310.0 ms
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+from os.path import abspath, dirname, join
+from time import perf_counter, sleep
+from urllib.parse import urlparse
+
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+
+from benchmarks.farm import FarmServer, document_key, generate_farm, load_recorded_farm
+from crawler import db
+from crawler.core import Agent
+from crawler.memory import descendant_pids, process_rss
+from crawler.metrics import METRICS
+from crawler.scope import Scope, ScopeRule
+from crawler.settings import SettingsReader
+
+
+class BenchmarkAgent(Agent):
+    """ Agent without a browser: HTML pages are 'rendered' by waiting for `render_time` seconds
+    and keeping the fetched HTML. Like the browser's request, rendering waits for the site's
+    turn (see `Agent.site_turn`)."""
+    render_time = 0.0
+
+    def render_stage(self, page):
+        if "text/html" not in page.headers.get("Content-Type", "text/html"):
+            return True
+        site_url = urlparse(page.url).netloc
+        with self.site_turn(site_url), METRICS.timer("render", host=site_url, status="ok"):
+            if self.render_time:
+                sleep(self.render_time)
+        return page.status_code in [200, 203, 302]
+
+
+def cpu_seconds():
+    """ User and system CPU time of this process and of its (finished) child processes."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"user": own.ru_utime, "system": own.ru_stime,
+            "children": children.ru_utime + children.ru_stime}
+
+
+class RssSampler:
+
+    def __init__(self, interval=0.2):
+        """ Measures the RSS of the process (and of its child processes) every `interval`
+        seconds in the background, keeping the peak and the mean."""
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="rss-sampler", daemon=True)
+
+    def run(self):
+        while True:
+            own = process_rss()
+            self.samples.append((own, own + sum(process_rss(pid) for pid in descendant_pids())))
+            if self.stopped.wait(self.interval):
+                break
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if not self.samples:
+            return {}
+        return {"peak_mb": max(own for own, _ in self.samples) / 2 ** 20,
+                "mean_mb": sum(own for own, _ in self.samples) / len(self.samples) / 2 ** 20,
+                "peak_with_children_mb": max(total for _, total in self.samples) / 2 ** 20}
+
+
+def run_benchmark(farm, latency=0.0, jitter=0.0, max_rate=None, workers=4, pipeline=False,
+                  analysis_processes=None, get_files=False, render_time=0.0, min_delay=0.0,
+                  max_pages=None, max_level=None, outage=0.0):
+    """ Crawls the farm (until all pages are crawled or `max_pages`/`max_level` is reached).
+    The first site of the farm answers every request with a 503 for the first `outage` seconds.
+
+    Returns
+    -------
+    dict:
+        Report of the crawl (see `print_report`)
+    """
+    server = FarmServer(farm, latency=latency, jitter=jitter, max_rate=max_rate,
+                        outages={document_key(farm.seeds[0])[0]: outage})
+    server.install_proxy()
+    print("[Benchmark] Serving {} documents of {} sites at {}...".format(
+        len(farm), len(farm.seeds), server.proxy_url))
+
+    config = SettingsReader.config
+    config["pipeline"]["enabled"] = pipeline
+    config["pipeline"]["report_interval"] = 0
+    config["archive"]["enabled"] = False
+    config["metrics"]["report_interval"] = 0
+    config["metrics"]["port"] = 0
+    config["profiler"]["signal"] = False
+    config["memory"]["interval"] = 0
+    config["politeness"]["min_delay"] = min_delay
+    BenchmarkAgent.render_time = render_time
+    if max_pages is not None:
+        Agent.MAX_CRAWLED_PAGES = max_pages
+
+    # every site of the farm is in scope (and nothing else)
+    agent = BenchmarkAgent(seed_pages=farm.seeds, num_workers=workers, sleep_period=0,
+                           get_files=get_files, analysis_processes=analysis_processes,
+                           scope=Scope([ScopeRule(host) for host in farm.hosts]))
+    with db.Database(agent.pool) as temp_db:
+        temp_db.truncate_everything()
+    METRICS.clear()
+
+    sampler = RssSampler()
+    sampler.start()
+    cpu_start = cpu_seconds()
+    start = perf_counter()
+    try:
+        agent.crawl(max_level=max_level)
+    finally:
+        agent.close()
+        duration = perf_counter() - start
+        cpu_end = cpu_seconds()
+        memory = sampler.stop()
+        server.close()
+
+    with db.Database(agent.pool) as temp_db:
+        page_types = dict(temp_db.return_all(
+            "SELECT page_type_code, COUNT(*) FROM page GROUP BY page_type_code"))
+    agent.pool.closeall()
+
+    totals = METRICS.totals()
+    num_pages = totals.get("page", {}).get("count", 0)
+    cpu = {name: cpu_end[name] - cpu_start[name] for name in cpu_start}
+    return {"pages": num_pages,
+            "seconds": duration,
+            "pages_per_second": num_pages / duration if duration else 0.0,
+            "page_latency": totals.get("page", {}),
+            "stages": {name: stats for name, stats in totals.items() if name != "page"},
+            "cpu_seconds": cpu,
+            "cpu_utilization": sum(cpu.values()) / duration if duration else 0.0,
+            "memory": memory,
+            "requests": sum(server.requests.values()),
+            "rejected_requests": sum(server.rejected.values()),
+            "failed_requests": sum(server.failed.values()),
+            "page_types": page_types}
+
+
+def print_report(report):
+    latency = report["page_latency"]
+    print("[Benchmark] {} pages in {:.1f} s ({:.1f} pages/s), page latency p50 {:.1f} ms, "
+          "p99 {:.1f} ms".format(report["pages"], report["seconds"], report["pages_per_second"],
+                                 1000 * latency.get("p50", 0.0), 1000 * latency.get("p99", 0.0)))
+    cpu = report["cpu_seconds"]
+    print("[Benchmark] CPU: {:.1f} s user, {:.1f} s system, {:.1f} s child processes "
+          "({:.0%} of the wall time)".format(cpu["user"], cpu["system"], cpu["children"],
+                                              report["cpu_utilization"]))
+    memory = report["memory"]
+    if memory:
+        print("[Benchmark] RSS: peak {:.0f} MB, mean {:.0f} MB, peak incl. child processes "
+              "{:.0f} MB".format(memory["peak_mb"], memory["mean_mb"],
+                                 memory["peak_with_children_mb"]))
+    page_types = ", ".join("{} {}".format(page_type, count)
+                           for page_type, count in sorted(report["page_types"].items()))
+    print("[Benchmark] {} requests to the farm ({} got a 429, {} a 503), pages in the database: "
+          "{}".format(report["requests"], report["rejected_requests"], report["failed_requests"],
+                      page_types))
+    print("[Benchmark] {:<16}{:>9}{:>10}{:>10}{:>10}".format("stage", "count", "mean ms",
+                                                             "p50 ms", "p99 ms"))
+    for name, stats in sorted(report["stages"].items(), key=lambda item: -item[1]["sum"]):
+        print("[Benchmark] {:<16}{:>9}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            name, stats["count"], 1000 * stats["mean"], 1000 * stats["p50"], 1000 * stats["p99"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the crawler")
+    farm_group = parser.add_argument_group("site farm")
+    farm_group.add_argument("--recorded", metavar="DIR",
+                            help="rebuild the farm from the CSV dumps of a crawl (e.g. ../crawl_9_sites) "
+                                 "instead of generating it")
+    farm_group.add_argument("--sites", type=int, default=5, help="number of generated sites")
+    farm_group.add_argument("--pages", type=int, default=200, help="HTML pages per generated site")
+    farm_group.add_argument("--links", type=int, default=10, help="links per page")
+    farm_group.add_argument("--page-size", type=int, default=5000, help="bytes per page")
+    farm_group.add_argument("--binary-share", type=float, default=0.02,
+                            help="binary files per generated page")
+    farm_group.add_argument("--duplicate-share", type=float, default=0.02,
+                            help="share of generated pages that duplicate another page")
+    farm_group.add_argument("--sitemap-share", type=float, default=0.5,
+                            help="share of generated pages listed in sitemaps")
+    farm_group.add_argument("--crawl-delay", type=int, default=None,
+                            help="Crawl-delay of robots.txt in seconds (generated sites: 0; "
+                                 "recorded sites: as recorded)")
+    farm_group.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+    farm_group.add_argument("--jitter", type=float, default=0.0,
+                            help="maximum random seconds added to the latency")
+    farm_group.add_argument("--max-rate", type=float, default=None,
+                            help="requests per second every site serves (faster ones get a 429)")
+    farm_group.add_argument("--outage", type=float, default=0.0,
+                            help="seconds the first site answers every request with a 503")
+    farm_group.add_argument("--seed", type=int, default=0)
+    crawl_group = parser.add_argument_group("crawl")
+    crawl_group.add_argument("--workers", type=int, default=4, help="worker threads (threaded crawl)")
+    crawl_group.add_argument("--pipeline", action="store_true",
+                             help="crawl with the pipeline of stages (see the 'pipeline' settings)")
+    crawl_group.add_argument("--analysis-processes", type=int, default=None,
+                             help="processes for parsing and hashing (0: in the crawl threads; "
+                                  "default: see the 'analysis' settings)")
+    crawl_group.add_argument("--files", action="store_true", help="download binary files and images")
+    crawl_group.add_argument("--render-time", type=float, default=0.0,
+                             help="seconds the stub browser takes per HTML page")
+    crawl_group.add_argument("--min-delay", type=float, default=0.0,
+                             help="smallest delay between requests to a site (see the 'politeness' "
+                                  "settings)")
+    crawl_group.add_argument("--max-pages", type=int, default=None)
+    crawl_group.add_argument("--max-level", type=int, default=None)
+    db_group = parser.add_argument_group("database (truncated before the crawl)")
+    db_group.add_argument("--db-host", default=db.Pool.host)
+    db_group.add_argument("--db-port", default=db.Pool.port)
+    db_group.add_argument("--db-user", default=db.Pool.user)
+    db_group.add_argument("--db-password", default=db.Pool.password)
+    db_group.add_argument("--db-name", default=db.Pool.db)
+    parser.add_argument("--output", metavar="FILE", help="write the report as JSON")
+    parser.add_argument("--quiet", action="store_true", help="hide the crawler's output")
+    args = parser.parse_args()
+
+    if args.recorded:
+        try:
+            site_farm = load_recorded_farm(args.recorded, links_per_page=args.links,
+                                           page_size=args.page_size, crawl_delay=args.crawl_delay,
+                                           seed=args.seed)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        site_farm = generate_farm(num_sites=args.sites, pages_per_site=args.pages,
+                                  links_per_page=args.links, page_size=args.page_size,
+                                  binary_share=args.binary_share,
+                                  duplicate_share=args.duplicate_share,
+                                  sitemap_share=args.sitemap_share,
+                                  crawl_delay=args.crawl_delay if args.crawl_delay is not None else 0,
+                                  images=args.files, seed=args.seed)
+
+    db.Pool.host, db.Pool.port, db.Pool.db = args.db_host, args.db_port, args.db_name
+    db.Pool.user, db.Pool.password = args.db_user, args.db_password
+
+    stdout = sys.stdout
+    if args.quiet:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        benchmark_report = run_benchmark(site_farm, latency=args.latency, jitter=args.jitter,
+                                         max_rate=args.max_rate, workers=args.workers,
+                                         pipeline=args.pipeline,
+                                         analysis_processes=args.analysis_processes,
+                                         get_files=args.files, render_time=args.render_time,
+                                         min_delay=args.min_delay, max_pages=args.max_pages,
+                                         max_level=args.max_level, outage=args.outage)
+    finally:
+        if args.quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    print_report(benchmark_report)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(benchmark_report, output, indent=2)
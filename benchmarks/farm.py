@@ -0,0 +1,450 @@
+"""
+This file contains the site farm of the offline benchmarks: many .gov.si sites served by one
+local HTTP server, so the whole crawler can run without touching the real sites.
+
+The farm is either generated (`generate_farm`: any number of sites and pages, with binary
+files, exact duplicates, broken links, sitemaps and crawl delays) or rebuilt from a recorded
+crawl (`load_recorded_farm`: sites, robots.txt, sitemaps and pages of the CSV dumps, e.g.
+crawl_9_sites). The dumps hold no content and only a few links, so the bodies and the links
+between the pages of a site (along their paths plus random ones) are generated.
+
+`FarmServer` is used as the HTTP proxy of the crawl (see `FarmServer.install_proxy`): the
+crawler requests the original URLs, so sites, scope, robots.txt and canonicalization work as
+in a real crawl, and every request (of requests and urllib) ends up in the farm. Unknown
+URLs get a 404. Responses can be delayed to simulate the latency of the sites, and sites can
+be limited to a number of requests per second (faster requests get a 429 with Retry-After).
+
+Example usage:
+
+> farm = generate_farm(num_sites=5, pages_per_site=200, crawl_delay=0)
+> server = FarmServer(farm, latency=0.05)
+> server.install_proxy()
+> requests.get(farm.seeds[0]).status_code
+200
+"""
+import csv
+import math
+import os
+import random
+import threading
+import urllib.request
+from collections import Counter, namedtuple
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from time import perf_counter, sleep
+from urllib.parse import unquote, urlsplit
+
+import requests
+
+HTML_TYPE = "text/html; charset=utf-8"
+BINARY_TYPES = {".pdf": "application/pdf", ".doc": "application/msword",
+                ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                ".ppt": "application/vnd.ms-powerpoint",
+                ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation"}
+LETTERS = "abcčdefghijklmnoprsštuvzž"
+
+FarmDocument = namedtuple("FarmDocument", ["status", "content_type", "body"])
+
+
+def document_key(url):
+    """ (host, path with query) of a URL, as the farm looks it up."""
+    parts = urlsplit(url)
+    path = unquote(parts.path) or "/"
+    return parts.netloc.lower(), path + ("?" + parts.query if parts.query else "")
+
+
+class SiteFarm:
+
+    def __init__(self):
+        # (host, path) -> FarmDocument
+        self.documents = {}
+        # URLs the crawl starts from (the roots of the sites)
+        self.seeds = []
+
+    def __len__(self):
+        return len(self.documents)
+
+    @property
+    def hosts(self):
+        return sorted({host for host, _ in self.documents})
+
+    def add(self, url, body, content_type=HTML_TYPE, status=200):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.documents[document_key(url)] = FarmDocument(status, content_type, body)
+
+    def get(self, url):
+        """ Document of a URL (with or without the trailing slash) or None."""
+        host, path = document_key(url)
+        document = self.documents.get((host, path))
+        if document is None and path != "/":
+            alternative = path[:-1] if path.endswith("/") else path + "/"
+            document = self.documents.get((host, alternative))
+        return document
+
+
+def random_text(rng, size):
+    """ Roughly `size` characters of random (Slovene looking) words."""
+    words = []
+    length = 0
+    while length < size:
+        word = "".join(rng.choice(LETTERS) for _ in range(rng.randint(2, 10)))
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def html_page(title, links, size, rng, images=()):
+    """ HTML page with a title, the links (and images) and paragraphs of random words, about
+    `size` bytes long."""
+    paragraphs = [random_text(rng, 400) for _ in range(max(1, size // 400))]
+    return "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>{}</title></head><body>\n" \
+           "<h1>{}</h1>\n<ul>\n{}\n</ul>\n{}\n{}\n</body></html>\n".format(
+               escape(title), escape(title),
+               "\n".join('<li><a href="{}">{}</a></li>'.format(escape(link), escape(link))
+                         for link in links),
+               "\n".join('<img src="{}" alt="">'.format(escape(image)) for image in images),
+               "\n".join("<p>{}</p>".format(paragraph) for paragraph in paragraphs))
+
+
+def robots_txt(crawl_delay=None, sitemap_url=None, disallow=()):
+    lines = ["User-agent: *"]
+    lines.extend("Disallow: {}".format(path) for path in disallow)
+    if crawl_delay is not None:
+        lines.append("Crawl-delay: {}".format(crawl_delay))
+    if sitemap_url is not None:
+        lines.append("Sitemap: {}".format(sitemap_url))
+    return "\n".join(lines) + "\n"
+
+
+def with_crawl_delay(robots, crawl_delay):
+    """ robots.txt with `crawl_delay` for all user agents (existing delays are replaced)."""
+    lines = [line for line in robots.splitlines()
+             if not line.strip().lower().startswith("crawl-delay")]
+    for idx_line, line in enumerate(lines):
+        if line.strip().lower().replace(" ", "") == "user-agent:*":
+            lines.insert(idx_line + 1, "Crawl-delay: {}".format(crawl_delay))
+            return "\n".join(lines) + "\n"
+    return "\n".join(["User-agent: *", "Crawl-delay: {}".format(crawl_delay), ""] + lines) + "\n"
+
+
+def sitemap_xml(urls):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' \
+           '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n{}\n</urlset>\n'.format(
+               "\n".join("<url><loc>{}</loc></url>".format(escape(url)) for url in urls))
+
+
+def generate_farm(num_sites=5, pages_per_site=200, links_per_page=10, page_size=5000,
+                  binary_share=0.02, duplicate_share=0.02, broken_share=0.01, sitemap_share=0.5,
+                  crawl_delay=0, images=True, seed=0):
+    """
+    Parameters
+    ----------
+    num_sites: int
+        Number of sites (hosts 'site-0.farm.gov.si', 'site-1.farm.gov.si', ...)
+
+    pages_per_site: int
+        Number of HTML pages of every site. All of them can be reached from the site's root.
+
+    links_per_page: int
+        Number of links on every page (to other pages of the site)
+
+    page_size: int
+        Approximate size (in bytes) of pages and binary files
+
+    binary_share: float
+        Share of additional binary files (PDF, DOC, ...), each linked from a random page
+
+    duplicate_share: float
+        Share of pages whose content is the same as that of another page of the site
+
+    broken_share: float
+        Share of additional links (from random pages) that lead to a 404
+
+    sitemap_share: float
+        Share of a site's pages listed in its sitemap.xml (no sitemap if 0)
+
+    crawl_delay: int, optional
+        Crawl-delay (seconds) of the sites' robots.txt (none if None, so the crawler uses its
+        default)
+
+    images: bool
+        If True, every page shows the site's logo
+
+    seed: int
+        Seed of the random generator (the same arguments give the same farm)
+
+    Returns
+    -------
+    SiteFarm
+    """
+    rng = random.Random(seed)
+    farm = SiteFarm()
+    branching = max(2, links_per_page // 2)
+    for idx_site in range(num_sites):
+        root = "http://site-{}.farm.gov.si".format(idx_site)
+        farm.seeds.append(root + "/")
+        paths = ["/"] + ["/section-{}/page-{}.html".format(idx_page % branching, idx_page)
+                         for idx_page in range(1, pages_per_site)]
+        # pages[i] links to its children in a tree (so every page is reachable) and to random pages
+        links = [["{}{}".format(root, paths[child])
+                  for child in range(branching * idx_page + 1,
+                                     min(branching * idx_page + branching + 1, pages_per_site))]
+                 for idx_page in range(pages_per_site)]
+        for page_links in links:
+            page_links.extend(root + rng.choice(paths)
+                              for _ in range(max(0, links_per_page - len(page_links))))
+        for idx_file in range(int(binary_share * pages_per_site)):
+            extension = rng.choice(sorted(BINARY_TYPES))
+            path = "/files/document-{}{}".format(idx_file, extension)
+            farm.add(root + path, rng.randbytes(page_size), BINARY_TYPES[extension])
+            rng.choice(links).append(root + path)
+        for idx_broken in range(int(broken_share * pages_per_site)):
+            rng.choice(links).append("{}/missing-{}.html".format(root, idx_broken))
+
+        logo = [root + "/images/logo.png"] if images else []
+        if images:
+            farm.add(logo[0], rng.randbytes(2000), "image/png")
+        bodies = []
+        for idx_page, path in enumerate(paths):
+            if idx_page > 0 and rng.random() < duplicate_share:
+                bodies.append(rng.choice(bodies))
+            else:
+                bodies.append(html_page("Stran {} ({})".format(idx_page, idx_site), links[idx_page],
+                                        page_size, rng, images=logo))
+            farm.add(root + path, bodies[-1])
+
+        sitemap_url = None
+        if sitemap_share > 0:
+            sitemap_url = root + "/sitemap.xml"
+            farm.add(sitemap_url, sitemap_xml(root + path for path in
+                                              rng.sample(paths, int(sitemap_share * pages_per_site))),
+                     "application/xml")
+        farm.add(root + "/robots.txt", robots_txt(crawl_delay, sitemap_url), "text/plain")
+    return farm
+
+
+def load_recorded_farm(directory, links_per_page=10, page_size=5000, crawl_delay=None, seed=0):
+    """ Farm of the sites and pages of a recorded crawl: site.csv (robots.txt and sitemaps),
+    page_noContent.csv (URLs, types and status codes) and, if present, link.csv.
+
+    Only dumps with page_noContent.csv (like crawl_9_sites) can be loaded. The other tables
+    (page_data.csv, image.csv and link.csv, all that crawl_2_sites has besides site.csv)
+    reference pages by id only, so the URLs of the pages are unknown without it.
+
+    Parameters
+    ----------
+    directory: str
+        Directory of the CSV dumps (e.g. 'crawl_9_sites')
+
+    links_per_page: int
+        Number of random links (to pages of the same site) added to every page
+
+    page_size: int
+        Approximate size (in bytes) of generated page bodies
+
+    crawl_delay: int, optional
+        If given, replaces the Crawl-delay (seconds) of all robots.txt files
+
+    seed: int
+        Seed of the random generator
+
+    Returns
+    -------
+    SiteFarm
+
+    Raises
+    ------
+    ValueError
+        If the directory has no page_noContent.csv
+    """
+    if not os.path.exists(join(directory, "page_noContent.csv")):
+        raise ValueError("'{}' has no page_noContent.csv with the URLs of the recorded pages (a "
+                         "dump like crawl_9_sites is needed)".format(directory))
+
+    def read_rows(name):
+        with open(join(directory, name), encoding="utf-8-sig", newline="") as csv_file:
+            return list(csv.reader(csv_file, delimiter=";"))
+
+    rng = random.Random(seed)
+    farm = SiteFarm()
+    # id, url, type and status of pages, by host
+    pages_by_host = {}
+    for row in read_rows("page_noContent.csv"):
+        page_id, _, page_type, _, url, status = row[:6]
+        if not url.startswith("http"):
+            continue
+        url = "http://" + url.split("://", 1)[1]
+        pages_by_host.setdefault(document_key(url)[0], []).append(
+            (page_id, url, page_type, int(status) if status.isdigit() else 200))
+
+    urls_by_id = {page_id: url for pages in pages_by_host.values() for page_id, url, _, _ in pages}
+    recorded_links = {}
+    if os.path.exists(join(directory, "link.csv")):
+        for row in read_rows("link.csv"):
+            if len(row) == 2 and row[0] in urls_by_id and row[1] in urls_by_id:
+                recorded_links.setdefault(urls_by_id[row[0]], []).append(urls_by_id[row[1]])
+
+    for row in read_rows("site.csv"):
+        _, host, robots, sitemap = row[:4]
+        host = host.lower()
+        root = "http://{}/".format(host)
+        farm.seeds.append(root)
+        pages = pages_by_host.get(host, [])
+        if not any(document_key(url)[1] == "/" for _, url, _, _ in pages):
+            pages.insert(0, (None, root, "HTML", 200))
+        urls = [url for _, url, _, _ in pages]
+        known_paths = {document_key(url)[1].rstrip("/"): url for url in urls}
+
+        # pages link to the pages under their path (so every page is reachable) and to random ones
+        links = {url: list(recorded_links.get(url, [])) for url in urls}
+        for url in urls:
+            path = document_key(url)[1].rstrip("/")
+            parent = path.rsplit("/", 1)[0]
+            while parent and parent not in known_paths:
+                parent = parent.rsplit("/", 1)[0]
+            if url != root:
+                links[known_paths.get(parent, root)].append(url)
+            links[url].extend(rng.choice(urls) for _ in range(links_per_page))
+
+        first_body = None
+        for _, url, page_type, status in pages:
+            if page_type == "DUPLICATE" and first_body is not None:
+                farm.add(url, first_body, status=status)
+                continue
+            body = html_page(url, links[url], page_size, rng)
+            first_body = first_body or body
+            farm.add(url, body, status=status)
+
+        if robots.strip():
+            farm.add(root + "robots.txt", robots if crawl_delay is None else
+                     with_crawl_delay(robots, crawl_delay), "text/plain")
+        elif crawl_delay is not None:
+            farm.add(root + "robots.txt", robots_txt(crawl_delay), "text/plain")
+        if sitemap.strip() and sitemap.strip() != "None":
+            # the farm only serves HTTP
+            farm.add(root + "sitemap.xml", sitemap.replace("https://", "http://"), "application/xml")
+    return farm
+
+
+class FarmServer:
+
+    def __init__(self, farm, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, max_rate=None,
+                 outages=None):
+        """ Serves a farm over HTTP (in a background thread), both as a proxy (absolute URLs in
+        requests) and to clients connecting directly (Host header).
+
+        Parameters
+        ----------
+        farm: SiteFarm
+
+        host: str
+            Address to listen on
+
+        port: int
+            Port to listen on (0 picks a free one)
+
+        latency: float
+            Time (in seconds) before every response is sent
+
+        jitter: float
+            Maximum random time (in seconds) added to the latency
+
+        max_rate: float, optional
+            Requests per second that every host serves. Requests that come sooner than
+            1 / `max_rate` seconds after the last served one get a 429 with Retry-After.
+
+        outages: dict, optional
+            Host -> time (in seconds, from the start of the server) during which the host
+            answers every request with a 503
+        """
+        self.farm = farm
+        # host -> number of requests
+        self.requests = Counter()
+        # host -> number of requests that got a 429
+        self.rejected = Counter()
+        # host -> number of requests that got a 503 (during an outage)
+        self.failed = Counter()
+        outages = outages or {}
+        started = perf_counter()
+        # host -> time of the last served request
+        last_served = {}
+        requests_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = self.path if "://" in self.path else \
+                    "http://{}{}".format(self.headers.get("Host", ""), self.path)
+                host = document_key(url)[0]
+                with requests_lock:
+                    server.requests[host] += 1
+                    overloaded = max_rate is not None and \
+                        perf_counter() - last_served.get(host, float("-inf")) < 1 / max_rate
+                    down = perf_counter() - started < outages.get(host, 0)
+                    if down:
+                        server.failed[host] += 1
+                    elif overloaded:
+                        server.rejected[host] += 1
+                    else:
+                        last_served[host] = perf_counter()
+                if latency or jitter:
+                    sleep(latency + random.uniform(0, jitter))
+                document = farm.get(url)
+                if down:
+                    document = FarmDocument(503, HTML_TYPE, b"<html><body>Service unavailable</body></html>")
+                elif overloaded:
+                    document = FarmDocument(429, HTML_TYPE, b"<html><body>Too many requests</body></html>")
+                elif document is None:
+                    document = FarmDocument(404, HTML_TYPE, b"<html><body>Not found</body></html>")
+                self.send_response(document.status)
+                if overloaded and not down:
+                    self.send_header("Retry-After", str(math.ceil(1 / max_rate)))
+                self.send_header("Content-Type", document.content_type)
+                self.send_header("Content-Length", str(len(document.body)))
+                self.end_headers()
+                self.wfile.write(document.body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="farm-server",
+                                       daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    @property
+    def proxy_url(self):
+        return "http://{}:{}".format(*self.address)
+
+    def install_proxy(self):
+        """ Routes all HTTP(S) requests of this process (requests and urllib, which read the
+        proxy from the environment) through the farm and checks that they are.
+
+        Raises
+        ------
+        RuntimeError
+            If requests to the farm's hosts would not go through the farm
+        """
+        for name in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+            os.environ[name] = self.proxy_url
+        for name in ("no_proxy", "NO_PROXY", "all_proxy", "ALL_PROXY"):
+            os.environ.pop(name, None)
+        # urllib's default opener reads the proxies when it is built
+        urllib.request.install_opener(urllib.request.build_opener())
+        for seed in self.farm.seeds:
+            if requests.utils.get_environ_proxies(seed).get("http") != self.proxy_url or \
+                    urllib.request.getproxies().get("http") != self.proxy_url:
+                raise RuntimeError("Requests to '{}' would not go through the farm".format(seed))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
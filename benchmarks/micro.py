@@ -0,0 +1,351 @@
+"""
+This file contains the microbenchmarks of the crawler's hot functions: link and image
+extraction, URL cleanup, robots.txt checks, sitemap parsing, LSH signatures and the difflib
+comparison of duplicate candidates. They run on fixed HTML/XML fixtures (generated with a fixed
+seed) of several sizes, so runs on the same machine are comparable.
+
+Results are saved as JSON (baselines, one per machine, e.g. in benchmarks/baselines/) and a run
+is compared against a baseline: benchmarks that got slower by more than the threshold are
+reported as regressions (and the comparison exits with status 1). The best time of several
+repeats is compared, as it is the least affected by other load on the machine.
+
+Images found by `find_images` are not downloaded: `save_images` is replaced by a stub while
+the suite runs.
+
+Example usage:
+
+> python benchmarks/micro.py run --output benchmarks/baselines/my-laptop.json
+> python benchmarks/micro.py compare benchmarks/baselines/my-laptop.json --threshold 0.1
+[Benchmark] find_links[medium]          1.25 ms      1.61 ms    +28.8%  REGRESSION
+"""
+import argparse
+import json
+import platform
+import random
+import re
+import statistics
+import sys
+import timeit
+from datetime import datetime
+from os.path import abspath, dirname, join
+from unittest import mock
+
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+
+from bs4 import BeautifulSoup
+
+from benchmarks.farm import LETTERS
+from crawler import core
+from crawler.analysis import build_lsh, read_vocab_file
+from crawler.db import html_similarity
+from crawler.extract import extract_page
+from crawler.links import Links
+from crawler.robots import Robots
+from crawler.sitemap import Sitemap
+
+PROJECT_ROOT = abspath(join(dirname(__file__), ".."))
+VOCAB_PATH = join(PROJECT_ROOT, "crawler", "data", "test2.txt")
+PAGE_URL = "http://www.e-prostor.gov.si/dostop-do-podatkov/"
+
+# number of content blocks (each ~500 bytes of HTML with links) or URLs (x10) of the fixtures
+FIXTURE_SIZES = {"small": 10, "medium": 100, "large": 1000}
+DEFAULT_THRESHOLD = 0.1
+
+ROBOTS_FIXTURE = """User-agent: *
+Allow: /
+Disallow: /fileadmin/global/
+Disallow: /t3lib/
+Disallow: /nc/
+Disallow: *no_cache*
+Disallow: /*cHash
+Disallow: /typo3/
+Disallow: /urednik/
+Disallow: /typo3conf/
+Disallow: /typo3temp/
+Disallow: /*?id=*
+Disallow: /*&type=98
+Disallow: /*&type=100
+
+User-agent: Googlebot
+Disallow: /iskanje/
+
+Sitemap: http://www.e-prostor.gov.si/sitemap.xml
+"""
+
+
+def words(rng, count):
+    return " ".join("".join(rng.choice(LETTERS) for _ in range(rng.randint(2, 10)))
+                    for _ in range(count))
+
+
+def url_fixture(count, seed=0):
+    """ URLs as found on .gov.si sites: with and without www, trailing slashes, queries and
+    fragments, of various depths."""
+    rng = random.Random(seed)
+    urls = []
+    for idx_url in range(count):
+        host = rng.choice(["www.e-prostor.gov.si", "e-prostor.gov.si", "www.evem.gov.si",
+                           "evem.gov.si", "www.mz.gov.si"])
+        path = "/".join(words(rng, 1) for _ in range(rng.randint(0, 6)))
+        url = "{}://{}/{}".format(rng.choice(["http", "https"]), host, path)
+        if rng.random() < 0.3:
+            url += "/"
+        if rng.random() < 0.3:
+            url += "?id={}&L={}".format(idx_url, rng.randint(0, 2))
+        if rng.random() < 0.1:
+            url += "#" + words(rng, 1)
+        urls.append(url)
+    return urls
+
+
+def html_fixture(blocks, seed=0):
+    """ Page with a navigation and `blocks` sections (a heading, a paragraph, relative and
+    absolute links, some images, fragment links and javascript redirects)."""
+    rng = random.Random(seed)
+    parts = ['<!DOCTYPE html>\n<html lang="sl"><head><meta charset="utf-8">',
+             '<title>{}</title><base href="{}"></head><body>'.format(words(rng, 4), PAGE_URL),
+             '<nav><ul>']
+    parts.extend('<li><a href="/{}/">{}</a></li>'.format(words(rng, 1), words(rng, 2))
+                 for _ in range(20))
+    parts.append('</ul></nav><main>')
+    for idx_block in range(blocks):
+        parts.append('<section id="s{}"><h2>{}</h2><p>{} <a href="{}/{}.html?id={}">{}</a> {}</p>'.format(
+            idx_block, words(rng, 3), words(rng, 30), words(rng, 1), words(rng, 1), idx_block,
+            words(rng, 2), words(rng, 20)))
+        parts.append('<a href="{}">{}</a>'.format(url_fixture(1, seed=idx_block)[0], words(rng, 2)))
+        if idx_block % 3 == 0:
+            parts.append('<img src="/fileadmin/slike/{}.jpg" alt="{}">'.format(idx_block, words(rng, 2)))
+        if idx_block % 5 == 0:
+            parts.append('<a href="#s{}">{}</a>'.format(idx_block, words(rng, 1)))
+            parts.append('<button onclick="window.location=\'/obrazci/{}.pdf\'">{}</button>'.format(
+                idx_block, words(rng, 1)))
+        parts.append('</section>')
+    parts.append('</main></body></html>')
+    return "\n".join(parts)
+
+
+def sitemap_fixture(num_urls, seed=0):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' \
+           '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n{}\n</urlset>\n'.format(
+               "\n".join("<url><loc>{}</loc><lastmod>2019-03-01</lastmod></url>".format(url)
+                         for url in url_fixture(num_urls, seed)))
+
+
+def save_images_stub(base_url, image_srcs, db, url):
+    """ Replaces `crawler.core.save_images` (no downloads) while the benchmarks run."""
+    return image_srcs
+
+
+class FixtureRobots(Robots):
+    """ Robots read from `ROBOTS_FIXTURE` instead of the site."""
+    def read(self):
+        self.parse(ROBOTS_FIXTURE.splitlines())
+
+
+# name -> (sizes, function creating the benchmarked function for a size)
+BENCHMARKS = {}
+
+
+def benchmark(name, sizes=tuple(FIXTURE_SIZES)):
+    def register(setup):
+        BENCHMARKS[name] = (sizes, setup)
+        return setup
+    return register
+
+
+@benchmark("find_links")
+def setup_find_links(blocks):
+    soup = BeautifulSoup(html_fixture(blocks), "lxml")
+    return lambda: core.find_links(PAGE_URL, soup, parse_js_redirects=True)
+
+
+@benchmark("find_images")
+def setup_find_images(blocks):
+    soup = BeautifulSoup(html_fixture(blocks), "lxml")
+    return lambda: core.find_images(PAGE_URL, soup, None, PAGE_URL)
+
+
+@benchmark("get_base_href")
+def setup_get_base_href(blocks):
+    soup = BeautifulSoup(html_fixture(blocks), "lxml")
+    return lambda: core.get_base_href(soup, PAGE_URL)
+
+
+@benchmark("extract_page")
+def setup_extract_page(blocks):
+    # what the crawler uses instead of parsing with BeautifulSoup and the three functions above
+    html = html_fixture(blocks)
+    return lambda: extract_page(html, PAGE_URL, parse_js_redirects=True)
+
+
+@benchmark("links_sanitize")
+def setup_links_sanitize(blocks):
+    urls = url_fixture(10 * blocks)
+    return lambda: [Links.sanitize(url) for url in urls]
+
+
+@benchmark("links_prune_to_max_depth")
+def setup_links_prune(blocks):
+    urls = [Links.sanitize(url) for url in url_fixture(10 * blocks)]
+    return lambda: [Links.prune_to_max_depth(url, 3) for url in urls]
+
+
+@benchmark("links_remove_www")
+def setup_links_remove_www(blocks):
+    urls = url_fixture(10 * blocks)
+    return lambda: [Links.remove_www(url) for url in urls]
+
+
+@benchmark("robots_can_fetch")
+def setup_robots_can_fetch(blocks):
+    robots = FixtureRobots("http://www.e-prostor.gov.si")
+    paths = ["/" + url.split("/", 3)[-1] for url in url_fixture(10 * blocks)]
+    return lambda: [robots.can_fetch(path) for path in paths]
+
+
+@benchmark("sitemap_process")
+def setup_sitemap_process(blocks):
+    raw = sitemap_fixture(10 * blocks)
+    return lambda: Sitemap.process_sitemap(raw)
+
+
+@benchmark("lsh_signature")
+def setup_lsh_signature(blocks):
+    lsh_obj = build_lsh(read_vocab_file(VOCAB_PATH))
+    html = html_fixture(blocks)
+    return lambda: lsh_obj.compute_signature(html)
+
+
+# difflib is quadratic in the worst case, so large pages would take minutes
+@benchmark("difflib_similarity", sizes=("small", "medium"))
+def setup_difflib_similarity(blocks):
+    # a near duplicate: the same template with a different part of the content
+    lowered = html_fixture(blocks).lower()
+    other = html_fixture(blocks // 2) + html_fixture(blocks - blocks // 2, seed=1)
+    return lambda: html_similarity(lowered, other)
+
+
+def measure(function, min_time=0.2, repeat=5):
+    """ Time of one call of `function`: it is called in loops of at least `min_time` seconds
+    (with the garbage collector disabled), `repeat` times.
+
+    Returns
+    -------
+    dict:
+        'best' and 'median' (seconds per call), 'loops' and 'repeat'
+    """
+    timer = timeit.Timer(function)
+    loops = 1
+    while timer.timeit(loops) < min_time:
+        loops *= 2
+    times = [total / loops for total in timer.repeat(repeat=repeat, number=loops)]
+    return {"best": min(times), "median": statistics.median(times), "loops": loops, "repeat": repeat}
+
+
+def run_suite(pattern=None, min_time=0.2, repeat=5):
+    """ Runs the benchmarks whose name ('find_links[medium]', ...) matches the regexp `pattern`.
+
+    Returns
+    -------
+    dict:
+        'created', 'python', 'platform' and 'results': name -> measurement (see `measure`)
+    """
+    results = {}
+    with mock.patch.object(core, "save_images", save_images_stub):
+        for name, (sizes, setup) in BENCHMARKS.items():
+            for size in sizes:
+                full_name = "{}[{}]".format(name, size)
+                if pattern is not None and re.search(pattern, full_name) is None:
+                    continue
+                results[full_name] = measure(setup(FIXTURE_SIZES[size]), min_time=min_time,
+                                             repeat=repeat)
+                print("[Benchmark] {:<36}{:>12}".format(full_name,
+                                                        format_seconds(results[full_name]["best"])))
+    return {"created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results}
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """ Compares the best times of two runs (see `run_suite`).
+
+    Returns
+    -------
+    list of tuple:
+        (name, baseline seconds or None, current seconds or None, relative change or None,
+        status), where the status is 'regression', 'improvement', 'ok', 'new' or 'missing'
+    """
+    rows = []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        before = baseline["results"].get(name, {}).get("best")
+        after = current["results"].get(name, {}).get("best")
+        if before is None or after is None:
+            rows.append((name, before, after, None, "new" if before is None else "missing"))
+            continue
+        change = after / before - 1
+        status = "regression" if change > threshold else \
+            "improvement" if change < -threshold else "ok"
+        rows.append((name, before, after, change, status))
+    return rows
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1e-3:
+        return "{:.2f} us".format(1e6 * seconds)
+    if seconds < 1:
+        return "{:.2f} ms".format(1e3 * seconds)
+    return "{:.2f} s".format(seconds)
+
+
+def print_comparison(rows):
+    print("[Benchmark] {:<36}{:>12}{:>12}{:>10}".format("benchmark", "baseline", "current", "change"))
+    for name, before, after, change, status in rows:
+        print("[Benchmark] {:<36}{:>12}{:>12}{:>10}  {}".format(
+            name, format_seconds(before), format_seconds(after),
+            "{:+.1%}".format(change) if change is not None else "", status.upper()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the crawler's hot functions")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    compare_parser = commands.add_parser("compare",
+                                         help="compare a run (or a new one) against a baseline")
+    compare_parser.add_argument("baseline", help="JSON file of the baseline")
+    compare_parser.add_argument("current", nargs="?",
+                                help="JSON file of the compared run (runs the benchmarks if not given)")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                                help="relative slowdown reported as a regression")
+    for command_parser in (run_parser, compare_parser):
+        command_parser.add_argument("--filter", metavar="REGEX",
+                                    help="only run benchmarks whose name matches")
+        command_parser.add_argument("--min-time", type=float, default=0.2,
+                                    help="minimum seconds of one repeat")
+        command_parser.add_argument("--repeat", type=int, default=5)
+        command_parser.add_argument("--output", metavar="FILE", help="save the run as JSON")
+    args = parser.parse_args()
+
+    if args.command == "compare" and args.current:
+        with open(args.current) as current_file:
+            run = json.load(current_file)
+    else:
+        run = run_suite(args.filter, min_time=args.min_time, repeat=args.repeat)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(run, output, indent=2)
+
+    if args.command == "compare":
+        with open(args.baseline) as baseline_file:
+            baseline_run = json.load(baseline_file)
+        if args.filter:
+            baseline_run["results"] = {name: result for name, result in baseline_run["results"].items()
+                                       if re.search(args.filter, name)}
+        comparison = compare(baseline_run, run, threshold=args.threshold)
+        print_comparison(comparison)
+        regressions = [row for row in comparison if row[-1] == "regression"]
+        if regressions:
+            print("[Benchmark] {} regression(s) above {:.0%}...".format(len(regressions), args.threshold))
+            sys.exit(1)
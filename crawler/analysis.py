@@ -0,0 +1,211 @@
+"""
+This file contains the CPU-bound part of crawling a page (link extraction, LSH signature and
+fingerprint), which can run in a pool of processes instead of the crawler's threads. Threads
+of an `Agent` share one interpreter, so while they are parsing, at most one core is used no
+matter how many workers fetch pages.
+
+With an `Analyzer`, crawling threads submit the HTML to a `ProcessPoolExecutor` and get back a
+compact `PageAnalysis` (lists of strings, no parsed trees), which is stored into the `Page` so
+that the rest of `crawl_page` uses it as if it had been computed in the thread. `start` does not
+wait for the worker, so the thread can go on with other pages until the results are needed
+(`finish`).
+
+Example usage:
+
+> analyzer = Analyzer("./data/test2.txt", max_workers=4)
+> page = Page("http://evem.gov.si", text=html)
+> analyzer.start(page)
+> ...
+> analyzer.finish(page)
+> page.extracted.links, page.signature
+"""
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os.path import abspath
+
+from crawler import lsh
+from crawler.page import Page
+
+# LSH object of a worker process (built by `init_worker`, lambdas cannot be sent to processes)
+worker_lsh = None
+
+
+def read_vocab_file(name):
+    with open(name) as f:
+        content = f.readlines()
+    # Remove whitespace characters like `\n` at the end of each line
+    content = [x.strip() for x in content]
+    return content
+
+
+def triples(big_string):
+    """
+    input: Big string, for example html_content
+    return: list of triples from that string
+    """
+    for i in range(len(big_string) - 3 + 1):
+        yield big_string[i: i + 3]
+
+
+def stable_hash(idx):
+    # unlike `hash(str(idx))`, gives the same value in every process (and every run)
+    return zlib.crc32(str(idx).encode("utf-8"))
+
+
+def build_lsh(vocab):
+    """ Creates the LSH object that the crawler uses for duplicate detection.
+
+    Parameters
+    ----------
+    vocab: list of str
+        Vocabulary (see `read_vocab_file`)
+
+    Returns
+    -------
+    crawler.lsh.LocalitySensitiveHashing
+    """
+    return lsh.LocalitySensitiveHashing(vocab,
+                                        num_hash=1,
+                                        hash_funcs=[stable_hash],
+                                        num_bands=1,
+                                        repr_func=triples)
+
+
+class PageAnalysis:
+    """
+    Result of `analyze_html`.
+
+    Attributes
+    ----------
+    extracted: crawler.extract.ExtractedPage
+        Base href, links and images of the page
+
+    signature: str
+        LSH signature of the page (see `crawler.page.Page.lsh_hash`)
+
+    fingerprint: str
+        SHA-256 hex digest of the page (see `crawler.page.Page.fingerprint`)
+    """
+
+    def __init__(self, extracted, signature, fingerprint):
+        self.extracted = extracted
+        self.signature = signature
+        self.fingerprint = fingerprint
+
+
+def init_worker(vocab_path):
+    global worker_lsh
+    worker_lsh = build_lsh(read_vocab_file(vocab_path))
+
+
+def analyze_html(url, html):
+    """ Work done by a worker process for a single page (a module-level function, so that it
+    can be sent to the process pool).
+
+    Parameters
+    ----------
+    url: str
+        URL of the page
+
+    html: str
+        (Rendered) HTML of the page
+
+    Returns
+    -------
+    PageAnalysis
+    """
+    page = Page(url, text=html)
+    return PageAnalysis(page.extracted, page.lsh_hash(worker_lsh), page.fingerprint)
+
+
+class Analyzer:
+
+    def __init__(self, vocab_path, max_workers=None):
+        """
+        Parameters
+        ----------
+        vocab_path: str
+            Path to the LSH vocabulary file (every worker process builds its own LSH object)
+
+        max_workers: int, optional
+            Number of worker processes. Defaults to the number of cores.
+        """
+        # 'spawn' so workers do not inherit the crawler's threads (database writer, webdriver)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                            mp_context=get_context("spawn"),
+                                            initializer=init_worker,
+                                            initargs=(abspath(vocab_path),))
+
+    def submit(self, page):
+        """ Starts analyzing the page in a worker process.
+
+        Returns
+        -------
+        concurrent.futures.Future:
+            Future of a `PageAnalysis`
+        """
+        return self.executor.submit(analyze_html, page.url, page.html)
+
+    def start(self, page):
+        """ Starts analyzing the page in a worker process, without waiting for it. The
+        analysis is stored into the page by `finish`.
+
+        Parameters
+        ----------
+        page: crawler.page.Page
+            Fetched HTML page
+
+        Returns
+        -------
+        bool:
+            Whether the analysis was started
+        """
+        if page.html is None:
+            return False
+        try:
+            page.analysis = self.submit(page)
+        except Exception as e:
+            print("[Analyzer] Analysis of '{}' failed, analyzing it in the thread... {}".format(
+                page.url, e))
+            return False
+        return True
+
+    def finish(self, page):
+        """ Waits for the analysis that `start` submitted and stores the results into the page.
+        If the pool fails, nothing is stored and the page computes everything itself when
+        needed.
+
+        Returns
+        -------
+        bool:
+            Whether the analysis was stored into the page
+        """
+        future, page.analysis = page.analysis, None
+        if future is None:
+            return False
+        try:
+            analysis = future.result()
+        except Exception as e:
+            print("[Analyzer] Analysis of '{}' failed, analyzing it in the thread... {}".format(
+                page.url, e))
+            return False
+
+        page.extracted = analysis.extracted
+        page.fingerprint = analysis.fingerprint
+        page.signature = analysis.signature
+        return True
+
+    def analyze(self, page):
+        """ Analyzes the page in a worker process and waits for the results (see `start` and
+        `finish`).
+
+        Returns
+        -------
+        bool:
+            Whether the analysis was stored into the page
+        """
+        return self.start(page) and self.finish(page)
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -0,0 +1,103 @@
+"""
+This file contains the content-addressed store for downloaded files and images. Every blob
+is stored once, under the SHA-256 hash of its content, so identical assets (the same logo
+on every site, the same PDF linked from many pages) take the disk space of a single copy,
+and files that share a name can no longer overwrite each other.
+
+Blobs are sharded into two levels of directories by the first bytes of their hash
+('ab/cd/abcd...'), which keeps directories small; the path of a blob is computed from its
+hash, so a lookup never has to search. Writes go through a temporary file that is renamed
+into place only once it is complete.
+
+The database only stores the hash (and size) of the blob; `BlobStore.path_for` turns it back
+into a path.
+
+Example usage:
+
+> store = BlobStore("files/blobs")
+> blob = store.put_stream(requests.get("http://evem.gov.si/vloga.pdf", stream=True))
+> store.path_for(blob.sha256)
+'files/blobs/3f/a2/3fa2...'
+"""
+import hashlib
+import os
+import threading
+from collections import namedtuple
+from os.path import join, exists
+
+from crawler.download import stream_to_file, MAX_DOWNLOAD_BYTES, CHUNK_SIZE
+
+Blob = namedtuple("Blob", ["sha256", "size", "path"])
+
+
+class BlobStore:
+
+    def __init__(self, root):
+        """
+        Parameters
+        ----------
+        root: str
+            Directory of the store (created when the first blob is written)
+        """
+        self.root = root
+        # temporary files live inside the store, so renaming them into place is atomic
+        self.temp_dir = join(root, "tmp")
+
+    def path_for(self, sha256):
+        """ Path of the blob with the given SHA-256 hex digest (whether it exists or not)."""
+        return join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def contains(self, sha256):
+        return exists(self.path_for(sha256))
+
+    def commit(self, temp_path, sha256, size):
+        """ Moves a complete temporary file into place (or drops it if the blob is stored already)."""
+        path = self.path_for(sha256)
+        if exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return Blob(sha256, size, path)
+
+    def temp_path(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        return join(self.temp_dir, "{}-{}".format(os.getpid(), threading.get_ident()))
+
+    def put_stream(self, response, max_bytes=MAX_DOWNLOAD_BYTES, chunk_size=CHUNK_SIZE):
+        """ Stores the body of a streamed response (see `crawler.download.stream_to_file`,
+        whose exceptions are passed on; nothing is stored in that case).
+
+        Returns
+        -------
+        Blob:
+            SHA-256 hex digest, size (in bytes) and path of the stored blob
+        """
+        download = stream_to_file(response, self.temp_path(), max_bytes=max_bytes, chunk_size=chunk_size)
+        return self.commit(download.path, download.sha256, download.size)
+
+    def put_bytes(self, data):
+        """ Stores a blob that is already in memory. If the blob is stored already, nothing is written.
+
+        Returns
+        -------
+        Blob
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256)
+        if exists(path):
+            return Blob(sha256, len(data), path)
+
+        temp_path = self.temp_path()
+        try:
+            with open(temp_path, "wb") as temp_file:
+                temp_file.write(data)
+            return self.commit(temp_path, sha256, len(data))
+        except BaseException:
+            if exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def open(self, sha256):
+        """ Opens a stored blob for reading (binary mode)."""
+        return open(self.path_for(sha256), "rb")
@@ -1,25 +1,41 @@
 import requests
-import re
 import threading
 import selenium
 import sys
 
+from contextlib import contextmanager
 from queue import Queue
-from time import sleep, time
+from time import perf_counter, sleep, time
 from datetime import datetime
-from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
-from urllib.request import urlretrieve
 from urllib.parse import urlparse, urljoin
-from os import environ, makedirs
-from os.path import splitext, exists, abspath, join, dirname
+from requests.utils import get_encoding_from_headers
+from os import environ, getpid
+from os.path import abspath, join, dirname
 import hashlib
 
-from crawler import db, lsh
+from crawler import db
 from crawler import robots as rb
 from crawler import sitemap as sm
-from crawler.links import Links
+from crawler.links import Links, CanonicalizationRules
+from crawler.settings import SettingsReader
+from crawler.scope import Scope
+from crawler.frontier import PostgresFrontier
+from crawler.partition import Coordinator
+from crawler.pipeline import Pipeline, Stage
+from crawler.blobstore import BlobStore
+from crawler.download import TIMEOUT_PERIOD, USER_AGENT
+from crawler.images import ImageDownloader
+from crawler.extract import absolutize, get_url_extension, js_redirects, normalize_url
+from crawler.page import Page
+from crawler.analysis import Analyzer, build_lsh, read_vocab_file
+from crawler.warc import WarcWriter, archive_paths, read_pages
+from crawler.metrics import METRICS, MetricsServer, TimedHTTPAdapter
+from crawler.profiler import SamplingProfiler, install_signal_handler
+from crawler.memory import LinkSpill, MemoryMonitor
+from crawler.ratelimit import RateController
+from crawler.health import RETRY_STATUS_CODES, CircuitBreaker, RetryQueue
 
 
 """
@@ -34,16 +50,12 @@ DOWNLOADABLE_CONTENT_TYPES = {"application/vnd.openxmlformats-officedocument.pre
                               "application/msword": "DOC",
                               "application/vnd.ms-powerpoint": "PPT",
                               "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "DOCX"}
-# how long the crawler waits before giving up on a page (in seconds)
-TIMEOUT_PERIOD = 10.0
-
-
-def get_url_extension(url):
-    # Returns the filename extension or '' if none. For example "png", "html", ...
-
-    parsed = urlparse(url)
-    root, extension = splitext(parsed.path)
-    return extension[1:]
+# root of the project (paths in the settings are relative to it)
+PROJECT_ROOT = abspath(join(dirname(__file__), '..'))
+# downloaded files and images, stored by the hash of their content
+BLOB_STORE = BlobStore(join(PROJECT_ROOT, 'files', 'blobs'))
+# vocabulary of the LSH duplicate detection
+VOCAB_PATH = "./data/test2.txt"
 
 
 def get_base_href(soup_obj, fallback):
@@ -96,182 +108,130 @@ def find_links(base_url, soup_obj, parse_js_redirects=False):
     Returns
     -------
     list of str:
-        List of absolute URLs
-    """
-
-    """
-    This regexp will extract links from value assignments of kind window.location(.href/.assign) = "link"
-    E.g. this example will result in "link".
-    """
-    regexp_set_value = r"window.location(\.href|\.assign)?\s*=\s*'(.+)'"
-
+        List of absolute URLs. Relative hrefs (not only the ones starting with '/' or '?') are
+        resolved against `base_url` and hrefs that are not http(s) URLs (mailto:, javascript:,
+        ...) are left out.
     """
-    This regexp will extract links from value of kind self/top.location = "link" (could be .replace)
-    E.g. this example will result in "link".
-    """
-    regexp_self_top = r"(self|top)\.location\s*=\s*'(.+)'"
-
-    """
-    This regexp will extract links from functional calls of kind window.location.assign("yeet") (could be .replace)
-    E.g. this example will result in "yeet".
-    """
-    regexp_func_call = r"window.location(\.assign|\.replace)\('(.+)'"
 
     a_tags = soup_obj.find_all("a")
     button_tags = soup_obj.find_all("button")
     links = []
 
-    def normalize_url(url):
-        return Links.remove_www(
-            Links.prune_to_max_depth(Links.sanitize(url), 10))
-
     for anchor in a_tags:
         link = anchor.get("href")
         onclick = anchor.get("onclick")
-        if link:
-            processed_link = link
-            if link[0] in {"/", "?"}:
-                processed_link = urljoin(base_url, link)
-            elif link[0] == "#":
-                continue
-
-            links.append(normalize_url(processed_link))
+        if link and link[0] != "#":
+            processed_link = normalize_url(absolutize(base_url, link))
+            if processed_link is not None:
+                links.append(processed_link)
         if onclick and parse_js_redirects:
-            links.extend([normalize_url(second_el)
-                          for _, second_el in re.findall(regexp_set_value, onclick)])
-            links.extend([normalize_url(second_el)
-                          for _, second_el in re.findall(regexp_self_top, onclick)])
-            links.extend([normalize_url(second_el)
-                          for _, second_el in re.findall(regexp_func_call, onclick)])
+            links.extend([c.url for c in Links.canonicalize_all(js_redirects(onclick))])
 
     if parse_js_redirects:
         for button in button_tags:
             onclick = button.get("onclick")
             if onclick:
-                links.extend([normalize_url(second_el)
-                              for _, second_el in re.findall(regexp_set_value, onclick)])
-                links.extend([normalize_url(second_el)
-                              for _, second_el in re.findall(regexp_self_top, onclick)])
-                links.extend([normalize_url(second_el)
-                              for _, second_el in re.findall(regexp_func_call, onclick)])
+                links.extend([c.url for c in Links.canonicalize_all(js_redirects(onclick))])
 
     return links
 
 
-def save_image(base_url, image_src):
+def save_image(base_url, image_src, store=None):
     """
-    Saves an image to the disk under the current crawled page's URL. The image's
-    path will look something like '../files/images/example.com/image_name.png'
+    Saves an image into the blob store (see `crawler.blobstore.BlobStore`), where it is
+    kept once, under the hash of its content.
 
     Parameters
     ----------
     base_url: str
-        URL of the page which we are currently crawling so we can
-        locate the correct folder we need to save the image in.
+        URL that a relative `image_src` is resolved against.
 
         Should be passed from the <base href=".."> element if it exists.
 
     image_src: str
         URL of image which you want to download.
 
+    store: crawler.blobstore.BlobStore, optional
+        Store to save the image into. Defaults to `BLOB_STORE`.
+
     Returns
     -------
-    TODO
+    crawler.blobstore.Blob or None:
+        Hash, size and path of the saved image (None if it could not be saved)
     """
-    # cross-platform path to the file/images directory
-    images_dir = abspath(join(dirname(__file__), '..', 'files', 'images'))
-
-    # the path to the folder of the current crawled page
-    current_url_directory = images_dir + '/' + urlparse(base_url).netloc
-
-    # getting the URL element from the last slash onwards and treating it as the filename
-    image_filename = image_src.rsplit('/', 1)[-1]
-
-    # filename (path) of the downloaded image
-    image_destination = current_url_directory + '/' + image_filename
-
-    if not exists(current_url_directory):
-        makedirs(current_url_directory)
-
-    abs_image_url = base_url + '/' + image_src
+    store = store if store is not None else BLOB_STORE
     try:
-        urlretrieve(image_src, image_destination)
-        print("Got image: ", image_filename)
+        response = requests.get(absolutize(base_url, image_src), headers={"User-Agent": Agent.USER_AGENT},
+                                timeout=TIMEOUT_PERIOD, stream=True)
+        blob = store.put_stream(response, max_bytes=SettingsReader.config["downloads"]["max_bytes"])
+        print("Got image: ", image_src.rsplit('/', 1)[-1])
+        return blob
     except Exception as e:
-        try:
-            # Try with absolute URL
-            urlretrieve(abs_image_url, image_destination)
-            print("Got image (abs): ", image_filename)
-        except Exception as e2:
-            print(abs_image_url)
-            print("Failed to retrieve image")
-            # print(image_src)
-            # print(abs_image_url)
-            print(e)
-            print(e2)
-
-    return image_destination, image_filename
+        print("Failed to retrieve image")
+        print(e)
+        return None
 
 
-def save_file(base_url, file_src, file_extension, db, url):
+def save_file(file_src, file_extension, db, url, response=None, store=None):
     """
-    Saves a file to the disk under the current crawled page's URL. The file's
-    path will look something like '../files/pptx/example.com/some_pres.pptx'
+    Saves a file into the blob store (see `crawler.blobstore.BlobStore`), where it is
+    kept once, under the hash of its content, and records it in the database.
 
     Parameters
     ----------
-    base_url: str
-        URL of the page which we are currently crawling so we can
-        locate the correct folder we need to save the file in.
-
-        Should be passed from the <base href=".."> element if it exists.
-
     file_src: str
         URL of the file from which you want to download it.
 
     file_extension: str
         The extension of the file that you have detected from the response's
-        content-type. It will be used to save the file under a correct folder
-        inside the files directory.
-    db: 
-        Database connection
-
-        E.g. files/pptx/example.com/pres.pptx or files/pdf/example.com/pricelist.pdf
-
-    Returns
-    -------
-    TODO
-    """
-    # cross-platform path to the files/extension directory
-    files_dir = abspath(join(dirname(__file__), '..', 'files', file_extension))
+        content-type (data type of the file in the database).
 
-    # the path to the folder of the current crawled page
-    current_url_directory = files_dir + '/' + base_url
+    db: crawler.db.Database or None
+        Database session to record the file in (not recorded if None)
 
-    # getting the URL element from the last slash onwards and treating it as the filename
-    file_filename = file_src.rsplit('/', 1)[-1]
+    url: str
+        URL of the page the file belongs to
 
-    # filename (path) of the downloaded file
-    file_destination = current_url_directory + '/' + file_filename
+    response: requests.Response, optional
+        Streamed response (`stream=True`) for `file_src` whose body was not read yet. If
+        given, the body is saved from it instead of requesting the file again.
 
-    if not exists(current_url_directory):
-        makedirs(current_url_directory)
+    store: crawler.blobstore.BlobStore, optional
+        Store to save the file into. Defaults to `BLOB_STORE`.
 
+    Returns
+    -------
+    crawler.blobstore.Blob or None:
+        Hash, size and path of the saved file (None if it could not be saved)
+    """
+    store = store if store is not None else BLOB_STORE
+    download_config = SettingsReader.config["downloads"]
+    host = urlparse(file_src).netloc
     try:
-        urlretrieve(file_src, file_destination)
-        print("Got file: ", file_filename)
+        with METRICS.timer("download", host=host) as labels:
+            if response is None:
+                response = requests.get(file_src, headers={"User-Agent": Agent.USER_AGENT},
+                                        timeout=TIMEOUT_PERIOD, stream=True)
+            labels["status"] = response.status_code
+            # the body goes to the disk in chunks (never whole into memory), hashed along the way
+            blob = store.put_stream(response, max_bytes=download_config["max_bytes"],
+                                    chunk_size=download_config["chunk_size"])
+        METRICS.count("downloaded_bytes", blob.size, host=host)
+        print("Got file: ", file_src.rsplit('/', 1)[-1])
     except Exception as e:
         print("Failed to retrieve file.")
         print(e)
+        return None
 
     # Save the file information into the db
-    db.insert_file_into_db(url, file_extension, file_destination)
+    if db is not None:
+        db.insert_file_into_db(url, file_extension, blob.sha256, blob.size)
 
-    return file_destination, file_filename
+    return blob
 
 
 def find_images(current_url, soup_obj, db, url):
-    """ Find links inside <a> tags.
+    """ Find images inside <img> tags, save them to disk and to the database.
 
     Parameters
     ----------
@@ -296,41 +256,57 @@ def find_images(current_url, soup_obj, db, url):
             elif src[0] == "#":
                 continue
             if get_url_extension(processed_src) in ["png", "jpeg", "jpg"]:
-                # Download the image to the disk
-                (image_path, image_name) = save_image(current_url, processed_src)
-                # Save the image information to DB
-                db.add_image(url, image_name, get_url_extension(processed_src), image_path)
-
                 images.append(processed_src)
-                # Probably no need to even return images. They will be saved into db in this function.
 
-    return images
+    return save_images(current_url, images, db, url)
 
 
-def read_vocab_file(name):
-    with open(name) as f:
-        content = f.readlines()
-    # Remove whitespace characters like `\n` at the end of each line
-    content = [x.strip() for x in content]
-    return content
+def save_images(base_url, image_srcs, db, url):
+    """ Downloads images to the disk and saves their information to the database.
 
+    Parameters
+    ----------
+    base_url: str
+        Base href of the page the images were found on
 
-def triples(big_string):
-    """
-    input: Big string, for example html_content
-    return: list of triples from that string
+    image_srcs: list of str
+        URLs of images (e.g. `ExtractedPage.images`)
+
+    db: crawler.db.Database
+        Database connection
+
+    url: str
+        URL of the page the images were found on
+
+    Returns
+    -------
+    list of str:
+        `image_srcs`
     """
-    for i in range(len(big_string) - 3 + 1):
-        yield big_string[i: i + 3]
+    for image_src in image_srcs:
+        # Download the image to the disk
+        blob = save_image(base_url, image_src)
+        # Save the image information to DB
+        if blob is not None:
+            db.add_image(url, image_src.rsplit('/', 1)[-1], get_url_extension(image_src),
+                         blob.sha256, blob.size)
+
+    return image_srcs
 
 
 class Agent:
-    USER_AGENT = "govrilovic-crawler/v0.1"
+    USER_AGENT = USER_AGENT
     MAX_CRAWLED_PAGES = 100000
 
-    def __init__(self, seed_pages, num_workers=None, sleep_period=1, get_files=False):
+    def __init__(self, seed_pages, num_workers=None, sleep_period=1, get_files=False,
+                 canonicalizer=None, scope=None, analysis_processes=None):
+        # Rules that collapse equivalent URLs before they enter the frontier
+        self.canonicalizer = canonicalizer if canonicalizer is not None else \
+            CanonicalizationRules.from_config(SettingsReader.config)
+        # Decides which links are allowed into the frontier
+        self.scope = scope if scope is not None else Scope.from_config(SettingsReader.config)
         # contains links for the next level of crawling (using BFS strategy)
-        self.link_queue = set(seed_pages)
+        self.link_queue = set(self.canonicalizer.apply_all(seed_pages))
         self.visited = set()
         # Unique sites, each has its own (possibly) robots.txt file etc.
         self.sites = set()
@@ -344,75 +320,367 @@ class Agent:
 
         # number of visited unique links
         self.visited_uniq_links = 0
-
-        # Selenium webdriver initialization
-        chromedriver = environ["CHROME_DRIVER"]
-        chrome_options = webdriver.ChromeOptions()
-        # Accepts untrusted certificates and thus prevents some SSLErrors
-        chrome_options.accept_untrusted_certs = True
-        chrome_options.add_argument('--headless')
-        self.driver = webdriver.Chrome(
-            chrome_options=chrome_options, executable_path=chromedriver)
-        # Set timeout for the request
-        self.driver.set_page_load_timeout(TIMEOUT_PERIOD)
+        # guards `visited_uniq_links` when it is counted by several threads (shared frontier)
+        self.visited_lock = threading.Lock()
+
+        # one lock per site, held while waiting for its crawl delay and fetching from it
+        self.site_locks = {}
+        # Delays between requests to a host, adapted to its responses (see SettingsReader's
+        # 'politeness' section); None for the fixed delays of robots.txt and `sleep_period`
+        politeness_config = SettingsReader.config["politeness"]
+        self.rate_controller = RateController(
+            initial_delay=politeness_config["initial_delay"],
+            min_delay=politeness_config["min_delay"],
+            max_delay=politeness_config["max_delay"],
+            increase=politeness_config["increase"],
+            backoff=politeness_config["backoff"],
+            slow_latency=politeness_config["slow_latency"],
+            latency_factor=politeness_config["latency_factor"],
+            max_retry_after=politeness_config["max_retry_after"]) \
+            if politeness_config["adaptive"] else None
+        # Parks the URLs of hosts that keep failing and schedules failed URLs to be crawled
+        # again (see SettingsReader's 'health' section)
+        health_config = SettingsReader.config["health"]
+        self.breaker = CircuitBreaker(failure_threshold=health_config["failure_threshold"],
+                                      open_seconds=health_config["open_seconds"],
+                                      max_open_seconds=health_config["max_open_seconds"])
+        self.retry_queue = RetryQueue(max_attempts=health_config["max_attempts"],
+                                      base_delay=health_config["base_delay"],
+                                      max_delay=health_config["max_delay"],
+                                      max_park_seconds=health_config["max_park_seconds"])
+        # Selenium webdrivers of all threads (a webdriver must only be used by one thread)
+        self.drivers = []
+        self.drivers_lock = threading.Lock()
+        # webdrivers that were running at the last `recycle_browsers`, restarted by their threads
+        self.stale_drivers = set()
+        # links from sitemaps are only added while memory is below its soft limit
+        self.expand_sitemaps = True
+        # HTTP sessions of all threads (see `Agent.session`)
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
 
         # LSH object
-        vocab = read_vocab_file("./data/test2.txt")
-        self.lsh_obj = lsh.LocalitySensitiveHashing(vocab,
-                                                    num_hash=1,
-                                                    hash_funcs=[
-                                                        lambda idx: hash(str(idx))
-                                                    ],
-                                                    num_bands=1,
-                                                    repr_func=triples)
+        self.lsh_obj = build_lsh(read_vocab_file(VOCAB_PATH))
+        # Parsing and hashing in worker processes (see SettingsReader's 'analysis' section)
+        analysis_processes = SettingsReader.config["analysis"]["processes"] \
+            if analysis_processes is None else analysis_processes
+        self.analyzer = Analyzer(VOCAB_PATH, max_workers=analysis_processes) \
+            if analysis_processes else None
 
         # Database
-        self.pool = db.Pool()
-        self.db = None # gets initialized by thread worker
+        writer_config = SettingsReader.config["database"]
+        self.pool = db.Pool(max_connections=writer_config["max_connections"],
+                            html_storage=writer_config["html_storage"])
+        # Batches the inserts of all workers (see SettingsReader's 'database' section)
+        self.writer = db.BulkWriter(self.pool,
+                                    batch_size=writer_config["batch_size"],
+                                    flush_interval=writer_config["flush_interval"],
+                                    max_pending=writer_config["max_pending"])
+        # browsers and HTTP sessions of the worker threads
+        self.thread_local = threading.local()
+        # Images are downloaded in the background (see SettingsReader's 'images' section)
+        images_config = SettingsReader.config["images"]
+        self.images = ImageDownloader(self.writer, BLOB_STORE,
+                                      workers=images_config["workers"],
+                                      max_pending=images_config["max_pending"],
+                                      host_delay=images_config["host_delay"],
+                                      max_images=images_config["max_images"],
+                                      max_bytes=SettingsReader.config["downloads"]["max_bytes"]) \
+            if get_files else None
+        # Responses are archived into WARC files (see SettingsReader's 'archive' section)
+        archive_config = SettingsReader.config["archive"]
+        self.archive = WarcWriter(join(PROJECT_ROOT, archive_config["directory"]),
+                                  max_file_size=archive_config["max_file_size"]) \
+            if archive_config["enabled"] else None
+
+        # Stage timings (see SettingsReader's 'metrics' section)
+        metrics_config = SettingsReader.config["metrics"]
+        self.metrics_server = None
+        if metrics_config["port"]:
+            try:
+                self.metrics_server = MetricsServer(METRICS, host=metrics_config["host"],
+                                                    port=metrics_config["port"])
+                print("[Agent] Serving metrics at http://{}:{}/metrics...".format(
+                    *self.metrics_server.address))
+            except OSError as e:
+                # e.g. another agent of a multi-process crawl already serves them
+                print("[Agent] Could not serve metrics: {}".format(e))
+        self.metrics_stopped = threading.Event()
+        if metrics_config["report_interval"]:
+            threading.Thread(target=METRICS.report_periodically,
+                             args=(metrics_config["report_interval"], self.metrics_stopped),
+                             daemon=True).start()
+
+        # Stacks of all threads, sampled on demand (see SettingsReader's 'profiler' section)
+        profiler_config = SettingsReader.config["profiler"]
+        self.profiler = SamplingProfiler(join(PROJECT_ROOT, profiler_config["directory"]),
+                                         duration=profiler_config["duration"],
+                                         interval=profiler_config["interval"])
+        if profiler_config["signal"] and install_signal_handler(self.profiler):
+            print("[Agent] Profile the crawl with: kill -USR1 {}".format(getpid()))
+        self.profiler_timer = None
+        if profiler_config["start_after"]:
+            self.profiler_timer = threading.Timer(profiler_config["start_after"], self.profiler.start)
+            self.profiler_timer.daemon = True
+            self.profiler_timer.start()
+
+        # Memory usage and soft limits (see SettingsReader's 'memory' section)
+        memory_config = SettingsReader.config["memory"]
+        self.max_frontier_links = memory_config["frontier_links"]
+        # links of the current level and of the next one that did not fit into memory
+        self.link_spill = LinkSpill(join(PROJECT_ROOT, memory_config["spill_directory"]))
+        self.next_link_spill = LinkSpill(join(PROJECT_ROOT, memory_config["spill_directory"]),
+                                         name="next-links")
+        self.memory_monitor = MemoryMonitor(
+            {"visited": lambda: self.visited, "link_queue": lambda: self.link_queue,
+             "last_crawled": lambda: self.last_crawled, "robots_file": lambda: self.robots_file,
+             "sites": lambda: self.sites, "site_locks": lambda: self.site_locks},
+            interval=memory_config["interval"],
+            limits={"rss_mb": memory_config["rss_mb"],
+                    "browser_rss_mb": memory_config["browser_rss_mb"]},
+            actions={"rss_mb": (self.pause_sitemaps, self.resume_sitemaps),
+                     "browser_rss_mb": (self.recycle_browsers, None)},
+            tracemalloc_frames=memory_config["tracemalloc_frames"],
+            top=memory_config["top"], browser_pids=self.browser_pids)
+        if memory_config["interval"]:
+            self.memory_monitor.start()
+
+        # Crawl stages running concurrently (see SettingsReader's 'pipeline' section)
+        pipeline_config = SettingsReader.config["pipeline"]
+        self.pipeline = self.create_pipeline(pipeline_config["stages"]) \
+            if pipeline_config["enabled"] else None
+        self.pipeline_report_interval = pipeline_config["report_interval"]
+
+    def database(self):
+        """ Database session for a with block. Its connection is only leased for the block, so
+        workers do not hold one while waiting for a host, fetching or rendering, and there can
+        be more workers than database connections."""
+        return db.Database(self.pool, self.writer)
+
+    @property
+    def session(self):
+        """ HTTP session of the current thread. It keeps connections to hosts open between
+        requests and records the time of opening them (see `crawler.metrics.TimedHTTPAdapter`)."""
+        session = getattr(self.thread_local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.headers["User-Agent"] = Agent.USER_AGENT
+            session.mount("http://", TimedHTTPAdapter())
+            session.mount("https://", TimedHTTPAdapter())
+            self.thread_local.session = session
+            with self.sessions_lock:
+                self.sessions.append(session)
+        return session
+
+    @property
+    def driver(self):
+        """ Selenium webdriver of the current thread (started when the thread first needs it)."""
+        driver = getattr(self.thread_local, "driver", None)
+        if driver is not None and driver in self.stale_drivers:
+            # restart the browser to free the memory it has accumulated
+            with self.drivers_lock:
+                self.drivers.remove(driver)
+                self.stale_drivers.discard(driver)
+            driver.quit()
+            driver = None
+        if driver is None:
+            # Selenium webdriver initialization
+            chromedriver = environ["CHROME_DRIVER"]
+            chrome_options = webdriver.ChromeOptions()
+            # Accepts untrusted certificates and thus prevents some SSLErrors
+            chrome_options.accept_untrusted_certs = True
+            chrome_options.add_argument('--headless')
+            driver = webdriver.Chrome(
+                chrome_options=chrome_options, executable_path=chromedriver)
+            # Set timeout for the request
+            driver.set_page_load_timeout(TIMEOUT_PERIOD)
+            self.thread_local.driver = driver
+            with self.drivers_lock:
+                self.drivers.append(driver)
+        return driver
+
+    def browser_pids(self):
+        """ Process ids of the chromedrivers of the running browsers (the browsers are their
+        child processes)."""
+        with self.drivers_lock:
+            drivers = list(self.drivers)
+        pids = []
+        for driver in drivers:
+            process = getattr(getattr(driver, "service", None), "process", None)
+            if process is not None:
+                pids.append(process.pid)
+        return pids
+
+    def close_thread(self):
+        """ Quits the browser and closes the HTTP session of the current thread. Threads that
+        end before the crawl does (e.g. the workers of every level) call this, so their browsers
+        do not outlive them."""
+        driver = getattr(self.thread_local, "driver", None)
+        if driver is not None:
+            with self.drivers_lock:
+                self.drivers.remove(driver)
+                self.stale_drivers.discard(driver)
+            self.thread_local.driver = None
+            try:
+                driver.quit()
+            except Exception as e:
+                print("[Agent] Failed to quit a browser: ", e)
+        session = getattr(self.thread_local, "session", None)
+        if session is not None:
+            with self.sessions_lock:
+                self.sessions.remove(session)
+            self.thread_local.session = None
+            session.close()
+
+    def recycle_browsers(self):
+        """ Makes every thread restart its browser before rendering the next page. Called after
+        every measurement while the browsers are above their memory limit, so nothing is done
+        while browsers of the previous call have not been restarted yet."""
+        with self.drivers_lock:
+            if self.stale_drivers:
+                return
+            self.stale_drivers = set(self.drivers)
+        print("[Agent] Restarting {} browsers...".format(len(self.stale_drivers)))
+
+    def pause_sitemaps(self):
+        if self.expand_sitemaps:
+            print("[Agent] Pausing the expansion of sitemaps...")
+        self.expand_sitemaps = False
+
+    def resume_sitemaps(self):
+        print("[Agent] Resuming the expansion of sitemaps...")
+        self.expand_sitemaps = True
+
+    def create_pipeline(self, stages_config):
+        """ Creates the pipeline of crawl stages (fetch -> render -> parse -> dedup -> persist
+        -> download), each with its own number of workers and queue size.
+
+        Parameters
+        ----------
+        stages_config: dict
+            Stage name -> {'workers': int, 'queue_size': int}
+
+        Returns
+        -------
+        crawler.pipeline.Pipeline
+        """
+        functions = [("fetch", self.fetch_stage),
+                     ("render", self.render_stage),
+                     ("parse", self.parse_stage),
+                     ("dedup", self.dedup_stage),
+                     ("persist", self.persist_stage),
+                     ("download", self.download_stage)]
+        return Pipeline([Stage(name, function, workers=stages_config[name]["workers"],
+                               queue_size=stages_config[name]["queue_size"])
+                         for name, function in functions],
+                        on_finish=self.finish_page)
+
+    def finish_page(self, page):
+        """ Called for every page that leaves the pipeline."""
+        self.archive_page(page)
+        page.close()
+        if page.status_code is not None:
+            METRICS.observe("page", perf_counter() - page.created, host=page.site_url)
+        self.thread_res_queue.put(page.new_links)
+
+    def archive_page(self, page):
+        """ Writes the response of a fetched page (and its rendered HTML) into the archive."""
+        if self.archive is None or page.status_code is None:
+            return
+        try:
+            if page.raw is not None:
+                self.archive.write_response(page.url, page.status_code, page.headers, page.raw,
+                                            rendered=page.rendered)
+            elif page.blob is not None:
+                # the body of binary content is copied from the blob store in chunks
+                with BLOB_STORE.open(page.blob.sha256) as body:
+                    self.archive.write_response(page.url, page.status_code, page.headers,
+                                                (body, page.blob.size))
+            else:
+                # the body was never downloaded
+                self.archive.write_response(page.url, page.status_code, page.headers, truncated=True)
+        except Exception as e:
+            print("[archive_page] Failed to archive '{}': {}".format(page.url, e))
 
 
     
-    def simillar_lsh_hash(self, lsh_hash, content, site_url, status_code):
+    def simillar_lsh_hash(self, page, site_url):
         '''
         Find simillar lsh_hash websites and do all the actions if site is a duplicate.
+        Returns the URL of the original page if the page is a duplicate.
         '''
-        return self.db.same_lsh_sites(lsh_hash, content, site_url, status_code)
+        lsh_hash = page.lsh_hash(self.lsh_obj)
+        with self.database() as database:
+            og_url = database.same_lsh_sites(page, lsh_hash, site_url)
+        if og_url is not None:
+            # URL variants that keep turning out to be duplicates teach the canonicalizer
+            # which query parameters to ignore
+            self.canonicalizer.observe_duplicate(page.url, og_url)
+        return og_url
 
 
-    def insert_page_into_db(self, url, content_type, html_content, status_code, site_url, page_type="HTML"):
+    def insert_page_into_db(self, page, site_url, page_type="HTML"):
         """ Inserts page into the database.
 
         Parameters
         ----------
-        url: str
-
-        content_type: str
-            available content types are PDF, DOC, DOCX, PPT, PPTX
-            
-        html_content: str or None
-            if it is not html, this is None. If it is a duplicate also None.
-
-        status_code: int
-            200, other 200 codes
+        page: crawler.page.Page
+            Fetched page. Its HTML and LSH signature are only stored if `page_type` is HTML.
 
         site_url: str
             ROOT url of the website. This page is connected to site table with site_url value.
 
         page_type: str
             available page types are HTML, BINARY, DUPLICATE and FRONTIER
+
+        Returns
+        -------
+        int or None:
+            Id of the page
         """
 
-        root_site_id = self.db.root_site_id(site_url)
         if page_type == "HTML":
-            lsh_hash = "".join(map(str, self.lsh_obj.compute_signature(str(html_content))))
-            self.db.add_page(root_site_id, page_type, url, html_content, status_code, lsh_hash)
+            lsh_hash = page.lsh_hash(self.lsh_obj)
+            with self.database() as database:
+                return database.add_page(site_url, page_type, page.url, page.html, page.status_code,
+                                         lsh_hash, page.fingerprint)
 
         elif page_type == "BINARY":
-            self.db.add_page(root_site_id, page_type, url, None, status_code, None)
+            with self.database() as database:
+                return database.add_page(site_url, page_type, page.url, None, page.status_code, None)
+
+    def close(self):
+        """ Writes everything that is still queued for the database and closes the connections."""
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        for driver in self.drivers:
+            driver.quit()
+        for session in self.sessions:
+            session.close()
+        if self.analyzer is not None:
+            self.analyzer.shutdown()
+        if self.images is not None:
+            self.images.close()
+        if self.archive is not None:
+            self.archive.close()
+        try:
+            # raises if rows were lost because the database could not be written to
+            self.writer.close()
+        finally:
+            self.pool.closeall()
+            if self.profiler_timer is not None:
+                self.profiler_timer.cancel()
+            self.profiler.stop()
+            self.memory_monitor.stop()
+            self.metrics_stopped.set()
+            METRICS.report()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
 
     def crawl(self, max_level=2):
         """ Performs breadth-first search up to a certain level or while there are links to be
-        crawled (if `max_level` is None).
+        crawled (if `max_level` is None). Pages that failed are retried in later levels (see
+        `crawler.health.RetryQueue`), also after the last level.
 
         Parameters
         ----------
@@ -424,10 +692,14 @@ class Agent:
             # set the depth limit ridiculously high which essentially means 'no limit'
             max_level = 2 ** 31 - 1
 
-        while self.link_queue:
-            if curr_level == max_level:
-                print("Reached specified maximal level. Exiting...")
-                break
+        while self.link_queue or len(self.link_spill) or self.retry_queue:
+            if curr_level >= max_level:
+                if not self.retry_queue:
+                    print("Reached specified maximal level. Exiting...")
+                    break
+                # links of the next level are not crawled, but failed pages are still retried
+                self.link_queue = set()
+                self.link_spill.load(len(self.link_spill))
             print("[Level %d] Links to be crawled: %d..." %
                   (curr_level, len(self.link_queue)))
             self.crawl_level()
@@ -435,22 +707,173 @@ class Agent:
                   (curr_level, len(self.link_queue)))
             curr_level += 1
 
-    def crawl_level(self):
-        """ Performs a single level of breadth-first search."""
-        # get pages for the next level and clear the queue
-        relevant_links = list(self.link_queue)
+    def crawl_frontier(self, frontier, idle_timeout=60):
+        """ Crawls from a shared frontier (see `crawler.frontier.PostgresFrontier`) with
+        `num_workers` threads. Any number of agents (processes or machines) can crawl from
+        the same frontier at the same time. Seed pages are added to the frontier first.
+
+        Parameters
+        ----------
+        frontier: crawler.frontier.PostgresFrontier
+            Shared frontier
+
+        idle_timeout: float
+            Time (in seconds) after which a worker stops if there is nothing left to claim
+        """
+        frontier.add(self.link_queue, depth=0)
+        self.link_queue = set()
 
-        # if current level contains an amount of links that would bring us over maximum,
-        # only take a part of the links to be crawled in the next level
-        if self.visited_uniq_links + len(relevant_links) > Agent.MAX_CRAWLED_PAGES:
-            relevant_links = relevant_links[: (Agent.MAX_CRAWLED_PAGES - self.visited_uniq_links)]
+        workers = [threading.Thread(target=self.frontier_worker_task,
+                                    args=(frontier, idle_timeout, id_worker),
+                                    name="frontier-worker-{}".format(id_worker))
+                   for id_worker in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def frontier_worker_task(self, frontier, idle_timeout, id_worker=None):
+        """ Work done by a single worker (thread) when crawling from a shared frontier: claim a
+        host with a batch of its URLs, crawl them, add the found links to the frontier and
+        release the host for the duration of its crawl delay. Failed URLs stay in the frontier,
+        but nobody claims them before they are due (after their retry backoff, or once their
+        host's circuit closes, see `crawler.health`), until they run out of attempts."""
+        idle_since = time()
+        while self.visited_uniq_links < Agent.MAX_CRAWLED_PAGES:
+            host, entries = frontier.claim()
+            if host is None:
+                if time() - idle_since > idle_timeout:
+                    print("[frontier_worker_task] Worker with ID={} found nothing to crawl for {} "
+                          "seconds. Exiting...".format(id_worker, idle_timeout))
+                    return
+                sleep(self.sleep_period)
+                continue
+
+            print("[frontier_worker_task] Worker with ID={} claimed {} pages of '{}'...".format(
+                id_worker, len(entries), host))
+            crawled = []
+            retries = {}
+            lease_start = time()
+            for page_id, url, depth in entries:
+                new_urls = self.crawl_page(url=url)
+                frontier.add(new_urls, depth=depth + 1)
+                # the frontier keeps the URL (until it is due) instead of the retry queue
+                due = self.retry_queue.take(url)
+                if due is not None:
+                    retries[page_id] = due - time()
+                else:
+                    crawled.append(page_id)
+                    with self.visited_lock:
+                        self.visited_uniq_links += 1
+                # keep the lease of a slow host from running out while crawling it
+                if time() - lease_start > frontier.lease_seconds / 2:
+                    frontier.renew(host)
+                    lease_start = time()
+
+            if self.rate_controller is not None:
+                delay = self.rate_controller.delay(host)
+            else:
+                delay = self.robots_file[host].crawl_delay() if host in self.robots_file else self.sleep_period
+            delay = max(delay, self.breaker.blocked_until(host) - time())
+            frontier.complete(host, crawled, delay=delay, retries=retries)
+            idle_since = time()
 
-        num_links = len(relevant_links)
+    def crawl_level(self):
+        """ Performs a single level of breadth-first search. Links of the level that were
+        spilled to the disk (see `spill_links`) are crawled in further rounds of the level,
+        together with failed pages that are due to be retried."""
+        # get pages for the next level and clear the queue (links that were collected before
+        # their page was crawled in a further round of the previous level are not counted again)
+        relevant_links = [link for link in self.link_queue if link not in self.visited] or \
+            self.load_spilled_links()
         self.link_queue = set()
+        if not relevant_links and self.retry_queue:
+            # only failed pages are left
+            sleep(self.retry_queue.wait_time())
+        retried_links = self.due_retries()
+        next_level_links = set()
+
+        while relevant_links or retried_links:
+            # if current level contains an amount of links that would bring us over maximum,
+            # only take a part of the links to be crawled in the next level
+            if self.visited_uniq_links + len(relevant_links) > Agent.MAX_CRAWLED_PAGES:
+                relevant_links = relevant_links[: (Agent.MAX_CRAWLED_PAGES - self.visited_uniq_links)]
+
+            # retried pages were already counted
+            num_links = len(relevant_links)
+            relevant_links += retried_links
+
+            if self.pipeline is not None:
+                self.crawl_level_pipelined(relevant_links)
+            else:
+                self.crawl_level_threaded(relevant_links)
+
+            # Deduplicate obtained links by workers because multiple workers might have extracted
+            # the same link twice independently
+            while not self.thread_res_queue.empty():
+                curr_res = self.thread_res_queue.get()
+
+                for link in curr_res:
+                    if link not in next_level_links:
+                        next_level_links.add(link)
+                # only 'frontier_links' of them are kept in memory while they are collected
+                next_level_links = self.spill_links(next_level_links)
 
+            self.visited_uniq_links += num_links
+
+            self.visited.update(relevant_links)
+            if self.visited_uniq_links >= Agent.MAX_CRAWLED_PAGES:
+                break
+            relevant_links = self.load_spilled_links()
+            retried_links = self.due_retries()
+
+        self.link_queue = next_level_links
+        # the spilled links of the next level are crawled in its further rounds
+        self.link_spill, self.next_link_spill = self.next_link_spill, self.link_spill
+
+    def due_retries(self):
+        """ Takes the failed pages that are due to be crawled again out of the retry queue."""
+        urls = self.retry_queue.pop_due()
+        # failed pages were marked as visited in the round they failed in
+        self.visited.difference_update(urls)
+        return urls
+
+    def load_spilled_links(self):
+        """ Loads the next chunk of spilled links of the level (see `spill_links`), without the
+        ones that were crawled since they were spilled."""
+        while len(self.link_spill):
+            links = [link for link in dict.fromkeys(
+                self.link_spill.load(self.max_frontier_links or len(self.link_spill)))
+                if link not in self.visited]
+            if links:
+                return links
+        return []
+
+    def spill_links(self, links):
+        """ Moves the links of the next level above the 'frontier_links' limit (see
+        SettingsReader's 'memory' section) to the disk, from where `crawl_level` loads them in
+        chunks.
+
+        Returns
+        -------
+        set:
+            Links that stay in memory
+        """
+        if not self.max_frontier_links or len(links) <= self.max_frontier_links:
+            return links
+        # called for every collected batch of links, so the set is not copied
+        spilled = [links.pop() for _ in range(len(links) - self.max_frontier_links)]
+        self.next_link_spill.add(spilled)
+        print("[Agent] Spilled {} links of the frontier to the disk...".format(len(spilled)))
+        return links
+
+    def crawl_level_threaded(self, relevant_links):
+        """ Crawls the links of a level with `num_workers` threads, each crawling all pages of
+        the sites assigned to it (see `worker_task`)."""
         urls_by_base = {}
         for link in relevant_links:
-            link_base = urlparse(Links.remove_www(link)).netloc
+            # links in the queue are already canonical, so this is a cache hit
+            link_base = Links.canonicalize(link).host
             curr_base_urls = urls_by_base.get(link_base, [])
             curr_base_urls.append(link)
             # need to set again in case we stumbled upon a new base URL
@@ -466,7 +889,6 @@ class Agent:
             worker_urls[idx_base % effective_workers].extend(links)
 
         workers = []
-        next_level_links = set()
         print("[crawl_level] Creating {} workers...".format(effective_workers))
         # divide relevant links among workers (as evenly as possible)
         for id_worker in range(effective_workers):
@@ -481,19 +903,15 @@ class Agent:
         for id_worker in range(effective_workers):
             workers[id_worker].join()
 
-        # Deduplicate obtained links by workers because multiple workers might have extracted
-        # the same link twice independently
-        while not self.thread_res_queue.empty():
-            curr_res = self.thread_res_queue.get()
-
-            for link in curr_res:
-                if link not in next_level_links:
-                    next_level_links.add(link)
-
-        self.visited_uniq_links += num_links
-
-        self.visited.update(relevant_links)
-        self.link_queue = next_level_links
+    def crawl_level_pipelined(self, relevant_links):
+        """ Crawls the links of a level with the pipeline of crawl stages (see `create_pipeline`).
+        Adding links blocks while the fetch stage is full."""
+        if not self.pipeline.threads:
+            self.pipeline.start(report_interval=self.pipeline_report_interval)
+        for link in relevant_links:
+            self.pipeline.put(Page(link))
+        self.pipeline.join()
+        self.pipeline.report()
 
     def worker_task(self, urls, id_worker=None):
         """ Work to be done in a single worker (thread/process).
@@ -507,23 +925,29 @@ class Agent:
             Unique identifier for current worker
 
         """
-        self.db = db.Database(self.pool)
         idx_curr_page = 0
         produced_links = set()
-        for url in urls:
-            print("[worker_task] Worker with ID={} crawling '{}'... {} pages left "
-                  "for this thread".format(id_worker, url, len(urls) - idx_curr_page))
-            new_urls = self.crawl_page(url=url)
-            # Insert new data into the database
-            produced_links.update(new_urls)
-            sleep(self.sleep_period)
-            idx_curr_page += 1
+        try:
+            for url in urls:
+                print("[worker_task] Worker with ID={} crawling '{}'... {} pages left "
+                      "for this thread".format(id_worker, url, len(urls) - idx_curr_page))
+                new_urls = self.crawl_page(url=url)
+                # Insert new data into the database
+                produced_links.update(new_urls)
+                # with adaptive politeness, only requests to the same host are spaced out
+                if self.rate_controller is None:
+                    sleep(self.sleep_period)
+                idx_curr_page += 1
+        finally:
+            # a new thread is started for every round of a level
+            self.close_thread()
 
         self.thread_res_queue.put(produced_links)
 
     def crawl_page(self, url):
         """ Crawl a single web page denoted by `url`. The URL is expected to be preprocessed
-        (if needed) and VALID.
+        (if needed) and VALID. The page passes all stages of the crawl in this thread (see
+        `crawl_level_pipelined` for running the stages concurrently).
 
         Parameters
         ----------
@@ -535,21 +959,176 @@ class Agent:
         list
             Obtained links
         """
-        links = []
-        duplicate_page = False
-        # Parsing URL
-        parsed_url = urlparse(url)
-        # URL of the site. This is the base url, which possibly has robots.txt etc.
-        site_url = parsed_url.netloc
-        # Relative path
-        path_url = parsed_url.path
+        page = Page(url)
+        try:
+            for stage in (self.fetch_stage, self.render_stage, self.parse_stage, self.dedup_stage,
+                          self.persist_stage, self.download_stage):
+                if not stage(page):
+                    break
+        finally:
+            self.archive_page(page)
+            page.close()
+            if page.status_code is not None:
+                METRICS.observe("page", perf_counter() - page.created, host=page.site_url)
+        return page.new_links
+
+    def replay(self, paths):
+        """ Processes archived responses (see `crawler.warc`) again, without the network: sites
+        are added from the archive and pages pass the parse, dedup and persist stages (running
+        concurrently as configured in SettingsReader's 'pipeline' section). Rendered HTML is
+        taken from the archive as well (pages that were not rendered use the raw HTML). Files
+        and images are not saved again.
 
-        if url not in self.visited:
-            # Check if you can crawl this page in robots file.
-            if site_url in self.robots_file and not self.robots_file[site_url].can_fetch(path_url):
-                return links
+        Parameters
+        ----------
+        paths: list of str
+            Archives, in the order in which they were written (see `crawler.warc.archive_paths`)
+
+        Returns
+        -------
+        int:
+            Number of replayed pages
+        """
+        stages_config = SettingsReader.config["pipeline"]["stages"]
+        pipeline = Pipeline([Stage(name, function, workers=stages_config[name]["workers"],
+                                   queue_size=stages_config[name]["queue_size"])
+                             for name, function in [("parse", self.parse_stage),
+                                                    ("dedup", self.dedup_stage),
+                                                    ("persist", self.persist_stage)]],
+                            on_finish=Page.close)
+        pipeline.start(report_interval=self.pipeline_report_interval)
+        num_pages = 0
+        try:
+            for path in paths:
+                print("[replay] Replaying '{}'...".format(path))
+                for kind, record, content, rendered in read_pages(path):
+                    if kind == "metadata":
+                        # sites are added before their pages, as while crawling
+                        with self.database() as database:
+                            database.add_site_info_to_db(content["domain"], content["robots"],
+                                                         content["sitemap"])
+                        self.sites.add(content["domain"])
+                        continue
+
+                    url = record.headers["WARC-Target-URI"]
+                    if url in self.visited:
+                        continue
+                    self.visited.add(url)
+                    page = Page(url, status_code=content.status_code, headers=content.headers,
+                                raw=content.body, text=rendered,
+                                encoding=get_encoding_from_headers(content.headers))
+                    page.rendered = rendered
+                    # the render stage dropped pages with other status codes
+                    if "text/html" in page.headers.get("Content-Type", "text/html") and \
+                            page.status_code not in [200, 203, 302]:
+                        continue
+                    pipeline.put(page)
+                    num_pages += 1
+        finally:
+            pipeline.stop()
+            pipeline.report()
+        return num_pages
+
+    def register_site(self, page):
+        """ Gets robots.txt and sitemap of the page's site and inserts the site into the database
+        (only for the first page of every site).
 
-            if site_url in self.last_crawled:
+        Returns
+        -------
+        bool:
+            False if robots.txt of the site could not be read because of a server error (the
+            site is registered with a later page)
+        """
+        site_url = page.site_url
+        if site_url in self.sites:
+            return True
+        # pages of a new site are fetched concurrently, but only the first one registers it
+        with self.site_locks.setdefault(site_url, threading.Lock()):
+            if site_url in self.sites:
+                return True
+            return self._register_site(page)
+
+    def _register_site(self, page):
+        parsed_url = page.parsed_url
+        site_url = parsed_url.netloc
+        robots = None
+        sitemap = None
+        try:
+            print(site_url)
+            robots = rb.Robots(parsed_url.scheme + '://' + site_url)
+            if robots.unavailable():
+                print("[crawl_page] Robots for '{}' are unavailable...".format(page.url))
+                return False
+            self.robots_file[site_url] = robots
+            if self.rate_controller is not None:
+                self.rate_controller.set_robots_delay(site_url, robots.explicit_delay())
+            print("[crawl_page] Found robots for '{}'...".format(page.url))
+        except:
+            print("[crawl_page] No robots file found for '{}'...".format(page.url))
+            # Robots failed.
+        try:
+            sitemap = sm.Sitemap(robots.sitemap_location)
+            # Add entire sitemap to 'links' array
+            self.add_sitemap_links(page, sitemap)
+            print("[crawl_page] Found sitemap for '{}'...".format(page.url))
+        except:
+            # Sitemap from robots failed.
+            try:
+                print("[crawl_page] Robots for '{}' didn't contain sitemap url. Trying "
+                      "default one ...".format(page.url))
+                sitemap = sm.Sitemap(
+                    parsed_url.scheme + '://' + site_url + '/sitemap.xml')
+                # Add entire sitemap to 'links' array
+                self.add_sitemap_links(page, sitemap)
+                print("[crawl_page] Found sitemap at default location for '{}'...".format(
+                    page.url))
+            except Exception as e:
+                print("[crawl_page] No sitemap found ANYWHERE for '{}'...".format(page.url))
+                # Sitemap failed.
+
+        # robots.txt and the sitemap were requests to the site too
+        self.last_crawled[site_url] = time()
+        # Insert this new Site into the DB
+        with self.database() as database:
+            database.add_site_info_to_db(site_url, str(robots), str(sitemap))
+        if self.archive is not None:
+            self.archive.write_metadata(parsed_url.scheme + '://' + site_url + '/',
+                                        {"domain": site_url, "robots": str(robots),
+                                         "sitemap": str(sitemap)})
+        # Add the new site into the set.
+        self.sites.add(site_url)
+        print("[crawl_page] New root website added: {}".format(site_url))
+        return True
+
+    def add_sitemap_links(self, page, sitemap):
+        """ Adds the links of a site's sitemap to the links found on the page (unless the
+        expansion of sitemaps is paused, see `pause_sitemaps`)."""
+        if not self.expand_sitemaps:
+            print("[crawl_page] Memory is over its soft limit, skipping {} sitemap links...".format(
+                len(sitemap.urls)))
+            return
+        page.new_links.extend(self.scope.filter(self.canonicalizer.apply_all(sitemap.urls)))
+
+    def page_failed(self, page, site_url, reason):
+        """ Records a transient failure of the site and schedules the page to be crawled again.
+        While the site's circuit is open, the page is parked instead of retried: the site is
+        down, which says nothing about the page, so it does not use up the page's attempts."""
+        if self.breaker.failure(site_url):
+            self.retry_queue.park(page.url, self.breaker.blocked_until(site_url))
+        else:
+            self.retry_queue.retry(page.url, reason)
+
+    @contextmanager
+    def site_turn(self, site_url):
+        """ Waits for the site's crawl delay and holds the site's lock while the caller requests
+        from the site, so concurrent fetchers and renderers make one request at a time per site
+        and keep the crawl delay."""
+        with self.site_locks.setdefault(site_url, threading.Lock()):
+            if self.rate_controller is not None:
+                cooldown = self.rate_controller.wait_time(site_url, self.last_crawled.get(site_url))
+                if cooldown > 0:
+                    sleep(cooldown)
+            elif site_url in self.last_crawled:
                 cooldown = self.sleep_period  # default
                 if site_url in self.robots_file:
                     cooldown = self.robots_file[site_url].crawl_delay()
@@ -558,130 +1137,226 @@ class Agent:
                     sleep(cooldown-cooldown_so_far)
                     print("[crawl_page] Waited %f second before crawling website..." %
                           (cooldown - cooldown_so_far))
+            self.last_crawled[site_url] = time()
+            yield
+
+    def fetch_stage(self, page):
+        """ Checks robots.txt, waits for the site's crawl delay and fetches the page."""
+        if page.url in self.visited:
+            return False
+
+        # URL of the site. This is the base url, which possibly has robots.txt etc.
+        site_url = page.site_url
+        if not self.breaker.allow(site_url):
+            # the site keeps failing, so its pages wait for it instead of the workers
+            self.retry_queue.park(page.url, self.breaker.blocked_until(site_url))
+            return False
+        if not self.register_site(page):
+            self.page_failed(page, site_url, "robots")
+            return False
+
+        # Check if you can crawl this page in robots file.
+        if site_url in self.robots_file and \
+                not self.robots_file[site_url].can_fetch(page.parsed_url.path):
+            return False
+
+        with self.site_turn(site_url):
+            start = perf_counter()
             try:
-                response = requests.get(url, headers={"User-Agent": Agent.USER_AGENT},
-                                        timeout=TIMEOUT_PERIOD)
+                with METRICS.timer("fetch", host=site_url) as labels:
+                    # the body of binary content is only read by the download stage (if at all)
+                    response = self.session.get(page.url, timeout=TIMEOUT_PERIOD, stream=True)
+                    labels["status"] = response.status_code
+                    # if Content-Type is not present in header (is this even possible?), assume it's HTML
+                    content_type = response.headers.get("Content-Type", "text/html")
+                    if "text/html" in content_type:
+                        page.raw = response.content
             except Exception as e:
                 print("[crawl_page] Requests error - ", e)
-                return links
-
-
-            # if Content-Type is not present in header (is this even possible?), assume it's HTML
-            content_type = response.headers.get("Content-Type")
-
-            # Selenium
-            print("[crawl_page] Passed duplicate checks, crawling '%s'..." % url)
-            if "text/html" in content_type:
-                try:
-                    start = time()
-                    self.driver.get(url)
-                    page_source = self.driver.page_source
-                    self.last_crawled[site_url] = start
-                    end = time()
-                    print("[crawl_page] Request time: ", round(end - start, 2), " seconds...")
-                except TimeoutException:
-                    print("[crawl_page] Timeout for request to '{}' reached...".format(url))
-                    return links
-                except Exception as e:
-                    # Exception for everything else: bad handshakes, various errors
-                    print("[crawl_page] Unexpected error for '{}'...{}".format(url, e))
-                    return links
-
-                print("[crawl_page] Response code for request to '{}': {}".format(
-                    url, response.status_code))
-
-                if not response or response.status_code not in [200, 203, 302]:
-                    return links
-
-
-            if site_url not in self.sites:
-                robots = None
-                sitemap = None
-                try:
-                    print(site_url)
-                    robots = rb.Robots(parsed_url.scheme + '://' + site_url)
-                    print("[crawl_page] Found robots for '{}'...".format(url))
-                except:
-                    print("[crawl_page] No robots file found for '{}'...".format(url))
-                    # Robots failed.
-                try:
-                    sitemap = sm.Sitemap(robots.sitemap_location)
-                    # Add entire sitemap to 'links' array
-                    links.extend(sitemap.urls)
-                    print("[crawl_page] Found sitemap for '{}'...".format(url))
-                except:
-                    # Sitemap from robots failed.
-                    try:
-                        print("[crawl_page] Robots for '{}' didn't contain sitemap url. Trying "
-                              "default one ...".format(url))
-                        sitemap = sm.Sitemap(
-                            parsed_url.scheme + '://' + site_url + '/sitemap.xml')
-                        # Add entire sitemap to 'links' array
-                        links.extend(sitemap.urls)
-                        print("[crawl_page] Found sitemap at default location for '{}'...".format(
-                            url))
-                    except Exception as e:
-                        print("[crawl_page] No sitemap found ANYWHERE for '{}'...".format(url))
-                        # Sitemap failed.
-
-                # Insert this new Site into the DB
-                self.db.add_site_info_to_db(
-                    site_url, str(robots), str(sitemap))
-                # Add the new site into the set.
-                self.sites.add(site_url)
-                print("[crawl_page] New root website added: {}".format(site_url))
-
-            # https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types/Complete_list_of_MIME_types
-            # possible to have {"Content-Type": "text/html; charset=utf-8"}
-            if "text/html" in content_type:
-                soup = BeautifulSoup(page_source, "lxml")
-
-                # Check if there is a base href url from which we have to assemble file paths
-                base_url = get_base_href(soup, fallback=url)
-                
-
-                # LSH comparison and duplicate sites detection.
-                lsh_hash = "".join(map(str, self.lsh_obj.compute_signature(str(soup))))
-                if self.simillar_lsh_hash(lsh_hash, str(soup), site_url, response.status_code):
-                    duplicate_page = True
-                    return links
-        
-
-
-                # Insert page into the database
-                if not duplicate_page:
-                    self.insert_page_into_db(url, "HTML", str(
-                        soup), response.status_code, site_url, "HTML")
-
-                # find images on the current site. Save to FS and DB
-                if self.get_files:
-                    find_images(base_url, soup, self.db, url)
-
-                # find links on current site
-                found_links = find_links(url, soup)
-
-                # TODO: only keep links that point to '.gov.si' websites
-                # CURRENT: only keep links that point to evem.gov.si and e-prostor.gov.si
-                found_links = [
-                    l for l in found_links if "evem.gov.si" in l or "e-prostor.gov.si" in l]
-
-                # Extend to links. There might be some from sitemap.
-                links.extend(found_links)
-
-            # Check if content is downloadable AND we are downloading files
-            elif content_type in DOWNLOADABLE_CONTENT_TYPES.keys() and self.get_files:
-                file_extension = DOWNLOADABLE_CONTENT_TYPES[content_type]
-
-                # Insert page into the database. Html_content is NULL
-                self.insert_page_into_db(
-                    url, file_extension, None, response.status_code, site_url, "BINARY")
-                if self.get_files:
-                    save_file(site_url, url, file_extension, self.db, url)
-
-        return links
+                METRICS.count("pages", host=site_url, status="error")
+                # a host that does not answer (in time) is probably overloaded or down
+                transient = isinstance(e, (requests.Timeout, requests.ConnectionError))
+                if self.rate_controller is not None:
+                    self.rate_controller.feedback(site_url, latency=perf_counter() - start,
+                                                  timeout=transient)
+                if transient:
+                    self.page_failed(page, site_url, type(e).__name__)
+                return False
+            if self.rate_controller is not None:
+                self.rate_controller.feedback(site_url, response.status_code, perf_counter() - start,
+                                              retry_after=response.headers.get("Retry-After"))
+
+        METRICS.count("pages", host=site_url, status=response.status_code)
+        if response.status_code in RETRY_STATUS_CODES:
+            # the error is (hopefully) temporary, so the page is not stored yet
+            response.close()
+            self.page_failed(page, site_url, str(response.status_code))
+            return False
+        self.breaker.success(site_url)
+        self.retry_queue.forget(page.url)
+        if page.raw is not None:
+            METRICS.count("fetched_bytes", len(page.raw), host=site_url)
+
+        page.status_code = response.status_code
+        page.headers = response.headers
+        page.encoding = response.encoding
+        if "text/html" in content_type:
+            response.close()
+        elif content_type in DOWNLOADABLE_CONTENT_TYPES.keys() and self.get_files:
+            # streamed to the disk in the download stage, so the file is only downloaded once
+            page.response = response
+        else:
+            # not needed, so the body is never downloaded
+            response.close()
+        return True
+
+    def render_stage(self, page):
+        """ Renders HTML pages with the (thread's) webdriver."""
+        # if Content-Type is not present in header (is this even possible?), assume it's HTML
+        if "text/html" not in page.headers.get("Content-Type", "text/html"):
+            return True
+
+        print("[crawl_page] Passed duplicate checks, crawling '%s'..." % page.url)
+        site_url = page.site_url
+        # started before waiting for the site, as starting a browser takes a while
+        driver = self.driver
+        # the browser requests the page again, so it waits for its turn like the fetch did
+        with self.site_turn(site_url):
+            start = time()
+            try:
+                driver.get(page.url)
+                # the rendered DOM replaces the raw response as the page's content
+                page.text = page.rendered = driver.page_source
+                end = time()
+                METRICS.observe("render", end - start, host=site_url, status="ok")
+                print("[crawl_page] Request time: ", round(end - start, 2), " seconds...")
+            except TimeoutException:
+                METRICS.observe("render", time() - start, host=site_url, status="timeout")
+                if self.rate_controller is not None:
+                    self.rate_controller.feedback(site_url, timeout=True)
+                print("[crawl_page] Timeout for request to '{}' reached...".format(page.url))
+                self.page_failed(page, site_url, "render_timeout")
+                return False
+            except Exception as e:
+                # Exception for everything else: bad handshakes, various errors
+                METRICS.observe("render", time() - start, host=site_url, status="error")
+                print("[crawl_page] Unexpected error for '{}'...{}".format(page.url, e))
+                return False
+
+        print("[crawl_page] Response code for request to '{}': {}".format(
+            page.url, page.status_code))
+
+        return page.status_code in [200, 203, 302]
+
+    def parse_stage(self, page):
+        """ Extracts links, images and the LSH signature of HTML pages (or starts extracting them
+        in a worker process of the analyzer, see `dedup_stage`)."""
+        if "text/html" not in page.headers.get("Content-Type", "text/html"):
+            return True
+
+        # links, LSH signature and fingerprint are computed by a worker process if
+        # there is an analyzer (otherwise in this thread)
+        site_url = page.site_url
+        if self.analyzer is not None:
+            # the worker process analyzes the page while this thread goes on with the next one;
+            # the dedup stage waits for the results
+            if self.analyzer.start(page):
+                return True
+        # base href, links and images in a single pass over the page
+        with METRICS.timer("parse", host=site_url):
+            page.extracted
+        with METRICS.timer("lsh", host=site_url):
+            page.lsh_hash(self.lsh_obj)
+        return True
+
+    def dedup_stage(self, page):
+        """ Drops HTML pages that are duplicates of already crawled pages (after storing the
+        analysis of the page into it, if it was started by `parse_stage`)."""
+        if "text/html" not in page.headers.get("Content-Type", "text/html"):
+            return True
+
+        site_url = page.site_url
+        if page.analysis is not None:
+            # parse includes the LSH signature here (the time this thread waits for it)
+            with METRICS.timer("parse", host=site_url, status="analyzer") as labels:
+                if not self.analyzer.finish(page):
+                    # the page computes everything itself
+                    labels["status"] = "skipped"
+
+        # LSH comparison and duplicate sites detection.
+        with METRICS.timer("dedup", host=site_url) as labels:
+            unique = self.simillar_lsh_hash(page, site_url) is None
+            labels["status"] = "unique" if unique else "duplicate"
+        return unique
+
+    def persist_stage(self, page):
+        """ Inserts the page and its links into the database."""
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types/Complete_list_of_MIME_types
+        # possible to have {"Content-Type": "text/html; charset=utf-8"}
+        content_type = page.headers.get("Content-Type", "text/html")
+        site_url = page.site_url
+        if "text/html" in content_type:
+            # Insert page into the database
+            self.insert_page_into_db(page, site_url, "HTML")
+
+            # links on current site, with equivalent URLs collapsed and only the ones in scope
+            found_links = self.scope.filter(self.canonicalizer.apply_all(page.extracted.links))
+
+            # record the edges of the link graph (targets that were not crawled yet become
+            # FRONTIER pages)
+            with self.database() as database:
+                database.add_links(page.url, Links.canonicalize_all(found_links))
+
+            # Extend to links. There might be some from sitemap.
+            page.new_links.extend(found_links)
+            return self.get_files and bool(page.extracted.images)
+
+        # Check if content is downloadable AND we are downloading files
+        elif content_type in DOWNLOADABLE_CONTENT_TYPES.keys() and self.get_files:
+            # Insert page into the database. Html_content is NULL
+            self.insert_page_into_db(page, site_url, "BINARY")
+            return True
+
+        return False
+
+    def download_stage(self, page):
+        """ Saves images of HTML pages and downloadable files to the disk and the database."""
+        if not self.get_files:
+            return False
+
+        content_type = page.headers.get("Content-Type", "text/html")
+        if "text/html" in content_type:
+            # images of the page are saved to FS and DB in the background
+            self.images.submit(page.url, page.extracted.images, base_url=page.extracted.base_href)
+        elif content_type in DOWNLOADABLE_CONTENT_TYPES.keys():
+            # the file is recorded after it is downloaded, so no connection is held meanwhile
+            page.blob = save_file(page.url, DOWNLOADABLE_CONTENT_TYPES[content_type], None,
+                                  page.url, response=page.response)
+            page.response = None
+            if page.blob is not None:
+                with self.database() as database:
+                    database.insert_file_into_db(page.url, DOWNLOADABLE_CONTENT_TYPES[content_type],
+                                                 page.blob.sha256, page.blob.size)
+        return False
 
 
 if __name__ == "__main__":
+    # With --replay DIRECTORY, the archives in the directory are processed again (no requests
+    # are made and no browser is needed; see SettingsReader's 'archive' section)
+    if "--replay" in sys.argv[1:]:
+        directory = sys.argv[sys.argv.index("--replay") + 1]
+        SettingsReader.config["archive"]["enabled"] = False
+        a = Agent(seed_pages=[], num_workers=20, get_files=True)
+        with db.Database(a.pool) as temp_db:
+            temp_db.truncate_everything()
+        replay_start = time()
+        try:
+            num_pages = a.replay(archive_paths(directory))
+        finally:
+            a.close()
+        print("Replayed {} pages in {} seconds...".format(num_pages, time() - replay_start))
+        sys.exit(0)
+
     # Check if environment variable is set
     try:
         print()
@@ -704,21 +1379,56 @@ if __name__ == "__main__":
                       "http://www.up.gov.si/", "http://www.ti.gov.si/", "http://www.mf.gov.si/"]
     SEED_PAGES_SAMPLE = SEED_PAGES_ALL[:3]
 
+    # With --shared-frontier, the agent crawls from the frontier in the database together with
+    # any other agents started the same way (on this or other machines)
+    shared_frontier = "--shared-frontier" in sys.argv[1:]
+
+    # With --processes N, hosts are split among N processes, each running its own agent
+    if "--processes" in sys.argv[1:]:
+        num_processes = int(sys.argv[sys.argv.index("--processes") + 1])
+        truncate_pool = db.Pool(max_connections=1)
+        with db.Database(truncate_pool) as temp_db:
+            temp_db.truncate_everything()
+        truncate_pool.closeall()
+
+        partition_config = SettingsReader.config["partition"]
+        coordinator = Coordinator(SEED_PAGES_THAT_REQUIRE_DOWNLOADS, num_processes,
+                                  agent_options={"num_workers": 20, "get_files": True},
+                                  batch_size=partition_config["batch_size"],
+                                  replicas=partition_config["replicas"])
+        crawl_start = time()
+        try:
+            coordinator.run()
+        except KeyboardInterrupt:
+            pass
+        print("Visited {} links in {} seconds...".format(coordinator.num_crawled,
+                                                         time() - crawl_start))
+        sys.exit(0)
+
     a = Agent(seed_pages=SEED_PAGES_THAT_REQUIRE_DOWNLOADS,
               num_workers=20, get_files=True)
     # TODO: On specific key press, stop the script and save current state
 
-    # Truncates every table except data_type, page_type --- they have fixed types in them
-    # WARNING: disable this when you want to start from a saved state
-    temp_db = db.Database(a.pool)
-    temp_db.truncate_everything()
-    temp_db.pool.pool.putconn(temp_db.connection)
+    if not shared_frontier:
+        # Truncates every table except data_type, page_type --- they have fixed types in them
+        # WARNING: disable this when you want to start from a saved state
+        with db.Database(a.pool) as temp_db:
+            temp_db.truncate_everything()
 
     crawl_start = time()
     try:
-        a.crawl(max_level=None)
+        if shared_frontier:
+            frontier_config = SettingsReader.config["frontier"]
+            a.crawl_frontier(PostgresFrontier(a.pool,
+                                              lease_seconds=frontier_config["lease_seconds"],
+                                              batch_size=frontier_config["batch_size"]),
+                             idle_timeout=frontier_config["idle_timeout"])
+        else:
+            a.crawl(max_level=None)
     except KeyboardInterrupt:
         pass
+    finally:
+        a.close()
     crawl_end = time()
 
     print("Visited {} links in {} seconds...".format(a.visited_uniq_links, crawl_end - crawl_start))
@@ -1,7 +1,493 @@
 import psycopg2
 from psycopg2 import pool
+from psycopg2.extras import execute_values
+from collections import OrderedDict
 from datetime import datetime
+from io import StringIO
+from queue import Queue, Empty, Full
+from time import sleep, time
+from contextlib import contextmanager
+import atexit
 import difflib
+import hashlib
+import threading
+import zlib
+
+from crawler.metrics import METRICS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Multi-row INSERT statements for the rows that the crawler writes in bulk (children of
+pages, which reference them by id), used with psycopg2's `execute_values`:
+(statement, template of a single row).
+"""
+INSERT_STATEMENTS = {
+    "page_data": ("INSERT INTO page_data (page_id, data_type_code, content_hash, size) VALUES %s",
+                  "(%s, %s, %s, %s)"),
+    "image": ("""INSERT INTO image (page_id, filename, content_type, content_hash, size, accessed_time)
+                 VALUES %s""",
+              "(%s, %s, %s, %s, %s, %s)"),
+    "link": ("INSERT INTO link (from_page, to_page) VALUES %s ON CONFLICT DO NOTHING",
+             "(%s, %s)"),
+    # image rows that reference their page by URL (for writers without a database session)
+    "image_by_url": ("""INSERT INTO image (page_id, filename, content_type, content_hash, size,
+                                           accessed_time)
+                        SELECT p.id, v.filename, v.content_type, v.content_hash, v.size, v.accessed_time
+                        FROM (VALUES %s) AS v (page_url, filename, content_type, content_hash, size,
+                                               accessed_time)
+                        JOIN page p ON p.url = v.page_url""",
+                     "(%s, %s, %s, %s, %s::bigint, %s::timestamp)")
+}
+
+"""
+Edges of the link graph are copied (COPY) into a temporary staging table and moved into
+`page` (FRONTIER rows for targets that have not been crawled yet) and `link` from there.
+"""
+EDGE_STAGING_TABLE = """CREATE TEMPORARY TABLE IF NOT EXISTS edge_staging (
+                            from_url varchar(3000), to_url varchar(3000), to_domain varchar(500)
+                        ) ON COMMIT DELETE ROWS"""
+EDGE_FRONTIER_PAGES = """INSERT INTO page (site_id, page_type_code, url)
+                         SELECT (SELECT s.id FROM site s WHERE s.domain = e.to_domain ORDER BY s.id LIMIT 1),
+                                'FRONTIER', e.to_url
+                         FROM (SELECT DISTINCT to_url, to_domain FROM edge_staging) AS e
+                         ON CONFLICT (url) DO NOTHING"""
+EDGE_LINKS = """INSERT INTO link (from_page, to_page)
+                SELECT DISTINCT f.id, t.id
+                FROM edge_staging e
+                JOIN page f ON f.url = e.from_url
+                JOIN page t ON t.url = e.to_url
+                ON CONFLICT DO NOTHING"""
+
+# maximum number of cached url -> page id and domain -> site id mappings
+PAGE_ID_CACHE_SIZE = 2 ** 17
+SITE_ID_CACHE_SIZE = 2 ** 12
+# maximum number of remembered hashes of HTML that is already in html_store
+HTML_HASH_CACHE_SIZE = 2 ** 16
+
+"""
+Ways of storing the HTML of pages ('html_storage' in the 'database' section of the settings):
+- inline: uncompressed, in page.html_content (one copy per page),
+- none: uncompressed, in html_store (one copy per distinct HTML, referenced by page.html_hash),
+- zlib, zstd: like none, but compressed by the crawler (zstd needs the zstandard package).
+The page_html view shows the HTML of every page as html_content, except for compressed HTML,
+which Postgres cannot decompress; it is left to the client (see `decode_html`). So inline is
+the default, and compression is for crawls whose HTML is only read through the crawler.
+"""
+HTML_STORAGE_MODES = ("inline", "none", "zlib", "zstd")
+HTML_COMPRESSION_LEVELS = {"zlib": 6, "zstd": 10}
+
+
+def html_hash(html):
+    """ SHA-256 hex digest of the HTML (the key of its row in html_store)."""
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+
+def html_similarity(lowered, other_html):
+    """ Similarity (difflib ratio, 0 to 1) of lowercased HTML and another page's HTML."""
+    return difflib.SequenceMatcher(a=lowered, b=other_html.lower()).ratio()
+
+
+def encode_html(html, compression):
+    """ Encodes HTML for html_store.
+
+    Parameters
+    ----------
+    html: str
+
+    compression: str
+        'none', 'zlib' or 'zstd'
+
+    Returns
+    -------
+    bytes
+    """
+    data = html.encode("utf-8")
+    if compression == "zlib":
+        return zlib.compress(data, HTML_COMPRESSION_LEVELS["zlib"])
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=HTML_COMPRESSION_LEVELS["zstd"]).compress(data)
+    return data
+
+
+def decode_html(compression, content):
+    """ Decodes HTML from html_store (the inverse of `encode_html`).
+
+    Parameters
+    ----------
+    compression: str
+        Compression of the row ('none', 'zlib' or 'zstd')
+
+    content: bytes or memoryview
+        Content of the row
+
+    Returns
+    -------
+    str
+    """
+    if compression == "zlib":
+        data = zlib.decompress(content)
+    elif compression == "zstd":
+        data = zstandard.ZstdDecompressor().decompress(bytes(content))
+    else:
+        data = bytes(content)
+    return data.decode("utf-8")
+
+
+class IdCache:
+    """
+    Bounded (least recently used entries get evicted) thread-safe cache of ids of database
+    rows, e.g. url -> page id. Shared by all the `Database` objects of a `Pool`.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            row_id = self.ids.get(key)
+            if row_id is not None:
+                self.ids.move_to_end(key)
+            return row_id
+
+    def put(self, key, row_id):
+        if row_id is None:
+            return
+        with self.lock:
+            self.ids[key] = row_id
+            self.ids.move_to_end(key)
+            if len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+
+
+def write_rows(connection, table, rows, page_size=1000):
+    """ Writes rows into a table with multi-row INSERT statements (see `INSERT_STATEMENTS`) and
+    commits them in a single transaction. If the batch fails, rows are retried one by one so
+    that a single bad row does not lose the whole batch.
+
+    Returns
+    -------
+    int:
+        Number of rows that could not be written
+    """
+    statement, template = INSERT_STATEMENTS[table]
+    cursor = connection.cursor()
+    try:
+        execute_values(cursor, statement, rows, template=template, page_size=page_size)
+        connection.commit()
+        return 0
+    except Exception as e:
+        connection.rollback()
+        if len(rows) == 1:
+            print("Failed to insert a row into ", table)
+            print("Issue ", e)
+            return 1
+    finally:
+        cursor.close()
+
+    return sum(write_rows(connection, table, [row]) for row in rows)
+
+
+def copy_escape(value):
+    """ Escapes a value for COPY's text format."""
+    if value is None:
+        return "\\N"
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def write_edges(connection, edges):
+    """ Writes edges of the link graph (from_url, to_url, to_domain) with COPY. Targets that are
+    not in the `page` table yet get a FRONTIER row. Edges whose source page is not in the
+    database (e.g. duplicates) are skipped and repeated edges are only written once. If the
+    batch fails, edges are retried one by one (like in `write_rows`) so that a single bad edge
+    (e.g. a URL that is too long) does not lose the whole batch.
+
+    Returns
+    -------
+    int:
+        Number of edges that could not be written
+    """
+    # deduplicate edges of the batch in memory before sending them to the database
+    edges = list(dict.fromkeys(edges))
+    data = StringIO("".join("\t".join(map(copy_escape, edge)) + "\n" for edge in edges))
+    cursor = connection.cursor()
+    try:
+        cursor.execute(EDGE_STAGING_TABLE)
+        cursor.copy_expert("COPY edge_staging (from_url, to_url, to_domain) FROM STDIN", data)
+        cursor.execute(EDGE_FRONTIER_PAGES)
+        cursor.execute(EDGE_LINKS)
+        connection.commit()
+        return 0
+    except Exception as e:
+        connection.rollback()
+        if len(edges) == 1:
+            print("Failed to write an edge ", edges[0])
+            print("Issue ", e)
+            return 1
+    finally:
+        cursor.close()
+
+    return sum(write_edges(connection, [edge]) for edge in edges)
+
+
+class WriterFailed(Exception):
+    pass
+
+
+class BulkWriter:
+    """
+    Batched database writer. Rows are queued per table and written by a background thread
+    with multi-row INSERT statements (one commit per batch instead of one per row).
+
+    A batch is written when `batch_size` rows are queued or `flush_interval` seconds have
+    passed since the last write, whichever comes first. At most `max_pending` rows can be
+    queued: `add` blocks when the queue is full (backpressure), so the crawler can never
+    outrun the database indefinitely. Everything that was queued gets written on `close`,
+    which is also called when the interpreter exits.
+
+    If a batch cannot be written (e.g. the server closed the connection), the writer takes a
+    new connection from the pool and tries again, waiting longer after every failure. After
+    `max_failures` failures in a row it gives up: the rows are lost and `add`, `flush` and
+    `close` raise `WriterFailed` (instead of blocking forever on a writer that is gone).
+
+    Tables are written in the order of `INSERT_STATEMENTS`, followed by the edges of the link
+    graph ('edge', see `write_edges`). Pages and sites are not written through the writer,
+    because their ids are needed right away.
+    """
+
+    # marker that asks the writer thread to write everything queued so far
+    _FLUSH = "__flush__"
+    # marker that stops the writer thread
+    _STOP = "__stop__"
+    # longest wait (in seconds) before writing a failed batch again
+    MAX_RETRY_DELAY = 30.0
+
+    def __init__(self, pool, batch_size=500, flush_interval=1.0, max_pending=10000, max_failures=5):
+        """
+        Parameters
+        ----------
+        pool: Pool
+            Connection pool from which the writer takes its (single) connection
+
+        batch_size: int
+            Number of queued rows that triggers a write
+
+        flush_interval: float
+            Maximum time (in seconds) that a row waits in the queue
+
+        max_pending: int
+            Maximum number of queued rows
+
+        max_failures: int
+            Number of failed writes in a row after which the writer gives up
+        """
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_failures = max_failures
+        self.queue = Queue(maxsize=max_pending)
+        self.num_written = 0
+        self.num_failed = 0
+        self.closed = False
+        # number of failed writes in a row
+        self.failures = 0
+        # error that made the writer give up
+        self.error = None
+
+        self.connection = self.pool.getconn()
+
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, table, row):
+        """ Queues a row for `table` (see `INSERT_STATEMENTS`). Blocks if the queue is full."""
+        if table not in INSERT_STATEMENTS and table != "edge":
+            raise ValueError("Unknown table '{}'".format(table))
+        self._put((table, row))
+
+    def _put(self, item):
+        # waits for room in the queue for as long as the writer is alive
+        while True:
+            if self.error is not None:
+                raise WriterFailed("The database writer gave up ({})".format(self.error)) from self.error
+            try:
+                self.queue.put(item, timeout=self.flush_interval)
+                return
+            except Full:
+                pass
+
+    def flush(self):
+        """ Blocks until all the rows queued before this call are written."""
+        if self.closed:
+            return
+        done = threading.Event()
+        self._put((BulkWriter._FLUSH, done))
+        while not done.wait(self.flush_interval):
+            if self.error is not None:
+                raise WriterFailed("The database writer gave up ({})".format(self.error)) from self.error
+
+    def close(self):
+        """ Writes all the queued rows and stops the writer."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._put((BulkWriter._STOP, None))
+        except WriterFailed:
+            pass
+        self.thread.join()
+        self.release_connection()
+        # rows that were queued after the writer gave up
+        while True:
+            try:
+                table, _ = self.queue.get_nowait()
+            except Empty:
+                break
+            if table not in (BulkWriter._FLUSH, BulkWriter._STOP):
+                self.num_failed += 1
+        print("[BulkWriter] Wrote {} rows ({} failed)...".format(self.num_written, self.num_failed))
+        if self.error is not None:
+            raise WriterFailed("The database writer gave up ({})".format(self.error)) from self.error
+
+    def release_connection(self):
+        if self.connection is not None:
+            if self.failures > 0:
+                # the connection could be broken, do not hand it out again
+                self.connection.close()
+            self.pool.putconn(self.connection)
+            self.connection = None
+
+    def write(self, pending):
+        """ Writes the pending rows. Tables are removed from `pending` once they are written, so
+        only the ones that were not are left if this raises an exception."""
+        if self.connection is None:
+            self.connection = self.pool.getconn()
+        for table in INSERT_STATEMENTS:
+            rows = pending.get(table)
+            if rows:
+                with METRICS.timer("db_write", table=table):
+                    num_failed = write_rows(self.connection, table, rows)
+                del pending[table]
+                METRICS.count("db_rows", len(rows), table=table)
+                self.num_failed += num_failed
+                self.num_written += len(rows) - num_failed
+        edges = pending.get("edge")
+        if edges:
+            with METRICS.timer("db_write", table="edge"):
+                num_failed = write_edges(self.connection, edges)
+            del pending["edge"]
+            METRICS.count("db_rows", len(edges), table="edge")
+            self.num_failed += num_failed
+            self.num_written += len(edges) - num_failed
+
+    def try_write(self, pending):
+        """ Writes the pending rows, handling failures (see the class docstring).
+
+        Returns
+        -------
+        bool:
+            False if the writer gave up
+        """
+        try:
+            self.write(pending)
+            self.failures = 0
+            return True
+        except Exception as e:
+            self.failures += 1
+            self.release_connection()
+            num_rows = sum(len(rows) for rows in pending.values())
+            METRICS.count("db_write_failures")
+            if self.failures >= self.max_failures:
+                self.num_failed += num_rows
+                pending.clear()
+                self.error = e
+                print("[BulkWriter] Giving up after {} failed writes, {} rows are lost ({})...".format(
+                    self.failures, num_rows, e))
+                return False
+            delay = min(BulkWriter.MAX_RETRY_DELAY, self.flush_interval * 2 ** (self.failures - 1))
+            print("[BulkWriter] Failed to write {} rows, retrying in {:.1f} seconds ({})...".format(
+                num_rows, delay, e))
+            sleep(delay)
+            return True
+
+    def run(self):
+        pending = {}
+        num_pending = 0
+        last_write = time()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time() - last_write))
+            try:
+                table, row = self.queue.get(timeout=timeout)
+            except Empty:
+                table, row = None, None
+
+            if table is not None and table not in (BulkWriter._FLUSH, BulkWriter._STOP):
+                pending.setdefault(table, []).append(row)
+                num_pending += 1
+                if num_pending < self.batch_size and time() - last_write < self.flush_interval:
+                    continue
+
+            # a failed write is repeated until it succeeds or the writer gives up
+            while num_pending > 0:
+                if not self.try_write(pending):
+                    return
+                num_pending = sum(len(rows) for rows in pending.values())
+                if num_pending > 0 and table not in (BulkWriter._FLUSH, BulkWriter._STOP):
+                    # the queue keeps filling up while waiting for the database
+                    break
+            last_write = time()
+
+            if table == BulkWriter._FLUSH:
+                row.set()
+            elif table == BulkWriter._STOP:
+                return
+
+"""
+Statements prepared (server-side) once on every connection of the pool, so the hot
+queries are only parsed and planned once per connection. They are used through
+EXECUTE name (parameters).
+"""
+PREPARED_STATEMENTS = {
+    "page_id_by_url": ("(varchar)", "SELECT id FROM page WHERE url = $1"),
+    "site_id_by_domain": ("(varchar)", "SELECT id FROM site WHERE domain = $1 ORDER BY id LIMIT 1"),
+    "insert_page": ("(integer, varchar, varchar, text, integer, timestamp, varchar, char(64))",
+                    """INSERT INTO page (site_id, page_type_code, url, html_content, http_status_code,
+                                         accessed_time, lsh_hash, html_hash)
+                       VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                       ON CONFLICT (url) DO UPDATE
+                       SET site_id = EXCLUDED.site_id, page_type_code = EXCLUDED.page_type_code,
+                           html_content = EXCLUDED.html_content, html_hash = EXCLUDED.html_hash,
+                           http_status_code = EXCLUDED.http_status_code,
+                           accessed_time = EXCLUDED.accessed_time, lsh_hash = EXCLUDED.lsh_hash
+                       WHERE page.page_type_code = 'FRONTIER'
+                       RETURNING id"""),
+    "insert_site": ("(varchar, text, text)",
+                    "INSERT INTO site (domain, robots_content, sitemap_content) VALUES ($1, $2, $3) RETURNING id"),
+    "insert_html": ("(char(64), varchar, integer, bytea)",
+                    """INSERT INTO html_store (hash, compression, size, content) VALUES ($1, $2, $3, $4)
+                       ON CONFLICT (hash) DO NOTHING"""),
+    # the HTML of a candidate is only decoded if it is compared (see `Database.same_lsh_sites`)
+    "lsh_candidates": ("(varchar)",
+                       """SELECT p.id, p.url, p.html_hash, p.html_content, h.compression, h.content
+                          FROM page p LEFT JOIN html_store h ON h.hash = p.html_hash
+                          WHERE p.lsh_hash = $1
+                                AND (p.html_content IS NOT NULL OR p.html_hash IS NOT NULL)"""),
+    "page_html": ("(varchar)",
+                  """SELECT p.html_content, h.compression, h.content
+                     FROM page p LEFT JOIN html_store h ON h.hash = p.html_hash
+                     WHERE p.url = $1""")
+}
+
 
 class Pool:
 
@@ -12,41 +498,153 @@ class Pool:
     db = 'crawldb'
     schema = 'crawldb'
 
-    def __init__(self):
+    def __init__(self, max_connections=100, timeout=None, html_storage="inline"):
+        """
+        Thread-safe connection pool. Unlike psycopg2's pools, `getconn` blocks while all
+        `max_connections` connections are leased (instead of raising an error), so any
+        number of workers can share the pool, and returned connections are kept open (and
+        set up) for the next lease.
+
+        Parameters
+        ----------
+        max_connections: int
+            Maximum number of open connections
+
+        timeout: float, optional
+            Maximum time (in seconds) that `getconn` waits for a free connection
+
+        html_storage: str, optional
+            How sessions of this pool store the HTML of pages (one of `HTML_STORAGE_MODES`)
+        """
+        if html_storage not in HTML_STORAGE_MODES:
+            raise ValueError("Unknown HTML storage '{}' (expected one of {})".format(
+                html_storage, ", ".join(HTML_STORAGE_MODES)))
+        if html_storage == "zstd" and zstandard is None:
+            raise ValueError("HTML storage 'zstd' needs the zstandard package")
+        self.html_storage = html_storage
+        self.timeout = timeout
+        self.available = threading.BoundedSemaphore(max_connections)
+        self.idle = []
+        self.lock = threading.Lock()
+        # ids of rows, shared between all the threads using this pool
+        self.page_ids = IdCache(PAGE_ID_CACHE_SIZE)
+        self.site_ids = IdCache(SITE_ID_CACHE_SIZE)
+        # hashes of HTML that is already in html_store (not written again)
+        self.html_hashes = IdCache(HTML_HASH_CACHE_SIZE)
         try:
-            self.pool = psycopg2.pool.ThreadedConnectionPool(1, 100,
-                                                             user=self.user,
-                                                             password=self.password,
-                                                             host=self.host,
-                                                             port=self.port,
-                                                             database=self.db)
+            self.idle.append(self.connect())
             print("Connected to database ", self.db, " and created pool.")
         except (Exception, psycopg2.Error) as error:
             print("Error while connecting to PostgreSQL", error)
 
+    def connect(self):
+        """ Opens and sets up a new connection: sets the schema and prepares `PREPARED_STATEMENTS`."""
+        connection = psycopg2.connect(user=self.user,
+                                      password=self.password,
+                                      host=self.host,
+                                      port=self.port,
+                                      database=self.db)
+        cursor = connection.cursor()
+        # Set the schema to 'crawldb' so we don't have to specify in each query.
+        cursor.execute("SET search_path TO " + self.schema)
+        for name, (types, statement) in PREPARED_STATEMENTS.items():
+            cursor.execute("PREPARE {} {} AS {}".format(name, types, statement))
+        connection.commit()
+        cursor.close()
+        return connection
+
+    def getconn(self):
+        """ Leases a connection, waiting for one to become free if needed."""
+        if not self.available.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError("Timed out while waiting for a free connection")
+        try:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            if connection is None or connection.closed:
+                # no idle connection (or the server closed it)
+                connection = self.connect()
+            return connection
+        except Exception:
+            self.available.release()
+            raise
+
+    def putconn(self, connection):
+        """ Returns a leased connection to the pool."""
+        try:
+            if not connection.closed:
+                # do not hand out connections with an open transaction (checked without a
+                # round trip, sessions are leased for every database call)
+                status = connection.get_transaction_status()
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                with self.lock:
+                    self.idle.append(connection)
+        finally:
+            self.available.release()
+
+    def closeall(self):
+        """ Closes all the idle connections."""
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+    @contextmanager
+    def connection(self):
+        """ Leases a connection for the duration of a with block."""
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
 
 class Database:
+    """
+    Database session. Holds a connection leased from the pool until `close_connection` is
+    called, so a single Database must only be used by one thread. Can be used as a context
+    manager, which returns the connection at the end of the with block:
+
+    > with Database(pool) as database:
+    >     database.page_id('http://evem.gov.si/')
+    """
 
     db = 'crawldb'
     schema = 'crawldb'
 
-    def __init__(self, pool):
-        try:
-            self.pool = pool
-            self.connection = self.pool.pool.getconn()
-            self.cursor = self.connection.cursor()
-            # Set the schema to 'crawldb' so we don't have to specify in each query.
-            set_schema = "SET search_path TO " + self.schema
-            self.alter(set_schema)
-            print("Connected to database ", self.db)
-        except (Exception, psycopg2.Error) as error:
-            print("Error while connecting to PostgreSQL", error)
+    def __init__(self, pool=None, writer=None):
+        """
+        Parameters
+        ----------
+        pool: Pool, optional
+            Connection pool from which the connection is leased. If not given, the session
+            opens (and on `close_connection` closes) a connection of its own.
+
+        writer: BulkWriter, optional
+            If given, inserts are queued and written in batches by the writer instead of
+            being committed one by one
+        """
+        self.writer = writer
+        self.own_pool = pool is None
+        self.pool = Pool(max_connections=1) if self.own_pool else pool
+        self.connection = self.pool.getconn()
+        self.cursor = self.connection.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_connection()
 
     # Close database connection
     def close_connection(self):
+        if self.connection is None:
+            return
         self.cursor.close()
         self.pool.putconn(self.connection)
-        print("PostgreSQL connection closed")
+        self.connection = None
+        if self.own_pool:
+            self.pool.closeall()
 
     # Not safe - perform self query escapes etc.
     # Method for create/update/delete (CUD) queries
@@ -84,128 +682,254 @@ class Database:
         return datetime.now()
 
     # Method for return (R) query (Single result).
-    def return_one(self, query, parameters):
+    def return_one(self, query, parameters=None):
         try:
             self.cursor.execute(query, parameters)
             return self.cursor.fetchone()
         except Exception as e:
             print("Return one failed ", e)
+            self.connection.rollback()
             return None
 
     # Method for return (R) query (All results).
-    def return_all(self, query, parameters):
+    def return_all(self, query, parameters=None):
         try:
             self.cursor.execute(query, parameters)
-            return self.cursor.fetchone()
+            return self.cursor.fetchall()
         except Exception as e:
             print("Return all failed ", e)
+            self.connection.rollback()
             return None
 
     # Clear the information in database.
     # Tables NOT to clear: data_type, page_type
-    # Tables to truncate: link, image, page_data, page, site
+    # Tables to truncate: link, image, page_data, frontier, frontier_host, page, html_store, site
     def truncate_everything(self):
-        query = "TRUNCATE link, image, page_data, page, site"
+        query = "TRUNCATE link, image, page_data, frontier, frontier_host, page, html_store, site"
         self.alter(query)
+        self.pool.page_ids.clear()
+        self.pool.site_ids.clear()
+        self.pool.html_hashes.clear()
         print("Database Truncated.")
 
     def root_site_id(self, root_site):
-        query = "SELECT id FROM site WHERE domain = (%s)"
-        return self.return_one(query, [root_site])
+        return self.site_id(root_site)
+
+    def site_id(self, domain):
+        """ Returns the id of the site with `domain` (or None if it does not exist)."""
+        site_id = self.pool.site_ids.get(domain)
+        if site_id is None:
+            row = self.return_one("EXECUTE site_id_by_domain (%s)", [domain])
+            site_id = row[0] if row is not None else None
+            self.pool.site_ids.put(domain, site_id)
+        return site_id
+
+    def page_id(self, url):
+        """ Returns the id of the page with `url` (or None if it does not exist)."""
+        page_id = self.pool.page_ids.get(url)
+        if page_id is None:
+            row = self.return_one("EXECUTE page_id_by_url (%s)", [url])
+            page_id = row[0] if row is not None else None
+            self.pool.page_ids.put(url, page_id)
+        return page_id
+
+    def insert_returning_id(self, query, parameters):
+        """ Runs an INSERT ... RETURNING id statement and commits it.
+
+        Returns
+        -------
+        int or None:
+            Id of the inserted row or None if no row was inserted (or the insert failed)
+        """
+        try:
+            self.cursor.execute(query, parameters)
+            row = self.cursor.fetchone()
+            self.connection.commit()
+            return row[0] if row is not None else None
+        except Exception as e:
+            print("Failed to run parameterized query: ", query)
+            print("Issue ", e)
+            self.connection.rollback()
+            return None
+
+    def insert_rows(self, table, rows):
+        """ Inserts rows into one of the `INSERT_STATEMENTS` tables with a single multi-row
+        statement, either right away or through the bulk writer (if the database has one).
+
+        Parameters
+        ----------
+        table: str
+            Key of `INSERT_STATEMENTS`
+
+        rows: list of tuple
+            Rows with the columns that the statement expects
+        """
+        if self.writer is not None:
+            for row in rows:
+                self.writer.add(table, row)
+        else:
+            write_rows(self.connection, table, rows)
 
     # Helper function for inserting links (duplicate page links to the OG page)
     def add_link(self, from_page_id, to_page_id):
-        query = """INSERT INTO link (from_page, to_page) 
-                   VALUES (%s, %s)
-                """
-        self.param_query(query, [from_page_id, to_page_id])
-
-    # Helper function for inserting an image into the database.
-    def add_image(self, page_url, filename, content_type, data):
-        accessed_time = self.current_time()
-        page_id = self.return_one(
-            "SELECT id FROM page WHERE url = (%s)", [page_url])
-        if page_id != None:
-            insert_parameterized_query = """
-                    INSERT INTO image (page_id, filename, content_type, data, accessed_time) 
-                    VALUES (%s, %s, %s, %s, %s)
-                    """
-            self.param_query(insert_parameterized_query, [
-                             page_id, filename, content_type, data, accessed_time])
-
-    # Helper function for inserting page data
-
-    def add_page_data(self, page_url, data_type_code, data):
-        # Return foreign key ID of this page.
-        page_id = self.return_one(
-            "SELECT id FROM page WHERE url = (%s)", [page_url])
-        if page_id != None:
-            insert_parameterized_query = """INSERT INTO page (page_id, data_type_code, data) 
-            VALUES (%s, %s, %s)"""
-            self.param_query(insert_parameterized_query, [
-                             page_id, data_type_code, data])
-
-    # Helpers for adding pages to the database
-    def add_site_info_to_db(self, domain, robots, sitemap):
-        if self.root_site_id(domain) == None:
-            insert_parameterized_query = "INSERT INTO site (domain, robots_content, sitemap_content) VALUES (%s, %s, %s)"
-            self.param_query(insert_parameterized_query,
-                             [domain, robots, sitemap])
-
-    # Helper for adding a page into the database
-    def add_page(self, site_id, page_type_code, url, html_content, http_status_code, lsh_hash):
-        accessed_time = self.current_time()
-        insert_parameterized_query = """INSERT INTO page (site_id, page_type_code, url, html_content, http_status_code, 
-        accessed_time, lsh_hash) VALUES (%s, %s, %s, %s, %s, %s, %s)"""
-        self.param_query(insert_parameterized_query, [
-                         site_id, page_type_code, url, html_content, http_status_code, accessed_time, lsh_hash])
+        self.insert_rows("link", [(from_page_id, to_page_id)])
 
-    def add_link_between_two_sites(self, page_og_url, page_dup_url):
-        og_page_id = self.return_one(
-            "SELECT id FROM page WHERE url = (%s)", [page_og_url])
-        dup_page_id = self.return_one(
-            "SELECT id FROM page WHERE url = (%s)", [page_dup_url])
-        if og_page_id != None and dup_page_id != None:
-            insert_parameterized_query = """INSERT INTO link (from_page, to_page) VALUES (%s, %s)"""
-            self.param_query(insert_parameterized_query,
-                             [og_page_id, dup_page_id])
-
-    def insert_file_into_db(self, url, data_type_code, data):
-        insert_parameterized_query = """INSERT INTO page_data (page_id, data_type_code, data) VALUES (%s, %s, %s)"""
-        page_id = self.return_one(
-            "SELECT id FROM page WHERE url = (%s)", [url])
-        if page_id != None:
-            self.param_query(insert_parameterized_query, [
-                            page_id, data_type_code, data])
+    # Helper function for inserting an image into the database. The image itself is stored in the
+    # blob store (see `crawler.blobstore.BlobStore`) under `content_hash`.
+    def add_image(self, page_url, filename, content_type, content_hash, size):
+        page_id = self.page_id(page_url)
+        if page_id is not None:
+            self.insert_rows("image", [(page_id, filename, content_type, content_hash, size,
+                                        self.current_time())])
+
+    # Helper function for inserting page data (a file stored in the blob store under `content_hash`)
+    def add_page_data(self, page_url, data_type_code, content_hash, size):
+        page_id = self.page_id(page_url)
+        if page_id is not None:
+            self.insert_rows("page_data", [(page_id, data_type_code, content_hash, size)])
         else:
             print("Error inserting file into db")
 
+    # Helpers for adding pages to the database. Returns the id of the site.
+    def add_site_info_to_db(self, domain, robots, sitemap):
+        site_id = self.site_id(domain)
+        if site_id is None:
+            site_id = self.insert_returning_id("EXECUTE insert_site (%s, %s, %s)",
+                                               [domain, robots, sitemap])
+            self.pool.site_ids.put(domain, site_id)
+        return site_id
+
+    # Helper for adding a page into the database. The page is attached to the site by its domain.
+    # A FRONTIER row of the page gets filled in. Returns the id of the page (also if the page was
+    # already in the database). The HTML is stored as the pool's 'html_storage' says, under
+    # `content_hash` if the caller already hashed it (see `crawler.page.Page.fingerprint`).
+    def add_page(self, site_domain, page_type_code, url, html_content, http_status_code, lsh_hash,
+                 content_hash=None):
+        if html_content is not None and self.pool.html_storage != "inline":
+            with METRICS.timer("db_write", table="html_store"):
+                content_hash = self.store_html(html_content, content_hash)
+            html_content = None
+        else:
+            content_hash = None
+
+        with METRICS.timer("db_write", table="page"):
+            page_id = self.insert_returning_id(
+                "EXECUTE insert_page (%s, %s, %s, %s, %s, %s, %s, %s)",
+                [self.site_id(site_domain), page_type_code, url, html_content, http_status_code,
+                 self.current_time(), lsh_hash, content_hash])
+        if page_id is None:
+            return self.page_id(url)
+        if content_hash is not None:
+            self.pool.html_hashes.put(content_hash, True)
+        self.pool.page_ids.put(url, page_id)
+        return page_id
+
+    def store_html(self, html, content_hash=None):
+        """ Adds HTML to html_store (unless it is there already) in the transaction of the page
+        that references it, so it is committed together with the page. The HTML is hashed
+        unless `content_hash` is given.
 
-    def same_lsh_sites(self, lsh, content1, url,status_code):
+        Returns
+        -------
+        str:
+            Hash of the HTML
+        """
+        if content_hash is None:
+            content_hash = html_hash(html)
+        if self.pool.html_hashes.get(content_hash) is None:
+            compression = self.pool.html_storage
+            content = encode_html(html, compression)
+            # size is the uncompressed size, so octet_length(content) / size is the compression ratio
+            self.cursor.execute("EXECUTE insert_html (%s, %s, %s, %s)",
+                                [content_hash, compression, len(html.encode("utf-8")),
+                                 psycopg2.Binary(content)])
+        return content_hash
+
+    def page_html(self, url):
+        """ Returns the HTML of the page with `url` (or None), however it is stored."""
+        row = self.return_one("EXECUTE page_html (%s)", [url])
+        if row is None:
+            return None
+        html_content, compression, content = row
+        if html_content is not None or content is None:
+            return html_content
+        return decode_html(compression, content)
+
+    def add_links(self, from_url, to_urls):
+        """ Records edges of the link graph from the page with `from_url` to each of `to_urls`.
+        Targets that are not in the database yet get a FRONTIER page.
+
+        Parameters
+        ----------
+        from_url: str
+            URL of a page that is (or will be) in the database
+
+        to_urls: list of crawler.links.CanonicalUrl
+            Links found on the page
+        """
+        edges = [(from_url, to_url.url, to_url.host) for to_url in to_urls]
+        if self.writer is not None:
+            for edge in edges:
+                self.writer.add("edge", edge)
+        elif edges:
+            write_edges(self.connection, edges)
+
+    def add_link_between_two_sites(self, page_og_url, page_dup_url):
+        og_page_id = self.page_id(page_og_url)
+        dup_page_id = self.page_id(page_dup_url)
+        if og_page_id is not None and dup_page_id is not None:
+            self.add_link(og_page_id, dup_page_id)
+
+    def insert_file_into_db(self, url, data_type_code, content_hash, size):
+        self.add_page_data(url, data_type_code, content_hash, size)
+
+    def same_lsh_sites(self, page, lsh_hash, site_url):
         '''
         Finds all the sites with same lsh_hash and compares their html_content to its own.
         It uses SequenceMatcher to calculate simillarity.
         Sites are equal if ratio is more or equal to 0.9.
 
         Also adds the page into the database and creates entry into Links table.
+
+        Returns the URL of the original page if the page is a duplicate, else None.
+
+        Parameters
+        ----------
+        page: crawler.page.Page
+            Page that is checked for duplicates. Its lowercased HTML is computed only once.
+
+        lsh_hash: str
+            LSH signature of the page
+
+        site_url: str
+            Domain of the site the page belongs to
         '''
-        same_lsh_website_ids = self.return_all("SELECT id FROM page WHERE lsh_hash = (%s)", [lsh])
-        if same_lsh_website_ids != None:
+        candidates = self.return_all("EXECUTE lsh_candidates (%s)", [lsh_hash])
+        if candidates:
+            content1 = page.lowered
+            content1_hash = page.fingerprint
             # Go through all returned sites
-            for id in same_lsh_website_ids:
-                html_content2 = self.return_all("SELECT html_content, url FROM page WHERE id= (%s)", [id])
-                if html_content2 != None:
-                    simillarity=difflib.SequenceMatcher(a=content1.lower(), b=html_content2[0].lower())
-                    if simillarity.ratio() >= 0.9:
-                        print("Duplicate page found.")
-                        root_site_id = self.root_site_id(url)
-                        self.add_page(root_site_id, "DUPLICATE", url, None, status_code, lsh)
-                        # Insert into links
-                        self.add_link_between_two_sites(html_content2[1], url)
-                        print(html_content2[1])
-                        return True
-
-        return False
+            for og_page_id, og_url, og_html_hash, html_content2, compression, content in candidates:
+                # identical HTML is a duplicate without comparing (or decompressing) it
+                if og_html_hash == content1_hash:
+                    ratio = 1.0
+                else:
+                    if html_content2 is None:
+                        html_content2 = decode_html(compression, content)
+                    with METRICS.timer("difflib", host=site_url) as labels:
+                        ratio = html_similarity(content1, html_content2)
+                        labels["status"] = "duplicate" if ratio >= 0.9 else "different"
+                if ratio >= 0.9:
+                    print("Duplicate page found.")
+                    dup_page_id = self.add_page(site_url, "DUPLICATE", page.url, None, page.status_code,
+                                                lsh_hash)
+                    # Insert into links
+                    if dup_page_id is not None:
+                        self.add_link(og_page_id, dup_page_id)
+                    print(og_url)
+                    return og_url
+
+        return None
 
 if __name__ == "__main__":
     # db = Database()
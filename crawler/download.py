@@ -0,0 +1,96 @@
+"""
+This file contains streaming downloads of binary content (documents, images). The body of a
+response is written to the disk in chunks while it is being received, so large files are
+never held in memory. The SHA-256 hash of the content is computed along the way.
+
+The content is first written into a temporary file in the destination's directory, which is
+renamed to the destination only once the whole body was received. If anything goes wrong
+(connection error, file bigger than the size cap), the temporary file is removed, so a
+partial file is never left behind.
+
+Example usage:
+
+> response = requests.get("http://evem.gov.si/vloga.pdf", stream=True)
+> download = stream_to_file(response, "files/PDF/evem.gov.si/vloga.pdf", max_bytes=50 * 2 ** 20)
+> download.sha256, download.size
+"""
+import hashlib
+import os
+import threading
+from collections import namedtuple
+from os.path import dirname, exists
+
+# User-Agent of all the crawler's requests (pages, files and images)
+USER_AGENT = "govrilovic-crawler/v0.1"
+# how long the crawler waits before giving up on a request (in seconds)
+TIMEOUT_PERIOD = 10.0
+# files larger than this are not downloaded (in bytes)
+MAX_DOWNLOAD_BYTES = 50 * 2 ** 20
+CHUNK_SIZE = 64 * 2 ** 10
+
+Download = namedtuple("Download", ["path", "sha256", "size"])
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+def stream_to_file(response, destination, max_bytes=MAX_DOWNLOAD_BYTES, chunk_size=CHUNK_SIZE):
+    """ Writes the body of a (streamed) response to a file. The response is always closed.
+
+    Parameters
+    ----------
+    response: requests.Response
+        Response of a request made with `stream=True` (its body was not read yet)
+
+    destination: str
+        Path of the file. Its directory is created if needed and an existing file is replaced.
+
+    max_bytes: int, optional
+        Maximum size of the body. Larger bodies are not saved (`DownloadTooLarge` is raised).
+
+    chunk_size: int
+        Number of bytes read from the response at once
+
+    Returns
+    -------
+    Download:
+        Path, SHA-256 hex digest and size (in bytes) of the saved file
+
+    Raises
+    ------
+    DownloadTooLarge:
+        If the body is larger than `max_bytes`
+    """
+    directory = dirname(destination) or "."
+    # unique for every thread, so concurrent downloads of the same file do not mix
+    temp_path = "{}.{}-{}.part".format(destination, os.getpid(), threading.get_ident())
+    try:
+        content_length = response.headers.get("Content-Length")
+        if max_bytes is not None and content_length is not None and content_length.isdigit() \
+                and int(content_length) > max_bytes:
+            raise DownloadTooLarge("{} has {} bytes (limit is {})".format(
+                response.url, content_length, max_bytes))
+
+        if not exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(temp_path, "wb") as temp_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                # Content-Length can be missing or wrong, so the cap is also checked while reading
+                if max_bytes is not None and size > max_bytes:
+                    raise DownloadTooLarge("{} has more than {} bytes".format(response.url, max_bytes))
+                sha256.update(chunk)
+                temp_file.write(chunk)
+
+        os.replace(temp_path, destination)
+        return Download(destination, sha256.hexdigest(), size)
+    except BaseException:
+        if exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        response.close()
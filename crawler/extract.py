@@ -0,0 +1,205 @@
+"""
+Single-pass extraction of everything the crawler needs from an HTML page
+(base href, links, javascript redirects, images and document links).
+
+Instead of building a BeautifulSoup tree and walking it once per element type,
+the page is fed to lxml's HTML parser with a custom parser target. The target
+only receives start tags, so no tree is ever built and every element is
+visited exactly once.
+
+Example usage:
+
+> page = extract_page('<a href="/about">About</a>', 'http://evem.gov.si')
+> page.links
+['http://evem.gov.si/about']
+"""
+import re
+from functools import lru_cache
+from urllib.parse import urljoin
+from os.path import splitext
+
+from lxml import etree
+
+from crawler.links import Links, CANONICAL_CACHE_SIZE
+
+"""
+This regexp will extract links from value assignments of kind window.location(.href/.assign) = "link"
+E.g. this example will result in "link".
+"""
+REGEXP_SET_VALUE = re.compile(r"window.location(\.href|\.assign)?\s*=\s*'(.+)'")
+
+"""
+This regexp will extract links from value of kind self/top.location = "link" (could be .replace)
+E.g. this example will result in "link".
+"""
+REGEXP_SELF_TOP = re.compile(r"(self|top)\.location\s*=\s*'(.+)'")
+
+"""
+This regexp will extract links from functional calls of kind window.location.assign("yeet") (could be .replace)
+E.g. this example will result in "yeet".
+"""
+REGEXP_FUNC_CALL = re.compile(r"window.location(\.assign|\.replace)\('(.+)'")
+
+JS_REDIRECT_REGEXPS = (REGEXP_SET_VALUE, REGEXP_SELF_TOP, REGEXP_FUNC_CALL)
+
+IMAGE_EXTENSIONS = {"png", "jpeg", "jpg"}
+DOCUMENT_EXTENSIONS = {"pdf", "doc", "docx", "ppt", "pptx"}
+
+
+def normalize_url(url):
+    """ Returns the canonical form of an absolute URL or None if it is not an http(s) URL."""
+    canonical = Links.canonicalize(url)
+    return canonical.url if canonical is not None else None
+
+
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def absolutize(base_url, href):
+    """ Resolves `href` against `base_url`, skipping the (slow) join for absolute URLs."""
+    if href.startswith(("http://", "https://")):
+        return href
+    return urljoin(base_url, href)
+
+
+def get_url_extension(url):
+    # Returns the filename extension or '' if none. For example "png", "html", ...
+    # Same as taking the extension of `urlparse(url).path`, but without parsing the whole URL.
+    path = url.split("#", 1)[0].split("?", 1)[0]
+    if "://" in path:
+        path = path.split("://", 1)[1]
+        idx_path = path.find("/")
+        path = path[idx_path:] if idx_path >= 0 else ""
+    root, extension = splitext(path)
+    return extension[1:]
+
+
+def js_redirects(onclick):
+    """ Returns the (unnormalized) URLs that an onclick handler redirects to."""
+    redirects = []
+    for regexp in JS_REDIRECT_REGEXPS:
+        redirects.extend(second_el for _, second_el in regexp.findall(onclick))
+    return redirects
+
+
+class _ElementCollector:
+    """
+    lxml parser target which collects raw attribute values of the elements we are
+    interested in. Only `start` is defined, so lxml skips text and end-tag callbacks.
+    """
+
+    def __init__(self):
+        self.base_href = None
+        # (href, onclick) pairs of <a> elements, in document order
+        self.anchors = []
+        self.button_onclicks = []
+        self.image_srcs = []
+
+    def start(self, tag, attrib):
+        if tag == "a":
+            self.anchors.append((attrib.get("href"), attrib.get("onclick")))
+        elif tag == "img":
+            src = attrib.get("src")
+            if src:
+                self.image_srcs.append(src)
+        elif tag == "button":
+            onclick = attrib.get("onclick")
+            if onclick:
+                self.button_onclicks.append(onclick)
+        elif tag == "base" and self.base_href is None:
+            self.base_href = attrib.get("href")
+
+    def close(self):
+        return self
+
+
+class ExtractedPage:
+    """
+    Result of `extract_page`.
+
+    Attributes
+    ----------
+    base_href: str
+        Href of the first <base> element or the page URL if there is none.
+
+    links: list of str
+        Normalized absolute URLs from <a> elements (and javascript redirects if requested).
+
+    redirects: list of str
+        Normalized URLs from onclick redirects of <a> and <button> elements.
+
+    images: list of str
+        URLs of .png/.jpeg/.jpg images.
+
+    documents: list of str
+        Subset of `links` that point to downloadable documents (pdf, doc, ppt, ...).
+    """
+
+    def __init__(self, base_href, links, redirects, images, documents):
+        self.base_href = base_href
+        self.links = links
+        self.redirects = redirects
+        self.images = images
+        self.documents = documents
+
+
+def extract_page(html, url, parse_js_redirects=False):
+    """ Extracts base href, links, images and document links from a page in a single pass.
+
+    Produces the same links as `find_links` and the same image URLs as `find_images`
+    (both resolved against the base href, as is the case in `crawl_page`).
+
+    Parameters
+    ----------
+    html: str or bytes
+        Content of the page
+
+    url: str
+        URL of the page, used if the page does not contain a <base href=".."> element
+
+    parse_js_redirects: bool
+        Whether to include javascript redirects inside onclick="window.location = 'somelink'"-like
+        attributes in `links`
+
+    Returns
+    -------
+    ExtractedPage
+    """
+    collector = _ElementCollector()
+    if html:
+        parser = etree.HTMLParser(target=collector)
+        parser.feed(html)
+        parser.close()
+
+    base_href = collector.base_href or url
+
+    # links are kept in the same order as `find_links` produces them: each anchor's href
+    # followed by its onclick redirects, then the redirects of all buttons
+    links = []
+    redirects = []
+    for href, onclick in collector.anchors:
+        if href and href[0] != "#":
+            link = normalize_url(absolutize(base_href, href))
+            if link is not None:
+                links.append(link)
+        if onclick and parse_js_redirects:
+            anchor_redirects = [c.url for c in Links.canonicalize_all(js_redirects(onclick))]
+            links.extend(anchor_redirects)
+            redirects.extend(anchor_redirects)
+
+    if parse_js_redirects:
+        for onclick in collector.button_onclicks:
+            button_redirects = [c.url for c in Links.canonicalize_all(js_redirects(onclick))]
+            links.extend(button_redirects)
+            redirects.extend(button_redirects)
+
+    images = []
+    for src in collector.image_srcs:
+        if src[0] == "#":
+            continue
+        if src[0] in {"/", "?"}:
+            src = absolutize(base_href, src)
+        if get_url_extension(src) in IMAGE_EXTENSIONS:
+            images.append(src)
+
+    documents = [link for link in links if get_url_extension(link).lower() in DOCUMENT_EXTENSIONS]
+
+    return ExtractedPage(base_href, links, redirects, images, documents)
@@ -0,0 +1,230 @@
+"""
+This file contains the shared (Postgres-backed) frontier, which allows any number of
+crawler processes, on any number of machines, to crawl from the same frontier.
+
+Every frontier entry is a FRONTIER page (see `docker/baza.sql`) with a row in the
+`frontier` table. Completed entries whose page was not stored (e.g. disallowed by robots.txt,
+non-200 responses) stay FRONTIER pages, but get an `accessed_time`, so they are never added
+to the frontier again. Work is partitioned by host to keep politeness: a worker first leases
+a host (so no other worker crawls it at the same time) and then a batch of the host's
+URLs, both with `SELECT ... FOR UPDATE SKIP LOCKED`, so workers never wait for each other.
+Leases expire after `lease_seconds`, so entries claimed by a worker that died get claimed
+again by someone else. Entries that failed are released with a `not_before` time (their retry
+backoff, see `crawler.health.RetryQueue`) and nobody claims them before it.
+
+Example usage (in each worker):
+
+> frontier = PostgresFrontier(pool, worker_id='host-1/worker-3')
+> frontier.add(['http://evem.gov.si/'], depth=0)
+> host, entries = frontier.claim()
+> ...crawl...
+> frontier.complete(host, [page_id for page_id, url, depth in entries], delay=3)
+"""
+import os
+import socket
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from crawler.links import Links
+
+ADD_PAGES = """WITH v (url, host, depth) AS (VALUES %s),
+               inserted AS (INSERT INTO page (page_type_code, url)
+                            SELECT 'FRONTIER', url FROM v
+                            ON CONFLICT (url) DO NOTHING
+                            RETURNING id, url),
+               frontier_pages AS (SELECT id, url FROM inserted
+                                  UNION ALL
+                                  SELECT id, url FROM page
+                                  WHERE url IN (SELECT url FROM v) AND page_type_code = 'FRONTIER'
+                                        AND accessed_time IS NULL)
+               INSERT INTO frontier (page_id, host, depth)
+               SELECT p.id, v.host, v.depth FROM v JOIN frontier_pages p ON p.url = v.url
+               ON CONFLICT DO NOTHING"""
+
+ADD_HOSTS = """INSERT INTO frontier_host (domain)
+               SELECT DISTINCT host FROM (VALUES %s) AS v (host)
+               ON CONFLICT DO NOTHING"""
+
+CLAIM_HOST = """UPDATE frontier_host
+                SET claimed_by = %(worker)s, claimed_until = now() + %(lease)s * interval '1 second'
+                WHERE domain = (SELECT h.domain FROM frontier_host h
+                                WHERE (h.claimed_until IS NULL OR h.claimed_until < now())
+                                  AND h.next_fetch_at <= now()
+                                  AND EXISTS (SELECT 1 FROM frontier f
+                                              WHERE f.host = h.domain
+                                                AND (f.claimed_until IS NULL OR f.claimed_until < now())
+                                                AND (f.not_before IS NULL OR f.not_before <= now()))
+                                ORDER BY h.next_fetch_at
+                                LIMIT 1
+                                FOR UPDATE SKIP LOCKED)
+                RETURNING domain"""
+
+CLAIM_ENTRIES = """UPDATE frontier f
+                   SET claimed_by = %(worker)s, claimed_until = now() + %(lease)s * interval '1 second'
+                   FROM page p
+                   WHERE p.id = f.page_id
+                     AND f.page_id IN (SELECT page_id FROM frontier
+                                       WHERE host = %(host)s
+                                         AND (claimed_until IS NULL OR claimed_until < now())
+                                         AND (not_before IS NULL OR not_before <= now())
+                                         AND (%(max_depth)s IS NULL OR depth <= %(max_depth)s)
+                                       ORDER BY depth, page_id
+                                       LIMIT %(batch_size)s
+                                       FOR UPDATE SKIP LOCKED)
+                   RETURNING f.page_id, p.url, f.depth"""
+
+RENEW = """UPDATE frontier_host SET claimed_until = now() + %(lease)s * interval '1 second'
+           WHERE domain = %(host)s AND claimed_by = %(worker)s;
+           UPDATE frontier SET claimed_until = now() + %(lease)s * interval '1 second'
+           WHERE host = %(host)s AND claimed_by = %(worker)s"""
+
+COMPLETE = """WITH completed AS (DELETE FROM frontier
+                                   WHERE page_id = ANY(%(page_ids)s) AND claimed_by = %(worker)s
+                                   RETURNING page_id)
+              UPDATE page SET accessed_time = now()
+              WHERE id IN (SELECT page_id FROM completed)
+                    AND page_type_code = 'FRONTIER' AND accessed_time IS NULL"""
+
+POSTPONE = """UPDATE frontier f SET not_before = now() + r.delay * interval '1 second'
+              FROM unnest(%(page_ids)s::integer[], %(delays)s::float8[]) AS r (page_id, delay)
+              WHERE f.page_id = r.page_id AND f.claimed_by = %(worker)s"""
+
+RELEASE_HOST = """UPDATE frontier_host
+                  SET claimed_by = NULL, claimed_until = NULL,
+                      next_fetch_at = now() + %(delay)s * interval '1 second'
+                  WHERE domain = %(host)s AND claimed_by = %(worker)s;
+                  UPDATE frontier SET claimed_by = NULL, claimed_until = NULL
+                  WHERE host = %(host)s AND claimed_by = %(worker)s"""
+
+
+class PostgresFrontier:
+
+    def __init__(self, pool, worker_id=None, lease_seconds=300, batch_size=20, max_depth=None):
+        """
+        Parameters
+        ----------
+        pool: crawler.db.Pool
+            Connection pool of the crawl database
+
+        worker_id: str, optional
+            Unique name of the worker (used to mark leases). Defaults to hostname and PID.
+
+        lease_seconds: float
+            Time after which claimed hosts and URLs can be claimed by other workers, unless
+            the lease gets renewed (`renew`)
+
+        batch_size: int
+            Maximum number of URLs claimed at once
+
+        max_depth: int, optional
+            URLs deeper than this (number of links from a seed page) are never claimed
+        """
+        self.pool = pool
+        self.worker_id = worker_id if worker_id is not None else \
+            "{}/{}".format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_depth = max_depth
+
+    def execute(self, query, parameters, fetch=False):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, parameters)
+                result = cursor.fetchall() if fetch else None
+                connection.commit()
+                return result
+            except psycopg2.Error as e:
+                print("[PostgresFrontier] Query failed: ", e)
+                connection.rollback()
+                return [] if fetch else None
+            finally:
+                cursor.close()
+
+    def add(self, urls, depth):
+        """ Adds URLs to the frontier. URLs that were already crawled (or are already in the
+        frontier) are skipped.
+
+        Parameters
+        ----------
+        urls: iterable of str
+            Canonical URLs (see `crawler.links.CanonicalizationRules`)
+
+        depth: int
+            Number of links between a seed page and the URLs
+        """
+        rows = [(canonical.url, canonical.host, depth) for canonical in Links.canonicalize_all(urls)]
+        if not rows:
+            return
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                execute_values(cursor, ADD_HOSTS, [(host,) for _, host, _ in rows])
+                execute_values(cursor, ADD_PAGES, rows, template="(%s::varchar, %s::varchar, %s::integer)")
+                connection.commit()
+            except psycopg2.Error as e:
+                print("[PostgresFrontier] Failed to add {} URLs: {}".format(len(rows), e))
+                connection.rollback()
+            finally:
+                cursor.close()
+
+    def claim(self):
+        """ Leases a host that is not being crawled by anyone else and a batch of its URLs.
+
+        Returns
+        -------
+        (str, list of (int, str, int)) or (None, []):
+            Host and its claimed (page id, URL, depth) entries, or (None, []) if there is
+            nothing to crawl right now
+        """
+        parameters = {"worker": self.worker_id, "lease": self.lease_seconds,
+                      "batch_size": self.batch_size, "max_depth": self.max_depth}
+        claimed = self.execute(CLAIM_HOST, parameters, fetch=True)
+        if not claimed:
+            return None, []
+
+        host = claimed[0][0]
+        entries = self.execute(CLAIM_ENTRIES, dict(parameters, host=host), fetch=True)
+        if not entries:
+            self.release(host, delay=0)
+            return None, []
+        return host, sorted(entries, key=lambda entry: (entry[2], entry[0]))
+
+    def renew(self, host):
+        """ Extends the leases of the host and its claimed URLs (for long batches)."""
+        self.execute(RENEW, {"worker": self.worker_id, "lease": self.lease_seconds, "host": host})
+
+    def complete(self, host, page_ids, delay=0, retries=None):
+        """ Removes crawled URLs from the frontier and releases the host. Crawled URLs that
+        were not stored are marked as accessed, so they are not added again.
+
+        Parameters
+        ----------
+        host: str
+            Host returned by `claim`
+
+        page_ids: list of int
+            Ids of the crawled entries. Claimed entries that are not listed become available again.
+
+        delay: float
+            Time (in seconds) before the host can be claimed again (politeness)
+
+        retries: dict, optional
+            Claimed entries that failed and are to be crawled again, as page id -> time (in
+            seconds) before they can be claimed again
+        """
+        if page_ids:
+            self.execute(COMPLETE, {"worker": self.worker_id, "page_ids": list(page_ids)})
+        if retries:
+            self.execute(POSTPONE, {"worker": self.worker_id, "page_ids": list(retries),
+                                    "delays": [max(0.0, delay) for delay in retries.values()]})
+        self.release(host, delay)
+
+    def release(self, host, delay=0):
+        self.execute(RELEASE_HOST, {"worker": self.worker_id, "host": host, "delay": delay})
+
+    def size(self):
+        """ Number of URLs in the frontier."""
+        result = self.execute("SELECT count(*) FROM frontier", [], fetch=True)
+        return result[0][0] if result else 0
@@ -0,0 +1,305 @@
+"""
+This file contains the failure handling of the crawler:
+
+- a `CircuitBreaker` tracks consecutive failures (timeouts, connection errors, 429 and 5xx
+  responses) of every host. After `failure_threshold` of them the host's circuit opens: its URLs
+  are not requested (so no worker waits for `TIMEOUT_PERIOD` on a dead host) until
+  `open_seconds` have passed, when a single probe request is let through (half-open). A
+  successful probe closes the circuit, a failed one opens it again for twice as long (at most
+  `max_open_seconds`).
+- a `RetryQueue` keeps URLs that failed until they are due again, after `base_delay`,
+  2 * `base_delay`, 4 * `base_delay` ... seconds (at most `max_delay`). A URL is dropped after
+  `max_attempts` attempts. URLs that were parked while their host's circuit was open were not
+  attempted, so they wait for the next probe of the host for as long as the host is down (at
+  most `max_park_seconds`).
+
+Example usage:
+
+> breaker = CircuitBreaker(failure_threshold=5, open_seconds=60)
+> retries = RetryQueue(max_attempts=3, base_delay=30)
+> if not breaker.allow("evem.gov.si"):
+>     retries.park(url, breaker.blocked_until("evem.gov.si"))
+> ...
+> if breaker.failure("evem.gov.si"):
+>     retries.park(url, breaker.blocked_until("evem.gov.si"))
+> else:
+>     retries.retry(url, "timeout")
+> ...
+> urls = retries.pop_due()
+"""
+import heapq
+import threading
+from time import time
+from urllib.parse import urlparse
+
+from crawler.metrics import METRICS
+
+# status codes of responses that are failures of the host (and worth retrying)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class HostHealth:
+    """ Circuit state of one host."""
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        # requests to the host are blocked until this time (while the circuit is open, or
+        # half-open and waiting for the outcome of the probe)
+        self.open_until = 0.0
+        # how long the circuit stays open the next time it opens
+        self.open_seconds = None
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=5, open_seconds=60.0, max_open_seconds=900.0):
+        """
+        Parameters
+        ----------
+        failure_threshold: int
+            Number of consecutive failures after which a host's circuit opens (0 never opens it)
+
+        open_seconds: float
+            Time (in seconds) before the first probe of a host whose circuit opened
+
+        max_open_seconds: float
+            The longest time a circuit stays open (it doubles after every failed probe)
+        """
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host(self, host):
+        health = self.hosts.get(host)
+        if health is None:
+            health = self.hosts[host] = HostHealth()
+        return health
+
+    def state(self, host):
+        with self.lock:
+            return self._host(host).state
+
+    def allow(self, host):
+        """ Checks if a request can be made to the host. Once an open circuit's time is up,
+        this is True for exactly one caller (the probe) until its outcome is known (or until
+        it is overdue, e.g. when the probed page was not requested after all)."""
+        with self.lock:
+            health = self._host(host)
+            if health.state == CLOSED:
+                return True
+            if time() >= health.open_until:
+                health.state = HALF_OPEN
+                health.open_until = time() + health.open_seconds
+                print("[CircuitBreaker] Probing '{}'...".format(host))
+                return True
+            return False
+
+    def blocked_until(self, host):
+        """ Time (a `time.time()` timestamp) until which requests to the host are not allowed
+        (a past time if they are)."""
+        with self.lock:
+            health = self._host(host)
+            return health.open_until if health.state != CLOSED else 0.0
+
+    def success(self, host):
+        with self.lock:
+            health = self._host(host)
+            closed = health.state != CLOSED
+            health.state = CLOSED
+            health.failures = 0
+            health.open_seconds = None
+        if closed:
+            print("[CircuitBreaker] '{}' is reachable again...".format(host))
+
+    def failure(self, host):
+        """ Records a failed request to the host and opens its circuit if needed.
+
+        Returns
+        -------
+        bool:
+            True if the host's circuit is open (so the failure was probably the host's, not the
+            requested page's)
+        """
+        with self.lock:
+            health = self._host(host)
+            health.failures += 1
+            if health.state == HALF_OPEN:
+                # the probe failed: stay away for longer
+                health.open_seconds = min(self.max_open_seconds, 2 * health.open_seconds)
+            elif health.state == CLOSED and self.failure_threshold and \
+                    health.failures >= self.failure_threshold:
+                health.open_seconds = min(self.max_open_seconds, self.open_seconds)
+            else:
+                return health.state != CLOSED
+            health.state = OPEN
+            health.open_until = time() + health.open_seconds
+            seconds, failures = health.open_seconds, health.failures
+        METRICS.count("circuit_opened", host=host)
+        print("[CircuitBreaker] '{}' failed {} times in a row, parking its URLs for {:.0f} "
+              "seconds...".format(host, failures, seconds))
+        return True
+
+
+class RetryQueue:
+
+    def __init__(self, max_attempts=3, base_delay=30.0, max_delay=600.0, max_park_seconds=86400.0):
+        """
+        Parameters
+        ----------
+        max_attempts: int
+            Number of times a URL is attempted before it is dropped (1 never retries). Parking a
+            URL does not count as an attempt.
+
+        base_delay: float
+            Time (in seconds) before the first retry of a URL, doubled for every further one
+
+        max_delay: float
+            The longest time before a retry
+
+        max_park_seconds: float
+            The longest time a URL stays parked (see `park`) before it is dropped
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_park_seconds = max_park_seconds
+        # (due time, URL), may contain entries of URLs that were taken out (see `take`)
+        self.heap = []
+        # due time of every scheduled URL
+        self.scheduled = {}
+        # number of failed attempts of every URL
+        self.attempts = {}
+        # time every parked URL was first parked at
+        self.parked_since = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.scheduled)
+
+    def __contains__(self, url):
+        with self.lock:
+            return url in self.scheduled
+
+    def retry(self, url, reason, not_before=None):
+        """ Schedules a failed URL to be attempted again.
+
+        Parameters
+        ----------
+        url: str
+
+        reason: str
+            Why the attempt failed (e.g. "timeout" or a status code)
+
+        not_before: float, optional
+            The earliest time (a `time.time()` timestamp) of the next attempt
+
+        Returns
+        -------
+        bool:
+            True if the URL was scheduled, False if it ran out of attempts
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            attempts = self.attempts[url] = self.attempts.get(url, 0) + 1
+            if attempts >= self.max_attempts:
+                del self.attempts[url]
+                self.parked_since.pop(url, None)
+                scheduled = False
+            else:
+                due = time() + min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+                if not_before is not None:
+                    due = max(due, not_before)
+                self._schedule(url, due)
+                scheduled = True
+        if not scheduled:
+            METRICS.count("retries_exhausted", host=host, reason=reason)
+            print("[RetryQueue] Giving up on '{}' after {} attempts ({})...".format(url, attempts, reason))
+            return False
+        METRICS.count("retries", host=host, reason=reason)
+        print("[RetryQueue] Retrying '{}' in {:.0f} seconds ({})...".format(url, due - time(), reason))
+        return True
+
+    def park(self, url, until):
+        """ Schedules a URL that was not requested because its host's circuit is open. It is due
+        when the host can be probed again. Parking does not count as an attempt, so URLs are
+        not lost to a long outage, but a URL that has been parked for
+        `max_park_seconds` is dropped.
+
+        Parameters
+        ----------
+        url: str
+
+        until: float
+            Time (a `time.time()` timestamp) the host can be probed at (see
+            `CircuitBreaker.blocked_until`)
+
+        Returns
+        -------
+        bool:
+            True if the URL was parked, False if it was parked for too long
+        """
+        host = urlparse(url).netloc
+        now = time()
+        with self.lock:
+            parked_since = self.parked_since.setdefault(url, now)
+            parked = now - parked_since < self.max_park_seconds
+            if parked:
+                self._schedule(url, max(until, now))
+            else:
+                del self.parked_since[url]
+                self.attempts.pop(url, None)
+        if not parked:
+            METRICS.count("retries_exhausted", host=host, reason="open")
+            print("[RetryQueue] Giving up on '{}' after it was parked for {:.0f} seconds...".format(
+                url, now - parked_since))
+            return False
+        METRICS.count("parks", host=host)
+        return True
+
+    def _schedule(self, url, due):
+        self.scheduled[url] = due
+        heapq.heappush(self.heap, (due, url))
+
+    def take(self, url):
+        """ Takes a scheduled URL out of the queue.
+
+        Returns
+        -------
+        float or None:
+            Its due time, or None if the URL was not scheduled
+        """
+        with self.lock:
+            # its entry in the heap is skipped by `pop_due`
+            return self.scheduled.pop(url, None)
+
+    def pop_due(self):
+        """ Takes the URLs that are due out of the queue."""
+        now = time()
+        urls = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, url = heapq.heappop(self.heap)
+                if self.scheduled.get(url) == due:
+                    del self.scheduled[url]
+                    urls.append(url)
+        return urls
+
+    def wait_time(self):
+        """ Time (in seconds) until the next URL is due (0 if the queue is empty)."""
+        with self.lock:
+            while self.heap and self.scheduled.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            return max(0.0, self.heap[0][0] - time()) if self.heap else 0.0
+
+    def forget(self, url):
+        """ Forgets the failed attempts of a URL (after it was crawled)."""
+        with self.lock:
+            self.attempts.pop(url, None)
+            self.parked_since.pop(url, None)
@@ -0,0 +1,223 @@
+"""
+This file contains the background image downloader. Crawling threads only hand the images of
+a page over (`ImageDownloader.submit` does not wait for downloads) and a fixed number of
+download threads fetch them:
+
+- every image URL is downloaded at most once (the same logo on every page of a site is
+  downloaded once, but still recorded for every page it appears on) and stored in the blob
+  store (`crawler.blobstore.BlobStore`), which keeps identical images from different URLs once.
+  Only the last `max_images` downloaded URLs are remembered, an older one is downloaded again
+  (and stored once, as its content is the same),
+- requests to the same host are spaced at least `host_delay` seconds apart,
+- rows of downloaded images are inserted in batches by the `crawler.db.BulkWriter`. Its `add`
+  blocks while the writer's queue is full, so a slow database holds up the download threads and
+  `submit` of images that were already downloaded (they are recorded right away).
+
+Example usage:
+
+> images = ImageDownloader(writer, BlobStore("files/blobs"), workers=4, host_delay=0.5)
+> images.submit("http://evem.gov.si/", ["http://evem.gov.si/logo.png"])
+> ...
+> images.close()
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from queue import Queue, Full
+from time import time, sleep
+from urllib.parse import urlparse
+
+import requests
+
+from crawler.download import MAX_DOWNLOAD_BYTES, TIMEOUT_PERIOD, USER_AGENT
+from crawler.extract import absolutize, get_url_extension
+from crawler.metrics import METRICS
+
+# state of an image URL whose download failed (besides the blob of a downloaded image)
+_FAILED = object()
+# number of request slots reserved between two removals of idle hosts
+HOST_PRUNE_INTERVAL = 1000
+
+
+class ImageDownloader:
+
+    def __init__(self, writer, store, workers=4, max_pending=10000, host_delay=0.5,
+                 max_bytes=MAX_DOWNLOAD_BYTES, max_images=100000):
+        """
+        Parameters
+        ----------
+        writer: crawler.db.BulkWriter
+            Writer that inserts the rows of downloaded images
+
+        store: crawler.blobstore.BlobStore
+            Store the images are saved into
+
+        workers: int
+            Number of download threads
+
+        max_pending: int
+            Maximum number of images waiting for download. Images submitted while the queue is
+            full are dropped (crawling never waits for image downloads).
+
+        host_delay: float
+            Minimum time (in seconds) between two image requests to the same host
+
+        max_bytes: int, optional
+            Images larger than this (in bytes) are not saved
+
+        max_images: int
+            Number of downloaded (or failed) image URLs that are remembered
+        """
+        self.writer = writer
+        self.store = store
+        self.host_delay = host_delay
+        self.max_bytes = max_bytes
+        self.max_images = max_images
+        self.queue = Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        # image URL -> blob of the downloaded image or _FAILED (least recently used first)
+        self.states = OrderedDict()
+        # image URL -> URLs of pages that wait for the image to be downloaded
+        self.waiting_pages = {}
+        # host -> earliest time of the next request to it (hosts without a future request are
+        # removed every HOST_PRUNE_INTERVAL reservations)
+        self.next_request = {}
+        self.num_reservations = 0
+        self.num_downloaded = 0
+        self.num_reused = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+
+        self.workers = [threading.Thread(target=self.run, name="images-{}".format(id_worker),
+                                         daemon=True)
+                        for id_worker in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, page_url, image_urls, base_url=None):
+        """ Queues the images of a page for download (without waiting for them). Images that were
+        already downloaded are recorded right away (see `crawler.db.BulkWriter.add`).
+
+        Parameters
+        ----------
+        page_url: str
+            URL of the page the images were found on (has to be in the database already)
+
+        image_urls: iterable of str
+            URLs of the images (e.g. `ExtractedPage.images`)
+
+        base_url: str, optional
+            URL that relative image URLs are resolved against (base href of the page).
+            Defaults to `page_url`.
+        """
+        base_url = base_url if base_url is not None else page_url
+        for image_url in dict.fromkeys(absolutize(base_url, image_url) for image_url in image_urls):
+            with self.lock:
+                if image_url in self.waiting_pages:
+                    # still downloading
+                    self.waiting_pages[image_url].append(page_url)
+                    continue
+                state = self.states.get(image_url)
+                if state is None:
+                    self.waiting_pages[image_url] = [page_url]
+                else:
+                    self.states.move_to_end(image_url)
+
+            if state is None:
+                try:
+                    self.queue.put_nowait(image_url)
+                except Full:
+                    with self.lock:
+                        del self.waiting_pages[image_url]
+                        self.num_dropped += 1
+            elif state is not _FAILED:
+                # already downloaded for another page
+                self.num_reused += 1
+                self.add_rows(image_url, state, [page_url])
+
+    def add_rows(self, image_url, blob, page_urls):
+        filename = image_url.rsplit('/', 1)[-1]
+        extension = get_url_extension(image_url)
+        for page_url in page_urls:
+            self.writer.add("image_by_url", (page_url, filename, extension, blob.sha256, blob.size,
+                                             datetime.now()))
+
+    def wait_for_host(self, host):
+        """ Reserves the next free request slot of the host and sleeps until it."""
+        with self.lock:
+            now = time()
+            self.num_reservations += 1
+            if self.num_reservations % HOST_PRUNE_INTERVAL == 0:
+                # a host whose next slot has passed is the same as one that was never requested
+                self.next_request = {other_host: other_slot
+                                     for other_host, other_slot in self.next_request.items()
+                                     if other_slot > now}
+            slot = max(now, self.next_request.get(host, now))
+            self.next_request[host] = slot + self.host_delay
+        if slot > now:
+            sleep(slot - now)
+
+    def download(self, image_url):
+        host = urlparse(image_url).netloc
+        self.wait_for_host(host)
+        with METRICS.timer("image_download", host=host) as labels:
+            response = requests.get(image_url, headers={"User-Agent": USER_AGENT},
+                                    timeout=TIMEOUT_PERIOD, stream=True)
+            labels["status"] = response.status_code
+            if response.status_code != 200:
+                response.close()
+                raise IOError("status code {}".format(response.status_code))
+            blob = self.store.put_stream(response, max_bytes=self.max_bytes)
+        METRICS.count("downloaded_bytes", blob.size, host=host)
+        return blob
+
+    def run(self):
+        while True:
+            image_url = self.queue.get()
+            if image_url is None:
+                self.queue.task_done()
+                return
+
+            try:
+                self.process(image_url)
+            finally:
+                # `join` (and so `close`) must not wait for an image whose worker failed
+                self.queue.task_done()
+
+    def process(self, image_url):
+        """ Downloads an image and records it for the pages that wait for it."""
+        try:
+            blob = self.download(image_url)
+        except Exception as e:
+            print("[ImageDownloader] Failed to retrieve image '{}': {}".format(image_url, e))
+            blob = None
+
+        with self.lock:
+            self.states[image_url] = blob if blob is not None else _FAILED
+            if len(self.states) > self.max_images:
+                self.states.popitem(last=False)
+            page_urls = self.waiting_pages.pop(image_url)
+            if blob is None:
+                self.num_failed += 1
+            else:
+                self.num_downloaded += 1
+        if blob is not None:
+            try:
+                self.add_rows(image_url, blob, page_urls)
+            except Exception as e:
+                # e.g. `crawler.db.WriterFailed` once the database writer gave up
+                print("[ImageDownloader] Failed to record image '{}': {}".format(image_url, e))
+
+    def join(self):
+        """ Waits until all queued images are downloaded."""
+        self.queue.join()
+
+    def close(self):
+        """ Downloads the queued images and stops the download threads."""
+        self.join()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        print("[ImageDownloader] Downloaded {} images ({} reused, {} failed, {} dropped)...".format(
+            self.num_downloaded, self.num_reused, self.num_failed, self.num_dropped))
@@ -1,9 +1,39 @@
 """
 This file contains utility functions for working with URLs.
 """
-from urllib.parse import urlsplit, quote
+from collections import namedtuple, Counter
+from functools import lru_cache
+from urllib.parse import urlsplit, quote, unquote
+import sys
+import threading
 import requests
 
+# maximum number of slashes kept in the path of a canonical URL
+MAX_PATH_DEPTH = 10
+# number of most recently canonicalized URLs that are memoized (same navigation links
+# appear on every page of a site)
+CANONICAL_CACHE_SIZE = 2 ** 16
+# query parameters that never change the content of a page (session IDs, tracking, ...).
+# Names ending with '*' are prefixes.
+DEFAULT_IGNORED_PARAMS = ["utm_*", "fbclid", "gclid", "jsessionid", "phpsessid", "sessionid",
+                          "sid", "cfid", "cftoken"]
+# query parameters that usually select the content of a page (IDs, pagination, search), so they
+# are never learned to be ignorable, even if pages that differ in them look the same (e.g. empty
+# search results or "not found" pages)
+DEFAULT_NEVER_LEARNED_PARAMS = ["id", "page", "p", "q", "query", "search", "s", "lang", "year",
+                                "month", "category", "cat", "tag"]
+
+
+class CanonicalUrl(namedtuple("CanonicalUrl", ["scheme", "host", "path", "query", "url"])):
+    """
+    Compact record of a canonicalized URL. `host` is interned, so records of the same
+    site share a single host string. `url` is the full canonical URL.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return self.url
+
 
 class Links:
 
@@ -119,3 +149,286 @@ class Links:
         url = url.replace("http://www.", "http://")
         url = url.replace("https://www.", "https://")
         return url
+
+    @staticmethod
+    @lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+    def canonicalize(url):
+        """
+        Parses the URL once and returns its canonical form, equivalent to
+        `Links.remove_www(Links.prune_to_max_depth(Links.sanitize(url), 10))` except that
+        the host is lowercased and the fragment is dropped (it never changes the fetched page).
+        Results are memoized in a bounded LRU cache.
+
+        Example:
+
+        >>> Links.canonicalize('HTTP://www.Python.org/doc/?q=1#top')
+        CanonicalUrl(scheme='http', host='python.org', path='/doc/', query='q=1', url='http://python.org/doc/?q=1')
+
+        Parameters:
+        ----------
+
+        url: str
+            Absolute URL.
+
+        Returns:
+        ----------
+        canonical: CanonicalUrl or None
+            The canonical URL or None if the URL is not an absolute http(s) URL.
+        """
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            return None
+
+        scheme = parts.scheme
+        if scheme not in {"http", "https"} or not parts.netloc:
+            return None
+
+        host = parts.netloc.lower()
+        if host.startswith("www."):
+            host = host[4:]
+        host = sys.intern(host)
+
+        path = parts.path
+        if path.count("/") > MAX_PATH_DEPTH:
+            path = "/".join(path.split("/", MAX_PATH_DEPTH + 1)[:MAX_PATH_DEPTH + 1])
+        elif len(path) > 1 and path[-1] == "/" and not parts.query:
+            # trailing slash is only removed if nothing follows it (same as `Links.sanitize`)
+            path = path[:-1]
+        if not path:
+            path = "/"
+
+        canonical_url = "".join([scheme, "://", host, path])
+        if parts.query:
+            canonical_url += "?" + parts.query
+
+        return CanonicalUrl(scheme, host, path, parts.query, canonical_url)
+
+    @staticmethod
+    def canonicalize_all(urls):
+        """
+        Canonicalizes a list of URLs, skipping the ones that are not absolute http(s) URLs.
+
+        Parameters:
+        ----------
+
+        urls: iterable of str
+
+        Returns:
+        ----------
+        canonical: list of CanonicalUrl
+        """
+        canonicalize = Links.canonicalize
+        result = []
+        for url in urls:
+            canonical = canonicalize(url)
+            if canonical is not None:
+                result.append(canonical)
+        return result
+
+
+class CanonicalizationRules:
+    """
+    Rules which collapse equivalent URLs into a single canonical URL before they enter the
+    frontier, so that variants of a page do not get fetched, rendered and only then
+    detected as duplicates.
+
+    On top of `Links.canonicalize`, the rules
+    (1.) sort query parameters (`?b=2&a=1` -> `?a=1&b=2`),
+    (2.) remove ignorable query parameters (globally or per host) and `;jsessionid=...` path
+    parameters,
+    (3.) fold host aliases into a single host and
+    (4.) fold `http` and `https` variants of a host into one scheme (either the configured one
+    or the first one seen for the host).
+
+    If `learn_threshold` is set, a query parameter that is the only difference between a page
+    and the page it was found to be a DUPLICATE of becomes ignorable for the host once this
+    happens `learn_threshold` times with at least `learn_min_values` distinct values of the
+    parameter. Parameters in `never_learned_params` are never learned.
+
+    Example usage:
+
+    > rules = CanonicalizationRules(host_ignored_params={'evem.gov.si': ['stran']})
+    > rules.apply('https://www.evem.gov.si/iskanje?q=a&stran=2&utm_source=x')
+    'https://evem.gov.si/iskanje?q=a'
+    """
+
+    def __init__(self, ignored_params=None, host_ignored_params=None, host_aliases=None,
+                 scheme=None, sort_query=True, learn_threshold=None, learn_min_values=3,
+                 never_learned_params=None, cache_size=CANONICAL_CACHE_SIZE):
+        """
+        Parameters
+        ----------
+        ignored_params: list of str, optional
+            Query parameters removed from every URL. Defaults to `DEFAULT_IGNORED_PARAMS`.
+
+        host_ignored_params: dict of str -> list of str, optional
+            Query parameters removed from URLs of a specific host
+
+        host_aliases: dict of str -> str, optional
+            Maps alias hosts to their canonical host (e.g. {'e-prostor.si': 'e-prostor.gov.si'})
+
+        scheme: str, optional
+            Scheme ('http' or 'https') that all URLs get. If not given, the first scheme seen
+            for a host is used for all of its URLs.
+
+        sort_query: bool
+            Whether to sort query parameters
+
+        learn_threshold: int, optional
+            Number of duplicates after which a differing query parameter becomes ignorable for
+            the host. Learning is disabled if not given.
+
+        learn_min_values: int
+            Number of distinct values a parameter must have been seen with (on duplicates)
+            before it becomes ignorable
+
+        never_learned_params: list of str, optional
+            Query parameters that never become ignorable by learning. Defaults to
+            `DEFAULT_NEVER_LEARNED_PARAMS`.
+
+        cache_size: int
+            Number of memoized results of `apply`
+        """
+        ignored_params = DEFAULT_IGNORED_PARAMS if ignored_params is None else ignored_params
+        self.ignored_params = set()
+        self.ignored_prefixes = []
+        for param in ignored_params:
+            param = param.lower()
+            if param.endswith("*"):
+                self.ignored_prefixes.append(param[:-1])
+            else:
+                self.ignored_params.add(param)
+        self.ignored_prefixes = tuple(self.ignored_prefixes)
+
+        self.host_ignored_params = {host: {param.lower() for param in params}
+                                    for host, params in (host_ignored_params or {}).items()}
+        self.host_aliases = dict(host_aliases or {})
+        self.scheme = scheme
+        self.sort_query = sort_query
+        self.learn_threshold = learn_threshold
+        self.learn_min_values = learn_min_values
+        self.never_learned_params = {param.lower() for param in (
+            DEFAULT_NEVER_LEARNED_PARAMS if never_learned_params is None else never_learned_params)}
+
+        self.host_schemes = {}
+        self.duplicate_param_counts = Counter()
+        # distinct values of every counted parameter (until there are `learn_min_values` of them)
+        self.duplicate_param_values = {}
+        self.lock = threading.Lock()
+        self.apply = lru_cache(maxsize=cache_size)(self._apply)
+
+    @classmethod
+    def from_config(cls, config):
+        """ Creates the rules from the 'canonicalization' section of the crawler config
+        (see `crawler.settings.SettingsReader`)."""
+        options = config.get("canonicalization") or {}
+        return cls(ignored_params=options.get("ignored_params"),
+                   host_ignored_params=options.get("host_ignored_params"),
+                   host_aliases=options.get("host_aliases"),
+                   scheme=options.get("scheme"),
+                   sort_query=options.get("sort_query", True),
+                   learn_threshold=options.get("learn_threshold"),
+                   learn_min_values=options.get("learn_min_values", 3),
+                   never_learned_params=options.get("never_learned_params"))
+
+    def is_ignored(self, param, host):
+        param = unquote(param).lower()
+        return (param in self.ignored_params or param.startswith(self.ignored_prefixes)
+                or param in self.host_ignored_params.get(host, ()))
+
+    def canonical_query(self, query, host):
+        """ Sorts the query parameters and drops the ignorable ones, without re-encoding them."""
+        if not query:
+            return query
+        params = [param for param in query.split("&")
+                  if param and not self.is_ignored(param.split("=", 1)[0], host)]
+        if self.sort_query:
+            # stable sort by name, so repeated parameters keep their relative order
+            params.sort(key=lambda param: param.split("=", 1)[0])
+        return "&".join(params)
+
+    def _apply(self, url):
+        canonical = Links.canonicalize(url)
+        if canonical is None:
+            return None
+
+        host = self.host_aliases.get(canonical.host, canonical.host)
+        scheme = self.scheme or self.host_schemes.setdefault(host, canonical.scheme)
+
+        path = canonical.path
+        if ";" in path:
+            # e.g. /index.jsp;jsessionid=1234
+            segments = path.split(";")
+            path = ";".join([segments[0]] + [segment for segment in segments[1:]
+                                             if not self.is_ignored(segment.split("=", 1)[0], host)])
+
+        query = self.canonical_query(canonical.query, host)
+        if query:
+            return "".join([scheme, "://", host, path, "?", query])
+        return "".join([scheme, "://", host, path])
+
+    def apply_all(self, urls):
+        """ Applies the rules to a list of URLs, skipping the ones that are not http(s) URLs
+        and removing the resulting duplicates (order is preserved)."""
+        result = {}
+        for url in urls:
+            canonical = self.apply(url)
+            if canonical is not None:
+                result[canonical] = None
+        return list(result)
+
+    def observe_duplicate(self, url, original_url):
+        """
+        Learns ignorable query parameters from a page (`url`) that was found to be a duplicate
+        of `original_url`. Only pages with the same host and path that differ in a single query
+        parameter are considered.
+
+        Returns
+        -------
+        list of str:
+            Parameters that became ignorable for the host
+        """
+        if self.learn_threshold is None:
+            return []
+
+        canonical, original = Links.canonicalize(url), Links.canonicalize(original_url)
+        if canonical is None or original is None or \
+                (canonical.host, canonical.path) != (original.host, original.path):
+            return []
+
+        host = self.host_aliases.get(canonical.host, canonical.host)
+        params = set(canonical.query.split("&")) ^ set(original.query.split("&"))
+        values = {}
+        for param in params:
+            name, _, value = param.partition("=")
+            if param and not self.is_ignored(name, host):
+                values.setdefault(unquote(name).lower(), set()).add(value)
+        if len(values) != 1:
+            # with more differences it is not known which parameter did not matter
+            return []
+        (name, values), = values.items()
+        if name in self.never_learned_params:
+            return []
+
+        learned = []
+        with self.lock:
+            if name not in self.host_ignored_params.get(host, ()):
+                # (it could have been learned by another thread in the meantime)
+                self.duplicate_param_counts[host, name] += 1
+                seen = self.duplicate_param_values.setdefault((host, name), set())
+                if len(seen) < self.learn_min_values:
+                    seen.update(values)
+                if self.duplicate_param_counts[host, name] >= self.learn_threshold and \
+                        len(seen) >= self.learn_min_values:
+                    self.host_ignored_params.setdefault(host, set()).add(name)
+                    del self.duplicate_param_values[host, name]
+                    learned.append(name)
+
+            if learned:
+                # memoized results could still contain the newly ignorable parameters
+                self.apply.cache_clear()
+                print("[CanonicalizationRules] Ignoring parameters {} on '{}' from now on...".format(
+                    learned, host))
+
+        return learned
@@ -0,0 +1,288 @@
+"""
+This file contains the memory accounting of the crawler. A `MemoryMonitor` thread regularly
+measures the resident memory (RSS) of the crawler and of its browser processes, estimates the
+size of the crawler's growing structures (visited URLs, link queue, ...) and, if enabled, lists
+the top allocators found by `tracemalloc`.
+
+Soft limits (on the RSS of the crawler or of the browsers) trigger actions, e.g. pausing the
+expansion of sitemaps or restarting the browsers. An action's counterpart (if any) runs once
+the measurement drops below 90% of the limit again. Links of the frontier above a limit are
+moved to the disk with `LinkSpill`.
+
+RSS is read from /proc (Linux). If the psutil package is installed, it is used instead (and
+works on other platforms as well).
+
+Example usage:
+
+> monitor = MemoryMonitor({"visited": lambda: agent.visited}, interval=60,
+>                         limits={"rss_mb": 4096}, actions={"rss_mb": (pause, resume)})
+> monitor.start()
+"""
+import os
+import sys
+import threading
+import tracemalloc
+from itertools import islice
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# a limit is lifted once the measurement drops below this share of it
+RECOVERY_RATIO = 0.9
+
+
+def process_rss(pid=None):
+    """ Resident memory (in bytes) of a process (the current one by default), or 0 if unknown."""
+    pid = pid if pid is not None else os.getpid()
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return 0
+    try:
+        with open("/proc/{}/status".format(pid)) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def descendant_pids(pid=None):
+    """ Ids of all (direct and indirect) child processes of a process (the current one by
+    default), e.g. chromedriver and the browsers it started."""
+    pid = pid if pid is not None else os.getpid()
+    if psutil is not None:
+        try:
+            return [child.pid for child in psutil.Process(pid).children(recursive=True)]
+        except psutil.Error:
+            return []
+
+    children = {}
+    try:
+        proc_entries = os.listdir("/proc")
+    except OSError:
+        return []
+    for entry in proc_entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as stat:
+                # the name (2nd field) is in parentheses and can contain spaces
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    descendants = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            descendants.append(child)
+            stack.append(child)
+    return descendants
+
+
+def estimate_size(obj, sample_size=1000):
+    """ Estimated size (in bytes) of a container and its items (keys and values of a dict),
+    extrapolated from a sample of the items, so large containers are measured quickly."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        items = list(islice(obj.items(), sample_size))
+        item_size = sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in items)
+    elif isinstance(obj, (set, frozenset, list, tuple)):
+        items = list(islice(obj, sample_size))
+        item_size = sum(sys.getsizeof(item) for item in items)
+    else:
+        return size
+    if items:
+        size += item_size * len(obj) // len(items)
+    return size
+
+
+class LinkSpill:
+
+    def __init__(self, directory, name="links"):
+        """ First-in first-out store of links on the disk (one URL per line), for links that
+        do not fit into memory.
+
+        Parameters
+        ----------
+        directory: str
+            Directory of the spill file (created when the first links are spilled)
+
+        name: str
+            Name of the spill file (spills of a process that share a directory need different
+            names)
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, "{}-{}.txt".format(name, os.getpid()))
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def add(self, links):
+        links = list(links)
+        if not links:
+            return
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as spill_file:
+                spill_file.writelines(link + "\n" for link in links)
+            self.pending += len(links)
+
+    def load(self, max_links):
+        """ Removes (at most `max_links`) links from the spill, in the order they were added."""
+        with self.lock:
+            if self.pending == 0:
+                return []
+            with open(self.path, encoding="utf-8") as spill_file:
+                spill_file.seek(self.offset)
+                links = []
+                while len(links) < max_links:
+                    line = spill_file.readline()
+                    if not line:
+                        break
+                    links.append(line.rstrip("\n"))
+                self.offset = spill_file.tell()
+            self.pending -= len(links)
+            if self.pending == 0:
+                os.remove(self.path)
+                self.offset = 0
+            return links
+
+
+class MemoryMonitor:
+
+    def __init__(self, structures, interval=60, limits=None, actions=None, tracemalloc_frames=0,
+                 top=10, browser_pids=None):
+        """
+        Parameters
+        ----------
+        structures: dict
+            Name -> function returning the structure (container) whose size is reported
+
+        interval: float
+            Time (in seconds) between two measurements
+
+        limits: dict, optional
+            Soft limits: 'rss_mb' (RSS of the crawler, without its child processes) and/or
+            'browser_rss_mb' (RSS of the browsers, see `browser_pids`) -> megabytes. 0 disables
+            a limit.
+
+        actions: dict, optional
+            Name of a limit -> (function called when the limit is exceeded, function called
+            when the measurement drops below it again or None). The first function is called
+            after every measurement while the limit is exceeded.
+
+        tracemalloc_frames: int
+            If positive, Python allocations are traced (with this many frames per allocation)
+            and the top allocators are reported. Tracing slows the crawler down.
+
+        top: int
+            Number of reported allocators
+
+        browser_pids: function, optional
+            Returns the ids of the processes that started the browsers (e.g. chromedriver);
+            they and their child processes make up 'browser_rss_mb'. Other child processes
+            (e.g. analysis workers) are not counted. If not given, all child processes are
+            counted.
+        """
+        self.structures = structures
+        self.interval = interval
+        self.limits = {name: limit for name, limit in (limits or {}).items() if limit}
+        self.actions = actions or {}
+        self.tracemalloc_frames = tracemalloc_frames
+        self.top = top
+        self.browser_pids = browser_pids
+        self.exceeded = set()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.tracemalloc_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+        self.thread = threading.Thread(target=self.run, name="memory-monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.tracemalloc_frames > 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check(self.report())
+            except Exception as e:
+                print("[MemoryMonitor] Measurement failed: {}".format(e))
+
+    def measure(self):
+        """
+        Returns
+        -------
+        dict:
+            'rss_mb' and 'browser_rss_mb' (megabytes) and 'structures': name -> (number of
+            items, estimated megabytes)
+        """
+        structures = {}
+        for name, get_structure in self.structures.items():
+            # the structures are used by other threads, so one can change while it is measured
+            for _ in range(3):
+                try:
+                    structure = get_structure()
+                    structures[name] = (len(structure), estimate_size(structure) / 2 ** 20)
+                    break
+                except RuntimeError:
+                    continue
+        if self.browser_pids is not None:
+            pids = []
+            for pid in self.browser_pids():
+                pids.append(pid)
+                pids.extend(descendant_pids(pid))
+        else:
+            pids = descendant_pids()
+        return {"rss_mb": process_rss() / 2 ** 20,
+                "browser_rss_mb": sum(process_rss(pid) for pid in pids) / 2 ** 20,
+                "structures": structures}
+
+    def report(self):
+        """ Prints (and returns) the measurements (see `measure`)."""
+        measurements = self.measure()
+        print("[MemoryMonitor] RSS: {:.0f} MB, browsers: {:.0f} MB".format(
+            measurements["rss_mb"], measurements["browser_rss_mb"]))
+        for name, (num_items, size_mb) in sorted(measurements["structures"].items(),
+                                                 key=lambda item: -item[1][1]):
+            print("[MemoryMonitor] {:<16}{:>10} items{:>10.1f} MB".format(name, num_items, size_mb))
+        if tracemalloc.is_tracing():
+            for statistic in tracemalloc.take_snapshot().statistics("lineno")[:self.top]:
+                print("[MemoryMonitor] {:>10.1f} MB in {} allocations at {}".format(
+                    statistic.size / 2 ** 20, statistic.count, statistic.traceback[0]))
+        return measurements
+
+    def check(self, measurements):
+        """ Runs the actions of exceeded limits (and their counterparts for limits that are
+        no longer exceeded)."""
+        for name, limit in self.limits.items():
+            on_exceeded, on_recovered = self.actions.get(name, (None, None))
+            value = measurements[name]
+            if value > limit:
+                if name not in self.exceeded:
+                    print("[MemoryMonitor] Soft limit '{}' exceeded ({:.0f} > {})...".format(
+                        name, value, limit))
+                self.exceeded.add(name)
+                if on_exceeded is not None:
+                    on_exceeded()
+            elif name in self.exceeded and value < RECOVERY_RATIO * limit:
+                print("[MemoryMonitor] Back under soft limit '{}' ({:.0f})...".format(name, value))
+                self.exceeded.discard(name)
+                if on_recovered is not None:
+                    on_recovered()
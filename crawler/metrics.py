@@ -0,0 +1,287 @@
+"""
+This file contains the crawler's instrumentation: counters and latency histograms of the
+crawl stages, tagged with labels (host, status, ...). Recording a value is a dictionary lookup
+and a few additions under a lock, so every page and every request can be measured.
+
+Stages measured by the crawler (see `crawler.core`, `crawler.db` and `crawler.images`):
+connect (DNS, TCP and TLS), fetch, render, parse, lsh, dedup, difflib, db_write, download,
+image_download and page (of fetched pages, from entering the crawl, incl. waiting for the
+crawl delay and in the queues of the pipeline, until the page is finished).
+
+The metrics are available as a periodic summary (`Metrics.report`), as JSON
+(`Metrics.snapshot`) and in the Prometheus text format (`Metrics.to_text`), both served over
+HTTP by `MetricsServer` (/metrics and /metrics.json).
+
+Example usage:
+
+> with METRICS.timer("fetch", host="evem.gov.si") as labels:
+>     response = requests.get("http://evem.gov.si/")
+>     labels["status"] = response.status_code
+> METRICS.count("pages", host="evem.gov.si")
+> METRICS.report()
+"""
+import json
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# upper bounds (in seconds) of the histogram buckets: 0.5 ms, 1 ms, 2 ms, ..., ~131 s
+BUCKETS = [0.0005 * 2 ** idx for idx in range(19)]
+
+
+class Histogram:
+
+    def __init__(self):
+        # the last bucket holds everything above BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ Estimate of the q-quantile (interpolated within its bucket)."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx_bucket, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = BUCKETS[idx_bucket - 1] if idx_bucket > 0 else 0.0
+                upper = BUCKETS[idx_bucket] if idx_bucket < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+    def stats(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+                "max": self.max}
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        """ Adds `value` to a counter."""
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """ Records a duration (in seconds) into a histogram."""
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Measures the duration of a with block. The block gets the labels and can add to
+        them (e.g. the status, once it is known). If the block raises an exception, the status
+        is 'error' (unless it was set already)."""
+        start = perf_counter()
+        try:
+            yield labels
+        except BaseException:
+            labels.setdefault("status", "error")
+            raise
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict:
+            'counters': list of {'name', 'labels', 'value'} and
+            'histograms': list of {'name', 'labels', 'count', 'sum', 'mean', 'p50', 'p90', 'p99',
+            'max'} (durations in seconds)
+        """
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in self.counters.items()]
+            histograms = [dict(name=name, labels=dict(labels), **histogram.stats())
+                          for (name, labels), histogram in self.histograms.items()]
+        return {"counters": counters, "histograms": histograms}
+
+    def totals(self):
+        """ Histograms merged over all labels.
+
+        Returns
+        -------
+        dict:
+            Name -> stats (see `Histogram.stats`)
+        """
+        merged = {}
+        with self.lock:
+            for (name, _), histogram in self.histograms.items():
+                total = merged.setdefault(name, Histogram())
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.count += histogram.count
+                total.sum += histogram.sum
+                total.max = max(total.max, histogram.max)
+        return {name: histogram.stats() for name, histogram in merged.items()}
+
+    def to_text(self):
+        """ Metrics in the Prometheus text format."""
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(name, value.replace('"', '\\"'))
+                                  for name, value in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("crawler_{}_total{} {}".format(name, format_labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + ["+Inf"], histogram.counts):
+                    cumulative += bucket_count
+                    lines.append("crawler_{}_seconds_bucket{} {}".format(
+                        name, format_labels(labels, [("le", str(bound))]), cumulative))
+                lines.append("crawler_{}_seconds_sum{} {}".format(name, format_labels(labels),
+                                                                  histogram.sum))
+                lines.append("crawler_{}_seconds_count{} {}".format(name, format_labels(labels),
+                                                                    histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        """ Prints the number of measurements, the total time and latencies of every stage."""
+        totals = self.totals()
+        if not totals:
+            return
+        lines = ["[Metrics] {:<16}{:>9}{:>11}{:>10}{:>10}{:>10}{:>10}".format(
+            "stage", "count", "total s", "mean ms", "p50 ms", "p99 ms", "max ms")]
+        for name, stats in sorted(totals.items(), key=lambda item: -item[1]["sum"]):
+            lines.append("[Metrics] {:<16}{:>9}{:>11.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                name, stats["count"], stats["sum"], 1000 * stats["mean"], 1000 * stats["p50"],
+                1000 * stats["p99"], 1000 * stats["max"]))
+        print("\n".join(lines))
+
+    def report_periodically(self, interval, stopped):
+        """ Prints a report every `interval` seconds until the `stopped` event is set."""
+        while not stopped.wait(interval):
+            self.report()
+
+
+# metrics of the whole process
+METRICS = Metrics()
+
+
+class MetricsServer:
+
+    def __init__(self, metrics, host="127.0.0.1", port=9100):
+        """ Serves the metrics over HTTP (in a background thread): /metrics in the Prometheus
+        text format and /metrics.json as JSON (see `Metrics.snapshot`).
+
+        Parameters
+        ----------
+        metrics: Metrics
+
+        host: str
+            Address to listen on (only local by default)
+
+        port: int
+            Port to listen on
+        """
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode("utf-8")
+                    content_type = "application/json"
+                elif self.path == "/metrics":
+                    body = metrics.to_text().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server",
+                                       daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """ Connection that records the time of opening it (DNS lookup and TCP connect) as 'connect'."""
+    def connect(self):
+        with METRICS.timer("connect", host=self.host):
+            super().connect()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """ Connection that records the time of opening it (DNS lookup, TCP connect and TLS
+    handshake) as 'connect'."""
+    def connect(self):
+        with METRICS.timer("connect", host=self.host):
+            super().connect()
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """ Transport adapter for `requests` sessions whose connections record their opening time:
+
+    > session = requests.Session()
+    > session.mount("http://", TimedHTTPAdapter())
+    > session.mount("https://", TimedHTTPAdapter())
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                   "https": TimedHTTPSConnectionPool}
@@ -0,0 +1,129 @@
+"""
+This file contains the Page class, which holds everything the crawler knows about a
+single fetched page. Derived artifacts (decoded text, lowercased text, extracted links,
+LSH signature, fingerprint) are computed lazily, at most once, so that every stage of
+the crawl can share the same object instead of recomputing them.
+"""
+import hashlib
+from functools import cached_property
+from time import perf_counter
+from urllib.parse import urlparse
+
+from crawler.extract import extract_page
+
+
+class Page:
+
+    def __init__(self, url, status_code=None, headers=None, raw=None, text=None, encoding=None):
+        """
+        Parameters
+        ----------
+        url: str
+            URL of the page
+
+        status_code: int, optional
+            HTTP status code of the response
+
+        headers: dict-like, optional
+            HTTP response headers
+
+        raw: bytes, optional
+            Raw body of the HTTP response
+
+        text: str, optional
+            Decoded (or rendered) content of the page. If not given, it gets decoded from
+            `raw` when first needed.
+
+        encoding: str, optional
+            Encoding used to decode `raw`. Defaults to UTF-8.
+        """
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers if headers is not None else {}
+        self.raw = raw
+        self.encoding = encoding
+        if text is not None:
+            self.text = text
+        # LSH signature, once computed (see `lsh_hash` and `crawler.analysis.Analyzer`)
+        self.signature = None
+        # future of the analysis in a worker process, until it is stored into the page (see
+        # `crawler.analysis.Analyzer.start`)
+        self.analysis = None
+        # canonical links in scope, found while crawling the page (and its site's sitemap)
+        self.new_links = []
+        # streamed response whose body was not read yet (binary content, see `crawler.download`)
+        self.response = None
+        # HTML rendered by the browser (replaces the content of the page, see `text`)
+        self.rendered = None
+        # blob of the downloaded body of binary content (see `crawler.blobstore.BlobStore`)
+        self.blob = None
+        # when the page entered the crawl (for its latency, see `crawler.metrics`)
+        self.created = perf_counter()
+
+    def close(self):
+        """ Closes the streamed response, if its body was not downloaded."""
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    @cached_property
+    def parsed_url(self):
+        """ Parsed URL of the page, shared by all stages instead of parsing it in each of them."""
+        return urlparse(self.url)
+
+    @property
+    def site_url(self):
+        """ Host of the page (robots.txt and crawl delays are kept per host)."""
+        return self.parsed_url.netloc
+
+    @property
+    def content_type(self):
+        return self.headers.get("Content-Type")
+
+    @cached_property
+    def text(self):
+        """ Decoded content of the page."""
+        if self.raw is None:
+            return None
+        return self.raw.decode(self.encoding or "utf-8", errors="replace")
+
+    @cached_property
+    def html(self):
+        """ HTML that gets stored into the database and used for duplicate detection."""
+        return self.text
+
+    @cached_property
+    def lowered(self):
+        """ Lowercased HTML, used for similarity comparisons."""
+        return self.html.lower() if self.html is not None else None
+
+    @cached_property
+    def extracted(self):
+        """ Base href, links and images of the page (see `crawler.extract.extract_page`)."""
+        return extract_page(self.html, self.url)
+
+    @cached_property
+    def fingerprint(self):
+        """ SHA-256 hex digest of the HTML, identical for byte-identical pages. It is the same as
+        `crawler.db.html_hash`, so it serves both as the key of the HTML in html_store and to spot
+        exact duplicates without comparing the pages."""
+        if self.html is None:
+            return None
+        return hashlib.sha256(self.html.encode("utf-8")).hexdigest()
+
+    def lsh_hash(self, lsh_obj):
+        """ LSH signature of the HTML as stored in the database (computed only once).
+
+        Parameters
+        ----------
+        lsh_obj: crawler.lsh.LocalitySensitiveHashing
+            LSH object used to compute the signature
+
+        Returns
+        -------
+        str:
+            Signature, concatenated into a string
+        """
+        if self.signature is None and self.html is not None:
+            self.signature = "".join(map(str, lsh_obj.compute_signature(self.html)))
+        return self.signature
@@ -0,0 +1,421 @@
+"""
+This file contains the multi-process crawl mode. Threads of a single `Agent` share one
+interpreter (and its GIL), so parsing and LSH signatures of all workers run on a single core.
+Here, a coordinator runs N worker processes (each with its own `Agent`) and assigns every host
+to exactly one of them by consistent hashing. The owning process keeps all of the host's
+state: politeness (last crawl time), robots.txt and the set of visited URLs (a dedup shard),
+so processes never need to agree on anything but the assignment.
+
+Links to hosts owned by other processes are sent to the coordinator in batches, which routes
+them (again in batches) to the owners. When a process is added or removed (`Coordinator.scale`),
+only the hosts whose position on the ring changed move: the old owner hands their pending and
+visited URLs over to the new one.
+
+Example usage:
+
+> coordinator = Coordinator(["http://evem.gov.si", "http://e-prostor.gov.si"], num_processes=4,
+>                           agent_options={"num_workers": 5, "get_files": True})
+> coordinator.run()
+"""
+import hashlib
+import multiprocessing
+from bisect import bisect
+from queue import Empty
+
+from crawler.links import Links, CanonicalizationRules
+from crawler.settings import SettingsReader
+
+# messages, sent as (kind, ...) tuples:
+# coordinator -> worker: (LINKS, urls), (VISITED, urls), (RING, nodes), (STOP,), (EXIT,)
+# worker -> coordinator: (LINKS, sender, urls), (VISITED, sender, urls),
+#                        (IDLE, sender, num_received), (DONE, sender, num_crawled)
+LINKS = "links"
+VISITED = "visited"
+RING = "ring"
+IDLE = "idle"
+STOP = "stop"
+EXIT = "exit"
+DONE = "done"
+
+
+class HashRing:
+
+    def __init__(self, nodes=(), replicas=100):
+        """
+        Parameters
+        ----------
+        nodes: iterable
+            Initial nodes (anything with a stable `str`, e.g. ids of processes)
+
+        replicas: int
+            Number of virtual nodes (positions on the ring) per node. More replicas spread the
+            hosts more evenly.
+        """
+        self.replicas = replicas
+        self.nodes = set()
+        self.positions = []
+        self.owners = []
+        # memoized host -> node lookups (hosts repeat for almost every link)
+        self.host_nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def position(key):
+        # stable across processes and runs, unlike `hash`
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def rebuild(self):
+        points = sorted((HashRing.position("{}#{}".format(node, replica)), node)
+                        for node in self.nodes for replica in range(self.replicas))
+        self.positions = [position for position, _ in points]
+        self.owners = [node for _, node in points]
+        self.host_nodes = {}
+
+    def add(self, node):
+        self.nodes.add(node)
+        self.rebuild()
+
+    def remove(self, node):
+        self.nodes.discard(node)
+        self.rebuild()
+
+    def node_for(self, host):
+        """ Returns the node that owns the host or None if the ring is empty."""
+        try:
+            return self.host_nodes[host]
+        except KeyError:
+            pass
+
+        if not self.positions:
+            return None
+        idx = bisect(self.positions, HashRing.position(host)) % len(self.positions)
+        node = self.owners[idx]
+        self.host_nodes[host] = node
+        return node
+
+    def partition(self, urls):
+        """
+        Parameters
+        ----------
+        urls: iterable of str
+            URLs to be partitioned
+
+        Returns
+        -------
+        dict:
+            Node -> list of its URLs (URLs that are not valid HTTP(S) URLs are dropped)
+        """
+        partitions = {}
+        for url in urls:
+            canonical = Links.canonicalize(url)
+            if canonical is None:
+                continue
+            partitions.setdefault(self.node_for(canonical.host), []).append(url)
+        return partitions
+
+
+class PartitionWorker:
+
+    def __init__(self, partition_id, ring, inbox, outbox, agent, batch_size=100):
+        """ Crawls the hosts of a single partition (runs inside a worker process).
+
+        Parameters
+        ----------
+        partition_id: int
+            Id of the partition (its node on the ring)
+
+        ring: HashRing
+            Current assignment of hosts to partitions
+
+        inbox: multiprocessing.Queue
+            Messages from the coordinator
+
+        outbox: multiprocessing.Queue
+            Messages to the coordinator (shared by all workers)
+
+        agent: crawler.core.Agent
+            Agent that crawls the partition's URLs
+
+        batch_size: int
+            Maximum number of URLs per message to the coordinator
+        """
+        self.partition_id = partition_id
+        self.ring = ring
+        self.inbox = inbox
+        self.outbox = outbox
+        self.agent = agent
+        self.batch_size = batch_size
+        # owned URLs waiting for the next level of crawling
+        self.pending = set()
+        # number of LINKS messages received (lets the coordinator tell when everyone is done)
+        self.num_received = 0
+        self.running = True
+
+    def owns(self, url):
+        canonical = Links.canonicalize(url)
+        return canonical is not None and self.ring.node_for(canonical.host) == self.partition_id
+
+    def send(self, kind, urls):
+        urls = list(urls)
+        for idx in range(0, len(urls), self.batch_size):
+            self.outbox.put((kind, self.partition_id, urls[idx: idx + self.batch_size]))
+
+    def route(self, urls):
+        """ Keeps owned URLs that were not crawled yet and sends the rest to their owners."""
+        foreign = []
+        for url in urls:
+            if not self.owns(url):
+                foreign.append(url)
+            elif url not in self.agent.visited:
+                self.pending.add(url)
+        self.send(LINKS, foreign)
+
+    def hand_over(self, keep_owned=True):
+        """ Sends pending and visited URLs of hosts that this partition no longer owns to the
+        coordinator. Visited URLs go first, so the new owner knows them before it gets links."""
+        owned = self.owns if keep_owned else (lambda url: False)
+        visited = [url for url in self.agent.visited if not owned(url)]
+        pending = [url for url in self.pending if not owned(url)]
+        self.agent.visited.difference_update(visited)
+        self.pending.difference_update(pending)
+        self.send(VISITED, visited)
+        self.send(LINKS, pending)
+
+    def handle(self, message):
+        kind = message[0]
+        if kind == LINKS:
+            self.num_received += 1
+            self.route(message[1])
+        elif kind == VISITED:
+            self.agent.visited.update(message[1])
+        elif kind == RING:
+            print("[PartitionWorker] Partition {} got a new ring with {} partitions...".format(
+                self.partition_id, len(message[1])))
+            self.ring = HashRing(message[1], self.ring.replicas)
+            self.hand_over()
+        elif kind == STOP:
+            # partition is being removed: everything goes to the remaining partitions
+            self.hand_over(keep_owned=False)
+            self.running = False
+        elif kind == EXIT:
+            self.running = False
+
+    def run(self):
+        from crawler.core import Agent
+
+        while self.running:
+            if not self.pending and not self.agent.retry_queue:
+                # nothing to crawl: tell the coordinator and wait for work
+                self.outbox.put((IDLE, self.partition_id, self.num_received))
+                self.handle(self.inbox.get())
+
+            # handle all waiting messages before crawling the next level
+            while self.running:
+                try:
+                    self.handle(self.inbox.get_nowait())
+                except Empty:
+                    break
+
+            if not self.running or not (self.pending or self.agent.retry_queue):
+                continue
+
+            # failed pages were already counted, so they are still retried
+            if self.agent.visited_uniq_links >= Agent.MAX_CRAWLED_PAGES and self.pending:
+                print("[PartitionWorker] Partition {} reached the maximum number of crawled "
+                      "pages...".format(self.partition_id))
+                self.pending = set()
+                continue
+
+            print("[PartitionWorker] Partition {} crawling {} pages...".format(
+                self.partition_id, len(self.pending)))
+            self.agent.link_queue = self.pending
+            self.pending = set()
+            self.agent.crawl_level()
+            new_links, self.agent.link_queue = self.agent.link_queue, set()
+            self.route(new_links)
+
+        self.outbox.put((DONE, self.partition_id, self.agent.visited_uniq_links))
+
+
+def run_partition(partition_id, nodes, inbox, outbox, agent_options, batch_size, replicas):
+    """ Entry point of a worker process (must be picklable, so it is a module-level function)."""
+    from crawler.core import Agent
+
+    agent = Agent(seed_pages=[], **agent_options)
+    worker = PartitionWorker(partition_id, HashRing(nodes, replicas), inbox, outbox, agent,
+                             batch_size=batch_size)
+    try:
+        worker.run()
+    finally:
+        agent.close()
+
+
+class Coordinator:
+
+    def __init__(self, seed_pages, num_processes, agent_options=None, batch_size=100, replicas=100):
+        """
+        Parameters
+        ----------
+        seed_pages: list of str
+            URLs that the crawl starts from
+
+        num_processes: int
+            Number of worker processes (each runs an `Agent` with its own threads)
+
+        agent_options: dict, optional
+            Keyword arguments for the `Agent` of every process (e.g. `num_workers`)
+
+        batch_size: int
+            Maximum number of URLs per message between processes
+
+        replicas: int
+            Number of virtual nodes per process on the hash ring
+        """
+        # canonicalized the same way an `Agent` canonicalizes its seed pages
+        self.seed_pages = CanonicalizationRules.from_config(SettingsReader.config).apply_all(seed_pages)
+        self.num_processes = num_processes
+        self.agent_options = agent_options if agent_options is not None else {}
+        self.batch_size = batch_size
+        # 'spawn' so workers do not inherit the coordinator's threads, sockets etc.
+        self.context = multiprocessing.get_context("spawn")
+        self.outbox = self.context.Queue()
+        self.ring = HashRing(replicas=replicas)
+        self.processes = {}
+        self.inboxes = {}
+        # LINKS messages sent to each partition and the count each one reported when idle
+        self.num_sent = {}
+        self.num_idle = {}
+        # partitions that were asked to stop but did not hand their URLs over yet
+        self.leaving = set()
+        self.next_id = 0
+        self.num_crawled = 0
+
+    def start_process(self):
+        partition_id = self.next_id
+        self.next_id += 1
+        self.ring.add(partition_id)
+        inbox = self.context.Queue()
+        process = self.context.Process(target=run_partition,
+                                       args=(partition_id, sorted(self.ring.nodes), inbox,
+                                             self.outbox, self.agent_options, self.batch_size,
+                                             self.ring.replicas),
+                                       name="partition-{}".format(partition_id))
+        process.start()
+        self.processes[partition_id] = process
+        self.inboxes[partition_id] = inbox
+        self.num_sent[partition_id] = 0
+        self.num_idle[partition_id] = None
+        print("[Coordinator] Started partition {}...".format(partition_id))
+        return partition_id
+
+    def stop_process(self, partition_id):
+        self.ring.remove(partition_id)
+        self.leaving.add(partition_id)
+        self.inboxes[partition_id].put((STOP,))
+        print("[Coordinator] Stopping partition {}...".format(partition_id))
+
+    def broadcast_ring(self):
+        nodes = sorted(self.ring.nodes)
+        for partition_id in nodes:
+            self.inboxes[partition_id].put((RING, nodes))
+
+    def scale(self, num_processes):
+        """ Sets the number of worker processes. Hosts get rebalanced at the next step of `run`."""
+        self.num_processes = max(1, num_processes)
+
+    def reconcile(self):
+        active = sorted(self.ring.nodes)
+        if len(active) == self.num_processes:
+            return
+        while len(self.ring.nodes) < self.num_processes:
+            self.start_process()
+        for partition_id in active[self.num_processes:]:
+            self.stop_process(partition_id)
+        self.broadcast_ring()
+
+    def remove(self, partition_id):
+        process = self.processes.pop(partition_id, None)
+        if process is not None:
+            process.join()
+        self.ring.remove(partition_id)
+        self.inboxes.pop(partition_id, None)
+        self.num_sent.pop(partition_id, None)
+        self.num_idle.pop(partition_id, None)
+        self.leaving.discard(partition_id)
+
+    def reap(self):
+        """ Removes partitions whose process died without saying goodbye. Their pending URLs are
+        lost, their hosts move to the remaining partitions."""
+        crashed = [partition_id for partition_id, process in self.processes.items()
+                   if process.exitcode not in (None, 0)]
+        for partition_id in crashed:
+            print("[Coordinator] Partition {} exited unexpectedly with code {}...".format(
+                partition_id, self.processes[partition_id].exitcode))
+            self.remove(partition_id)
+        if crashed:
+            self.broadcast_ring()
+
+    def send(self, kind, urls):
+        for partition_id, owned in self.ring.partition(urls).items():
+            if partition_id not in self.inboxes:
+                continue
+            if kind == LINKS:
+                self.num_sent[partition_id] += 1
+            self.inboxes[partition_id].put((kind, owned))
+
+    def finished(self):
+        return not self.leaving and all(self.num_idle[partition_id] == self.num_sent[partition_id]
+                                        for partition_id in self.ring.nodes)
+
+    def handle(self, message):
+        kind, sender = message[0], message[1]
+        if kind in (LINKS, VISITED):
+            self.send(kind, message[2])
+        elif kind == IDLE:
+            self.num_idle[sender] = message[2]
+        elif kind == DONE:
+            self.num_crawled += message[2]
+            self.remove(sender)
+            print("[Coordinator] Partition {} finished after crawling {} pages...".format(
+                sender, message[2]))
+
+        # any message from a partition means it is not idle anymore, unless it says so
+        if kind != IDLE and sender in self.num_idle:
+            self.num_idle[sender] = None
+
+    def run(self, poll_interval=1.0):
+        """ Crawls until no partition has anything left to crawl.
+
+        Parameters
+        ----------
+        poll_interval: float
+            Time (in seconds) between checks for changes in the number of processes
+        """
+        self.reconcile()
+        self.send(LINKS, self.seed_pages)
+        try:
+            while not self.finished():
+                try:
+                    self.handle(self.outbox.get(timeout=poll_interval))
+                except Empty:
+                    self.reap()
+                self.reconcile()
+        finally:
+            self.shutdown()
+        print("[Coordinator] Crawled {} pages with {} partitions...".format(
+            self.num_crawled, self.next_id))
+
+    def shutdown(self, poll_interval=1.0):
+        """ Stops all processes (links that are still being sent around are dropped)."""
+        self.ring = HashRing(replicas=self.ring.replicas)
+        for inbox in self.inboxes.values():
+            inbox.put((EXIT,))
+        while self.processes:
+            try:
+                message = self.outbox.get(timeout=poll_interval)
+            except Empty:
+                self.reap()
+                continue
+            if message[0] == DONE:
+                self.handle(message)
@@ -0,0 +1,183 @@
+"""
+This file contains a staged pipeline: a chain of stages connected by bounded queues, each
+stage with its own number of worker threads. A slow stage (e.g. rendering) only fills up its
+own queue; once the queue is full, the stage before it blocks (backpressure), so the number
+of items held in memory never exceeds the sum of the queue sizes.
+
+A stage function takes an item and returns True if the item should continue to the next
+stage or False if it is finished. Items that finish (early, at the end or with an error) are
+passed to `on_finish`.
+
+Example usage:
+
+> pipeline = Pipeline([Stage("fetch", fetch, workers=10, queue_size=100),
+>                      Stage("render", render, workers=2, queue_size=20)],
+>                     on_finish=print)
+> pipeline.start()
+> for item in items:
+>     pipeline.put(item)
+> pipeline.join()
+> pipeline.report()
+"""
+import threading
+from queue import Queue
+
+# tells a stage worker to exit
+_STOP = object()
+
+
+class Stage:
+
+    def __init__(self, name, function, workers=1, queue_size=100):
+        """
+        Parameters
+        ----------
+        name: str
+            Name of the stage (used in stats)
+
+        function: callable
+            Function that processes an item. Returns True if the item should be passed on.
+
+        workers: int
+            Number of threads that run `function`
+
+        queue_size: int
+            Maximum number of items waiting for the stage
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue = Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.processed = 0
+        self.finished = 0
+        self.failed = 0
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict:
+            Queue depth and size, busy and all workers, and numbers of processed items,
+            items that finished in this stage and items that failed
+        """
+        return {"queued": self.queue.qsize(), "queue_size": self.queue.maxsize,
+                "busy": self.busy, "workers": self.workers, "processed": self.processed,
+                "finished": self.finished, "failed": self.failed}
+
+
+class Pipeline:
+
+    def __init__(self, stages, on_finish=None):
+        """
+        Parameters
+        ----------
+        stages: list of Stage
+            Stages in the order in which items pass them
+
+        on_finish: callable, optional
+            Called with every item that leaves the pipeline
+        """
+        self.stages = stages
+        self.on_finish = on_finish
+        self.threads = []
+        self.reporter = None
+        self.stopped = threading.Event()
+
+    def start(self, report_interval=None):
+        """ Starts the workers of all stages.
+
+        Parameters
+        ----------
+        report_interval: float, optional
+            If given, stats of the stages are printed every `report_interval` seconds
+        """
+        for idx_stage, stage in enumerate(self.stages):
+            next_stage = self.stages[idx_stage + 1] if idx_stage + 1 < len(self.stages) else None
+            for id_worker in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(stage, next_stage),
+                                          name="{}-{}".format(stage.name, id_worker), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+        if report_interval:
+            self.reporter = threading.Thread(target=self.report_periodically,
+                                             args=(report_interval,), daemon=True)
+            self.reporter.start()
+
+    def work(self, stage, next_stage):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                stage.queue.task_done()
+                return
+
+            with stage.lock:
+                stage.busy += 1
+            passed = False
+            try:
+                passed = stage.function(item)
+            except Exception as e:
+                print("[Pipeline] Stage '{}' failed for {}: {}".format(stage.name, item, e))
+                with stage.lock:
+                    stage.failed += 1
+
+            with stage.lock:
+                stage.busy -= 1
+                stage.processed += 1
+                if not passed or next_stage is None:
+                    stage.finished += 1
+
+            # the item is handed on before it is marked as done, so `join` never misses it
+            if passed and next_stage is not None:
+                next_stage.queue.put(item)
+            else:
+                self.finish(item)
+            stage.queue.task_done()
+
+    def finish(self, item):
+        if self.on_finish is not None:
+            try:
+                self.on_finish(item)
+            except Exception as e:
+                print("[Pipeline] Finishing {} failed: {}".format(item, e))
+
+    def put(self, item):
+        """ Adds an item to the first stage (blocks while its queue is full)."""
+        self.stages[0].queue.put(item)
+
+    def join(self):
+        """ Waits until every item that was put into the pipeline has left it."""
+        # items only move forward, so once a stage is empty nothing can enter it again
+        for stage in self.stages:
+            stage.queue.join()
+
+    def stop(self):
+        """ Waits for the items in the pipeline and stops the workers."""
+        self.join()
+        for stage in self.stages:
+            for _ in range(stage.workers):
+                stage.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.stopped.set()
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict:
+            Stage name -> stats of the stage (see `Stage.stats`)
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def report(self):
+        print("[Pipeline] " + " | ".join(
+            "{}: {queued}/{queue_size} queued, {busy}/{workers} busy, {processed} done".format(
+                name, **stats) for name, stats in self.stats().items()))
+
+    def report_periodically(self, interval):
+        while not self.stopped.wait(interval):
+            self.report()
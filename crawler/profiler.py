@@ -0,0 +1,171 @@
+"""
+This file contains a sampling profiler for a running crawl. Once started (by a signal, see
+`install_signal_handler`, or after a delay set in the settings), a background thread takes
+the stacks of all threads (`sys._current_frames`) every `interval` seconds for `duration`
+seconds. Nothing runs while the profiler is not sampling.
+
+Samples are grouped by the role of their thread, which is its name without the number
+('fetch-3' -> 'fetch', 'images-0' -> 'images', 'Thread-7 (worker_task)' -> 'worker_task'),
+and written into one file per role in the collapsed stack format (one line per distinct stack:
+frames from the outermost to the innermost, separated by ';', followed by the number of
+samples), which flame graph tools (flamegraph.pl, speedscope, ...) read. Threads waiting for
+a lock or the GIL show up as many samples in the frame that waits.
+
+Example usage:
+
+> profiler = SamplingProfiler("files/profiles", duration=30, interval=0.01)
+> install_signal_handler(profiler)
+$ kill -USR1 <pid of the crawler>
+[SamplingProfiler] Wrote 1450 samples of 'fetch' threads to files/profiles/20201104-101500-fetch.collapsed
+"""
+import os
+import re
+import signal
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from os.path import basename, join
+from time import perf_counter
+
+# 'fetch-3' -> 'fetch', 'Thread-7 (worker_task)' -> 'worker_task', 'Thread-7' -> 'Thread'
+_ROLE_PATTERN = re.compile(r"^(?:Thread-\d+ \((?P<target>[^)]+)\)|(?P<name>.*?)(?:[-_]\d+)*)$")
+
+
+def thread_role(name):
+    """ Role of a thread, i.e. its name without the number of the thread."""
+    match = _ROLE_PATTERN.match(name)
+    return match.group("target") or match.group("name") or name
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, basename(code.co_filename), code.co_firstlineno)
+
+
+def collapse(frame):
+    """ Stack of `frame` in the collapsed format (outermost frame first)."""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler:
+
+    def __init__(self, directory, duration=30.0, interval=0.01):
+        """
+        Parameters
+        ----------
+        directory: str
+            Directory the collapsed stacks are written into (created if needed)
+
+        duration: float
+            Default time (in seconds) of sampling
+
+        interval: float
+            Time (in seconds) between two samples
+        """
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=None):
+        """ Starts sampling in the background (unless the profiler is running already).
+
+        Returns
+        -------
+        bool:
+            True if the profiler was started
+        """
+        with self.lock:
+            if self.running:
+                print("[SamplingProfiler] Already running...")
+                return False
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run,
+                                           args=(duration if duration is not None else self.duration,),
+                                           name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def stop(self):
+        """ Ends sampling early (the samples taken so far are written)."""
+        self.stopped.set()
+        self.join()
+
+    def sample(self, duration):
+        """ Takes samples for `duration` seconds (or until `stop` is called).
+
+        Returns
+        -------
+        dict:
+            Role -> Counter of collapsed stacks
+        """
+        own_id = threading.get_ident()
+        stacks = {}
+        end = perf_counter() + duration
+        while perf_counter() < end and not self.stopped.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                role = thread_role(names.get(thread_id, "unknown"))
+                stacks.setdefault(role, Counter())[collapse(frame)] += 1
+            self.stopped.wait(self.interval)
+        return stacks
+
+    def run(self, duration):
+        print("[SamplingProfiler] Sampling all threads for {} seconds...".format(duration))
+        stacks = self.sample(duration)
+        self.write(stacks)
+
+    def write(self, stacks):
+        """ Writes the stacks of every role into '<directory>/<time>-<role>.collapsed'.
+
+        Returns
+        -------
+        list of str:
+            Paths of the written files
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        paths = []
+        for role, counter in sorted(stacks.items()):
+            path = join(self.directory, "{}-{}.collapsed".format(
+                timestamp, re.sub(r"[^\w.-]", "_", role)))
+            with open(path, "w") as output:
+                for stack, count in counter.most_common():
+                    output.write("{} {}\n".format(stack, count))
+            paths.append(path)
+            print("[SamplingProfiler] Wrote {} samples of '{}' threads to {}".format(
+                sum(counter.values()), role, path))
+        return paths
+
+
+def install_signal_handler(profiler, signum=None):
+    """ Starts `profiler` whenever the process receives `signum` (SIGUSR1 by default). Has to
+    be called from the main thread; does nothing on platforms without SIGUSR1.
+
+    Returns
+    -------
+    bool:
+        True if the handler was installed
+    """
+    signum = signum if signum is not None else getattr(signal, "SIGUSR1", None)
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signum, lambda received, frame: profiler.start())
+    return True
@@ -0,0 +1,197 @@
+"""
+This file contains the adaptive politeness of the crawler: a `RateController` keeps the delay
+between two requests to every host and adapts it to the host's responses (AIMD, as in TCP
+congestion control):
+
+- after a good response, the request rate (1 / delay) is increased by a constant (additive
+  increase), so robust hosts are crawled faster and faster,
+- after a 429 or 503 response, a timeout or a slow response (slower than `slow_latency` or than
+  `latency_factor` times the host's usual latency), the delay is multiplied (multiplicative
+  decrease of the rate), so overloaded hosts are quickly relieved. A Retry-After header is
+  honored as well: no request is made to the host before it has passed.
+
+The delay never drops below the delay asked for by the host's robots.txt (Crawl-delay or
+Request-rate, see `crawler.robots.Robots.explicit_delay`) nor below `min_delay`.
+
+Example usage:
+
+> controller = RateController(initial_delay=3, min_delay=0.5)
+> controller.set_robots_delay("evem.gov.si", robots.explicit_delay())
+> sleep(controller.wait_time("evem.gov.si", last_request_time))
+> controller.feedback("evem.gov.si", response.status_code, latency,
+>                     retry_after=response.headers.get("Retry-After"))
+"""
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import time
+
+from crawler.metrics import METRICS
+
+# status codes of responses that ask the crawler to slow down
+BACKOFF_STATUS_CODES = {429, 503}
+# weight of the newest latency in the smoothed latency of a host
+LATENCY_SMOOTHING = 0.2
+# the smallest delay after backing off (if `min_delay` and the robots.txt allow none)
+MIN_BACKOFF_DELAY = 0.1
+# responses faster than this (in seconds) are never slow compared to the host's usual latency
+MIN_SLOW_LATENCY = 1.0
+
+
+def parse_retry_after(value, now=None):
+    """ Seconds to wait according to a Retry-After header (seconds or an HTTP date), or None if
+    the header is missing or invalid."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    now = now if now is not None else datetime.now(timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class HostRate:
+    """ Politeness state of one host."""
+    def __init__(self, delay):
+        self.delay = delay
+        # delay asked for by robots.txt (0 if none)
+        self.robots_delay = 0.0
+        # no request before this time (from Retry-After)
+        self.retry_at = 0.0
+        # smoothed latency of good responses (None until the first one)
+        self.latency = None
+
+
+class RateController:
+
+    def __init__(self, initial_delay=3.0, min_delay=0.5, max_delay=60.0, increase=0.1,
+                 backoff=2.0, slow_latency=5.0, latency_factor=3.0, max_retry_after=600.0):
+        """
+        Parameters
+        ----------
+        initial_delay: float
+            Delay (in seconds) between requests to a host whose robots.txt does not ask for one
+
+        min_delay: float
+            The smallest delay used for any host
+
+        max_delay: float
+            The largest delay the controller backs off to
+
+        increase: float
+            Requests per second added to a host's rate after every good response
+
+        backoff: float
+            Factor the delay is multiplied with after a response asking to slow down
+
+        slow_latency: float
+            Responses slower than this (in seconds) cause a back off
+
+        latency_factor: float
+            Responses slower than this many times the host's smoothed latency (and slower than
+            `MIN_SLOW_LATENCY`) cause a back off (0 disables it)
+
+        max_retry_after: float
+            Longest Retry-After (in seconds) that is honored
+        """
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.increase = increase
+        self.backoff = backoff
+        self.slow_latency = slow_latency
+        self.latency_factor = latency_factor
+        self.max_retry_after = max_retry_after
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostRate(max(self.initial_delay, self.min_delay))
+        return state
+
+    def floor(self, state):
+        return max(self.min_delay, state.robots_delay)
+
+    def set_robots_delay(self, host, delay):
+        """ Sets the delay (in seconds) asked for by the host's robots.txt (None if none). The
+        host is crawled with exactly this delay until its responses say otherwise."""
+        with self.lock:
+            state = self._host(host)
+            if delay is not None:
+                state.robots_delay = float(delay)
+                state.delay = self.floor(state)
+
+    def delay(self, host):
+        """ Current delay (in seconds) between two requests to the host."""
+        with self.lock:
+            return self._host(host).delay
+
+    def wait_time(self, host, last_request):
+        """ Time (in seconds) to wait before the next request to the host, if the last one was
+        made at `last_request` (a `time.time()` timestamp, None if there was none)."""
+        now = time()
+        with self.lock:
+            state = self._host(host)
+            wait = state.retry_at - now
+            if last_request is not None:
+                wait = max(wait, last_request + state.delay - now)
+        return max(0.0, wait)
+
+    def feedback(self, host, status_code=None, latency=None, retry_after=None, timeout=False):
+        """ Adapts the host's delay to the outcome of a request.
+
+        Parameters
+        ----------
+        host: str
+
+        status_code: int, optional
+            Status of the response (None if there was none, e.g. after a connection error)
+
+        latency: float, optional
+            Duration (in seconds) of the request
+
+        retry_after: str, optional
+            Value of the Retry-After header
+
+        timeout: bool
+            True if the request timed out
+        """
+        retry_seconds = parse_retry_after(retry_after)
+        with self.lock:
+            state = self._host(host)
+            reason = None
+            if timeout:
+                reason = "timeout"
+            elif status_code in BACKOFF_STATUS_CODES:
+                reason = str(status_code)
+            elif latency is not None and (latency > self.slow_latency or (
+                    self.latency_factor and state.latency is not None and
+                    latency > max(MIN_SLOW_LATENCY, self.latency_factor * state.latency))):
+                reason = "slow"
+
+            if retry_seconds is not None and retry_seconds > 0:
+                state.retry_at = max(state.retry_at, time() + min(retry_seconds, self.max_retry_after))
+
+            if reason is None:
+                if latency is not None:
+                    state.latency = latency if state.latency is None else \
+                        (1 - LATENCY_SMOOTHING) * state.latency + LATENCY_SMOOTHING * latency
+                if status_code is not None and status_code < 500 and state.delay > 0:
+                    # additive increase of the rate
+                    state.delay = max(self.floor(state), 1 / (1 / state.delay + self.increase))
+                return
+            # multiplicative decrease of the rate
+            state.delay = max(self.floor(state), min(self.max_delay, max(MIN_BACKOFF_DELAY,
+                                                                         state.delay * self.backoff)))
+            delay = state.delay
+        METRICS.count("backoffs", host=host, reason=reason)
+        print("[RateController] Slowing down '{}' to a request every {:.1f} seconds ({})...".format(
+            host, delay, reason))
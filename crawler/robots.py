@@ -117,6 +117,32 @@ class Robots(RobotFileParser):
             return 3
         return super().crawl_delay('*')
 
+    def explicit_delay(self):
+        """
+        Returns
+        ----------
+        explicit_delay: float or None
+            The delay between two requests (in seconds) that robots.txt asks for with
+            Crawl-delay or Request-rate (the longer one if both are given), None if neither is.
+        """
+        delays = []
+        if super().crawl_delay('*') is not None:
+            delays.append(float(super().crawl_delay('*')))
+        rate = self.request_rate('*')
+        if rate is not None and rate.requests > 0:
+            delays.append(rate.seconds / rate.requests)
+        return max(delays) if delays else None
+
+    def unavailable(self):
+        """
+        Returns
+        ----------
+        unavailable: boolean
+            True if robots.txt could not be read because of a server error (5xx). Nothing can
+            be fetched from the domain until it is read.
+        """
+        return not (self.mtime() or self.allow_all or self.disallow_all)
+
     def can_fetch(self, page):
         """
         Tells whether the agent (*) is allowed to crawl a page from the current domain.
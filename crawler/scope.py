@@ -0,0 +1,139 @@
+"""
+This file contains the crawl scope engine, which decides whether a link is allowed to
+enter the frontier.
+
+Scope is given as a list of rules (see `crawler/config.yaml`). Each rule matches a host
+suffix (e.g. 'gov.si' matches 'gov.si' and any of its subdomains) and can additionally
+restrict the paths (include/exclude regexps) and the depth (number of path segments) of
+links on matching hosts. If multiple rules match a host, the most specific one is used.
+
+Host suffixes are compiled into a trie of reversed host labels ('evem.gov.si' is stored as
+si -> gov -> evem), so finding the rule for a host takes one dictionary lookup per label.
+
+Example usage:
+
+> scope = Scope([ScopeRule('gov.si', exclude=['^/fileadmin/global/'])])
+> scope.filter(['http://evem.gov.si/a', 'http://google.com', 'http://gov.si/fileadmin/global/x'])
+['http://evem.gov.si/a']
+"""
+import re
+
+from crawler.links import Links
+
+
+class ScopeRule:
+
+    def __init__(self, host, include=None, exclude=None, max_depth=None):
+        """
+        Parameters
+        ----------
+        host: str
+            Host suffix that the rule applies to (e.g. 'gov.si' or 'evem.gov.si')
+
+        include: list of str, optional
+            Regexps of which at least one has to match (`re.search`) the path of a link. If not
+            given, all paths are included.
+
+        exclude: list of str, optional
+            Regexps of which none may match the path of a link
+
+        max_depth: int, optional
+            Maximum number of path segments of a link ('/a/b' has 2)
+        """
+        self.host = host.lower().strip(".")
+        self.include = re.compile("|".join("(?:%s)" % regexp for regexp in include)) if include else None
+        self.exclude = re.compile("|".join("(?:%s)" % regexp for regexp in exclude)) if exclude else None
+        self.max_depth = max_depth
+
+    def allows_path(self, path):
+        if self.max_depth is not None and path.rstrip("/").count("/") > self.max_depth:
+            return False
+        if self.include is not None and self.include.search(path) is None:
+            return False
+        if self.exclude is not None and self.exclude.search(path) is not None:
+            return False
+        return True
+
+
+class Scope:
+
+    # key under which a trie node stores its rule (host labels can never be empty)
+    RULE = ""
+
+    def __init__(self, rules):
+        """
+        Parameters
+        ----------
+        rules: list of ScopeRule
+            Rules of the scope. Links on hosts that do not match any rule are out of scope.
+        """
+        self.rules = list(rules)
+        self.trie = {}
+        for rule in self.rules:
+            node = self.trie
+            for label in reversed(rule.host.split(".")):
+                node = node.setdefault(label, {})
+            node[Scope.RULE] = rule
+
+        # memoized host -> rule lookups (hosts repeat for almost every link)
+        self.host_rules = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """ Creates the scope from the 'scope' section of the crawler config
+        (see `crawler.settings.SettingsReader`)."""
+        return cls([ScopeRule(host=options["host"],
+                              include=options.get("include"),
+                              exclude=options.get("exclude"),
+                              max_depth=options.get("max_depth"))
+                    for options in config.get("scope") or []])
+
+    def rule_for(self, host):
+        """ Returns the most specific rule matching the host or None if the host is out of scope."""
+        try:
+            return self.host_rules[host]
+        except KeyError:
+            pass
+
+        rule = None
+        node = self.trie
+        for label in reversed(host.split(":", 1)[0].split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            rule = node.get(Scope.RULE, rule)
+
+        self.host_rules[host] = rule
+        return rule
+
+    def allows(self, url):
+        """ Tells whether a URL is in scope."""
+        canonical = Links.canonicalize(url)
+        if canonical is None:
+            return False
+        rule = self.rule_for(canonical.host)
+        return rule is not None and rule.allows_path(canonical.path)
+
+    def filter(self, links):
+        """
+        Parameters
+        ----------
+        links: iterable of str
+            URLs to be filtered
+
+        Returns
+        -------
+        list of str:
+            Links that are in scope (in the same order)
+        """
+        canonicalize = Links.canonicalize
+        rule_for = self.rule_for
+        result = []
+        for link in links:
+            canonical = canonicalize(link)
+            if canonical is None:
+                continue
+            rule = rule_for(canonical.host)
+            if rule is not None and rule.allows_path(canonical.path):
+                result.append(link)
+        return result
@@ -19,9 +19,31 @@ from settings import SettingsReader
 
 {'workers': 2, 'some_other_parameter': 'foobar'}
 
+The crawler's own config.yaml (or the file in the CRAWLER_CONFIG environment variable) is
+merged into `SettingsReader.config` when this module is imported, so every part of the crawler
+(and every process it starts) reads the same configuration. Files are merged section by
+section: a section that only sets some of its options keeps the defaults of the others.
 """
+from copy import deepcopy
+from os import environ
+from os.path import abspath, dirname, exists, join
 
-from yaml import load
+from yaml import load, SafeLoader
+
+# configuration file loaded on import (see `SettingsReader.load`)
+CONFIG_PATH = environ.get("CRAWLER_CONFIG", join(dirname(abspath(__file__)), "config.yaml"))
+
+
+def merge(defaults, custom):
+    """ Merges a configuration into the defaults: dictionaries (sections) are merged key by key,
+    any other value (including lists) replaces the default. Neither argument is modified."""
+    merged = deepcopy(defaults)
+    for key, value in custom.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = deepcopy(value)
+    return merged
 
 
 class SettingsReader:
@@ -30,7 +52,119 @@ class SettingsReader:
     Default settings for the crawler.
     """
     config = {
-        'workers': 5
+        'workers': 5,
+        # see crawler.links.CanonicalizationRules
+        'canonicalization': {
+            'sort_query': True,
+            'learn_threshold': 5,
+            'learn_min_values': 3
+        },
+        # see crawler.db.BulkWriter
+        'database': {
+            'max_connections': 100,
+            'batch_size': 500,
+            'flush_interval': 1.0,
+            'max_pending': 10000,
+            # see crawler.db.HTML_STORAGE_MODES
+            'html_storage': 'inline'
+        },
+        # see crawler.frontier.PostgresFrontier
+        'frontier': {
+            'lease_seconds': 300,
+            'batch_size': 20,
+            'idle_timeout': 60
+        },
+        # see crawler.partition.Coordinator
+        'partition': {
+            'batch_size': 100,
+            'replicas': 100
+        },
+        # see crawler.analysis.Analyzer (0 processes = analyze pages in the crawling threads)
+        'analysis': {
+            'processes': 0
+        },
+        # see crawler.core.Agent.create_pipeline
+        'pipeline': {
+            'enabled': False,
+            'report_interval': 10,
+            'stages': {
+                'fetch': {'workers': 10, 'queue_size': 100},
+                'render': {'workers': 2, 'queue_size': 20},
+                'parse': {'workers': 2, 'queue_size': 20},
+                'dedup': {'workers': 2, 'queue_size': 50},
+                'persist': {'workers': 4, 'queue_size': 50},
+                'download': {'workers': 4, 'queue_size': 50}
+            }
+        },
+        # see crawler.download.stream_to_file
+        'downloads': {
+            'max_bytes': 50 * 2 ** 20,
+            'chunk_size': 64 * 2 ** 10
+        },
+        # see crawler.images.ImageDownloader
+        'images': {
+            'workers': 4,
+            'max_pending': 10000,
+            'host_delay': 0.5,
+            'max_images': 100000
+        },
+        # see crawler.warc.WarcWriter (the directory is relative to the project's root)
+        'archive': {
+            'enabled': False,
+            'directory': 'files/warc',
+            'max_file_size': 2 ** 30
+        },
+        # see crawler.metrics.Metrics (port 0 = no metrics endpoint)
+        'metrics': {
+            'report_interval': 60,
+            'host': '127.0.0.1',
+            'port': 0
+        },
+        # see crawler.profiler.SamplingProfiler (start_after 0 = only when signalled)
+        'profiler': {
+            'signal': True,
+            'start_after': 0,
+            'duration': 30,
+            'interval': 0.01,
+            'directory': 'files/profiles'
+        },
+        # see crawler.memory.MemoryMonitor (0 = no report / no limit)
+        'memory': {
+            'interval': 300,
+            'top': 10,
+            'tracemalloc_frames': 0,
+            'rss_mb': 0,
+            'browser_rss_mb': 0,
+            'frontier_links': 0,
+            'spill_directory': 'files/spill'
+        },
+        # see crawler.ratelimit.RateController
+        'politeness': {
+            'adaptive': True,
+            'initial_delay': 3,
+            'min_delay': 0.5,
+            'max_delay': 60,
+            'increase': 0.1,
+            'backoff': 2,
+            'slow_latency': 5,
+            'latency_factor': 3,
+            'max_retry_after': 600
+        },
+        # see crawler.health.CircuitBreaker and crawler.health.RetryQueue
+        'health': {
+            'failure_threshold': 5,
+            'open_seconds': 60,
+            'max_open_seconds': 900,
+            'max_attempts': 3,
+            'base_delay': 30,
+            'max_delay': 600,
+            'max_park_seconds': 86400
+        },
+        # see crawler.scope.Scope
+        'scope': [
+            {'host': 'evem.gov.si'},
+            {'host': 'e-prostor.gov.si'}
+        ]
     }
 
     def __init__(self, config_file_path):
@@ -39,5 +173,16 @@ class SettingsReader:
             Merges the default configuration with additional
             parameters from the config file (which override defaults).
             """
-            custom_config = load(config_file)
-            self.config = {**self.config, **custom_config}
+            custom_config = load(config_file, Loader=SafeLoader) or {}
+            self.config = merge(self.config, custom_config)
+
+    @classmethod
+    def load(cls, config_file_path):
+        """ Merges a config file into the configuration that the crawler reads
+        (`SettingsReader.config`)."""
+        cls.config = cls(config_file_path).config
+        print("[SettingsReader] Loaded the configuration from '{}'...".format(config_file_path))
+
+
+if "CRAWLER_CONFIG" in environ or exists(CONFIG_PATH):
+    SettingsReader.load(CONFIG_PATH)
@@ -0,0 +1,334 @@
+"""
+This file contains the WARC archive of a crawl: a writer that records the HTTP responses the
+crawler receives and a reader that reads them back, so pages can be processed again (see
+`crawler.core.Agent.replay`) without requesting them from the sites again.
+
+Archives are WARC/1.0 files in which every record is a separate gzip member ('.warc.gz'), the
+format that other WARC tools read as well. Records are written one after another (never held
+in memory as a whole file) into '<prefix>-<timestamp>-<pid>-<serial>.warc.gz.open', which is renamed
+to '.warc.gz' once it reaches `max_file_size` or the writer is closed, so a file that is still
+being written is never read.
+
+A page is stored as a 'response' record (status line, headers and body of the HTTP response),
+followed by a 'conversion' record with its rendered HTML if it was rendered. Sites are stored
+as 'metadata' records with their robots.txt and sitemap.
+
+The body of a response is stored decoded (as the crawler received it from `requests`), so its
+Content-Encoding and Transfer-Encoding headers are dropped and Content-Length is set to the
+length of the stored body.
+
+Example usage:
+
+> writer = WarcWriter("files/warc", max_file_size=2 ** 30)
+> writer.write_response("http://evem.gov.si/", 200, response.headers, response.content)
+> writer.close()
+> for record in read_records(archive_paths("files/warc")[0]):
+>     print(record.type, record.headers["WARC-Target-URI"])
+"""
+import gzip
+import json
+import os
+import threading
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+from glob import glob
+from http.client import responses
+from os.path import join
+
+from requests.structures import CaseInsensitiveDict
+
+from crawler.download import CHUNK_SIZE
+
+WARC_VERSION = "WARC/1.0"
+# headers that describe the transfer of the body rather than the (decoded) body itself
+TRANSFER_HEADERS = {"content-encoding", "transfer-encoding", "content-length"}
+
+WarcRecord = namedtuple("WarcRecord", ["type", "headers", "content"])
+HttpResponse = namedtuple("HttpResponse", ["status_code", "reason", "headers", "body"])
+
+
+class WarcFormatError(Exception):
+    pass
+
+
+def archive_paths(directory):
+    """ Paths of the complete archives in `directory`, in the order in which they were written."""
+    return sorted(glob(join(directory, "*.warc.gz")))
+
+
+def http_header_block(status_code, headers, body_size):
+    """ Status line and headers of an HTTP response, as stored in a response record."""
+    lines = ["HTTP/1.1 {} {}".format(status_code, responses.get(status_code, ""))]
+    lines.extend("{}: {}".format(name, value) for name, value in headers.items()
+                 if name.lower() not in TRANSFER_HEADERS)
+    lines.append("Content-Length: {}".format(body_size))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1", errors="replace")
+
+
+def parse_http_response(content):
+    """ Splits the content of a response record into the parts of the HTTP response.
+
+    Returns
+    -------
+    HttpResponse:
+        Status code, reason, headers (case-insensitive dict, like the ones of `requests`) and
+        body (bytes)
+    """
+    head, separator, body = content.partition(b"\r\n\r\n")
+    if not separator:
+        raise WarcFormatError("HTTP response without the end of its headers")
+    lines = head.decode("latin-1").split("\r\n")
+    status_line = lines[0].split(" ", 2)
+    headers = CaseInsensitiveDict()
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip()] = value.strip()
+    return HttpResponse(int(status_line[1]), status_line[2] if len(status_line) > 2 else "",
+                        headers, body)
+
+
+def read_records(path):
+    """ Reads the records of an archive one by one.
+
+    Parameters
+    ----------
+    path: str
+        Path of a '.warc.gz' file (or an uncompressed '.warc' file)
+
+    Yields
+    ------
+    WarcRecord:
+        Type of the record, its WARC headers (dict) and content (bytes)
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as archive:
+        while True:
+            version = archive.readline()
+            if not version:
+                return
+            if version.strip() == b"":
+                continue
+            if not version.startswith(b"WARC/"):
+                raise WarcFormatError("{}: expected a record, got {!r}".format(path, version[:50]))
+
+            headers = {}
+            for line in iter(archive.readline, b"\r\n"):
+                if not line:
+                    raise WarcFormatError("{}: truncated record headers".format(path))
+                name, _, value = line.decode("utf-8").partition(":")
+                headers[name.strip()] = value.strip()
+
+            length = int(headers["Content-Length"])
+            content = archive.read(length)
+            if len(content) != length:
+                raise WarcFormatError("{}: truncated record content".format(path))
+            # every record ends with two CRLFs
+            archive.read(4)
+            yield WarcRecord(headers.get("WARC-Type"), headers, content)
+
+
+class WarcWriter:
+    SOFTWARE = "govrilovic-crawler/v0.1"
+
+    def __init__(self, directory, prefix="govrilovic", max_file_size=2 ** 30, compress_level=6):
+        """
+        Parameters
+        ----------
+        directory: str
+            Directory of the archives (created if needed)
+
+        prefix: str
+            Beginning of the names of the archives
+
+        max_file_size: int
+            Size (in bytes) after which the writer starts a new archive
+
+        compress_level: int
+            gzip compression level of the records
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        self.serial = 0
+        self.num_records = 0
+
+    def open_next(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # the process id keeps the names of archives written by parallel processes apart
+        name = "{}-{}-{}-{:05d}.warc.gz".format(self.prefix,
+                                                datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S"),
+                                                os.getpid(), self.serial)
+        self.serial += 1
+        self.path = join(self.directory, name)
+        self.file = open(self.path + ".open", "wb")
+        info = "software: {}\r\nformat: WARC File Format 1.0\r\n".format(WarcWriter.SOFTWARE)
+        self.write_record("warcinfo", {"WARC-Filename": name, "Content-Type": "application/warc-fields"},
+                          [info.encode("utf-8")])
+
+    def close_current(self):
+        if self.file is None:
+            return
+        self.file.close()
+        os.replace(self.path + ".open", self.path)
+        self.file = None
+
+    def write_record(self, record_type, headers, blocks, target_uri=None):
+        """ Writes a record as a separate gzip member. The caller holds the lock.
+
+        Parameters
+        ----------
+        record_type: str
+            WARC-Type of the record
+
+        headers: dict
+            Additional WARC headers
+
+        blocks: list of (bytes or (file object, int))
+            Content of the record: bytes, or open binary files with the number of bytes to
+            copy from them (copied in chunks)
+
+        target_uri: str, optional
+            URL the record belongs to
+
+        Returns
+        -------
+        str:
+            WARC-Record-ID of the record
+        """
+        record_id = "<urn:uuid:{}>".format(uuid.uuid4())
+        length = sum(len(block) if isinstance(block, bytes) else block[1] for block in blocks)
+        lines = [WARC_VERSION,
+                 "WARC-Type: " + record_type,
+                 "WARC-Record-ID: " + record_id,
+                 "WARC-Date: " + datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")]
+        if target_uri is not None:
+            lines.append("WARC-Target-URI: " + target_uri)
+        lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+        lines.append("Content-Length: {}".format(length))
+
+        with gzip.GzipFile(fileobj=self.file, mode="wb", compresslevel=self.compress_level) as member:
+            member.write(("\r\n".join(lines) + "\r\n\r\n").encode("utf-8"))
+            for block in blocks:
+                if isinstance(block, bytes):
+                    member.write(block)
+                else:
+                    source, size = block
+                    while size > 0:
+                        chunk = source.read(min(CHUNK_SIZE, size))
+                        if not chunk:
+                            raise WarcFormatError("source ended {} bytes early".format(size))
+                        member.write(chunk)
+                        size -= len(chunk)
+            member.write(b"\r\n\r\n")
+        self.num_records += 1
+        return record_id
+
+    def write(self, records):
+        """ Writes records into the current archive (one after another, so they stay together)
+        and starts a new archive if the current one is full.
+
+        Parameters
+        ----------
+        records: list of (str, dict, list, str)
+            Arguments of `write_record`. A header value of None is replaced by the id of the
+            previous record (for WARC-Refers-To).
+
+        Returns
+        -------
+        list of str:
+            Ids of the records
+        """
+        with self.lock:
+            if self.file is None:
+                self.open_next()
+            record_ids = []
+            for record_type, headers, blocks, target_uri in records:
+                headers = {name: value if value is not None else record_ids[-1]
+                           for name, value in headers.items()}
+                record_ids.append(self.write_record(record_type, headers, blocks, target_uri))
+            if self.file.tell() >= self.max_file_size:
+                self.close_current()
+            return record_ids
+
+    def write_response(self, url, status_code, headers, body=b"", rendered=None, truncated=False):
+        """ Records the HTTP response of a page.
+
+        Parameters
+        ----------
+        url: str
+            URL of the page
+
+        status_code: int
+            HTTP status code
+
+        headers: dict-like
+            HTTP response headers
+
+        body: bytes or (file object, int)
+            Body of the response, or an open binary file with the body and its size in bytes
+
+        rendered: str, optional
+            HTML of the page as rendered by the browser (stored in a conversion record)
+
+        truncated: bool
+            True if the body was not downloaded (the record then has an empty body)
+
+        Returns
+        -------
+        str:
+            WARC-Record-ID of the response record
+        """
+        body_size = len(body) if isinstance(body, bytes) else body[1]
+        response_headers = {"Content-Type": "application/http; msgtype=response"}
+        if truncated:
+            response_headers["WARC-Truncated"] = "unspecified"
+        records = [("response", response_headers,
+                    [http_header_block(status_code, headers, body_size), body], url)]
+        if rendered is not None:
+            records.append(("conversion", {"WARC-Refers-To": None, "Content-Type": "text/html"},
+                            [rendered.encode("utf-8")], url))
+        return self.write(records)[0]
+
+    def write_metadata(self, url, fields):
+        """ Records metadata (a JSON object) about `url`, e.g. robots.txt and sitemap of a site."""
+        content = json.dumps(fields).encode("utf-8")
+        return self.write([("metadata", {"Content-Type": "application/json"}, [content], url)])[0]
+
+    def close(self):
+        """ Closes (and completes) the current archive."""
+        with self.lock:
+            self.close_current()
+        print("[WarcWriter] Wrote {} records into {} archives...".format(self.num_records, self.serial))
+
+
+def read_pages(path):
+    """ Reads the pages and sites recorded in an archive by `WarcWriter`.
+
+    Yields
+    ------
+    (str, WarcRecord, HttpResponse or dict, str or None):
+        Either ('response', record, HTTP response, rendered HTML or None) or
+        ('metadata', record, JSON object, None)
+    """
+    pending = None
+    for record in read_records(path):
+        if record.type == "conversion" and pending is not None \
+                and record.headers.get("WARC-Refers-To") == pending[1].headers["WARC-Record-ID"]:
+            yield pending[0], pending[1], pending[2], record.content.decode("utf-8")
+            pending = None
+            continue
+        if pending is not None:
+            yield pending
+            pending = None
+
+        if record.type == "response":
+            pending = ("response", record, parse_http_response(record.content), None)
+        elif record.type == "metadata":
+            yield "metadata", record, json.loads(record.content), None
+    if pending is not None:
+        yield pending
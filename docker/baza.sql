@@ -1,3 +1,5 @@
+-- Creates the database. Changes to the schema also go into migrate.sql, which updates existing databases.
+
 CREATE SCHEMA IF NOT EXISTS crawldb;
 
 CREATE TABLE crawldb.data_type ( 
@@ -18,6 +20,14 @@ CREATE TABLE crawldb.site (
 	CONSTRAINT pk_site_id PRIMARY KEY ( id )
  );
 
+CREATE TABLE crawldb.html_store ( 
+	hash                 char(64)  NOT NULL,
+	compression          varchar(10)  NOT NULL,
+	"size"               integer  ,
+	content              bytea  ,
+	CONSTRAINT pk_html_store_hash PRIMARY KEY ( hash )
+ );
+
 CREATE TABLE crawldb.page ( 
 	id                   serial  NOT NULL,
 	site_id              integer  ,
@@ -25,6 +35,7 @@ CREATE TABLE crawldb.page (
 	lsh_hash			 varchar(200) ,
 	url                  varchar(3000)  ,
 	html_content         text  ,
+	html_hash            char(64)  ,
 	http_status_code     integer  ,
 	accessed_time        timestamp  ,
 	CONSTRAINT pk_page_id PRIMARY KEY ( id ),
@@ -35,11 +46,15 @@ CREATE INDEX "idx_page_site_id" ON crawldb.page ( site_id );
 
 CREATE INDEX "idx_page_page_type_code" ON crawldb.page ( page_type_code );
 
+CREATE INDEX "idx_page_html_hash" ON crawldb.page ( html_hash );
+
 CREATE TABLE crawldb.page_data ( 
 	id                   serial  NOT NULL,
 	page_id              integer  ,
 	data_type_code       varchar(20)  ,
 	"data"               bytea,
+	content_hash         char(64)  ,
+	"size"               bigint  ,
 	CONSTRAINT pk_page_data_id PRIMARY KEY ( id )
  );
 
@@ -47,18 +62,24 @@ CREATE INDEX "idx_page_data_page_id" ON crawldb.page_data ( page_id );
 
 CREATE INDEX "idx_page_data_data_type_code" ON crawldb.page_data ( data_type_code );
 
+CREATE INDEX "idx_page_data_content_hash" ON crawldb.page_data ( content_hash );
+
 CREATE TABLE crawldb.image ( 
 	id                   serial  NOT NULL,
 	page_id              integer  ,
 	filename             varchar(255)  ,
 	content_type         varchar(50)  ,
 	"data"               bytea  ,
+	content_hash         char(64)  ,
+	"size"               bigint  ,
 	accessed_time        timestamp  ,
 	CONSTRAINT pk_image_id PRIMARY KEY ( id )
  );
 
 CREATE INDEX "idx_image_page_id" ON crawldb.image ( page_id );
 
+CREATE INDEX "idx_image_content_hash" ON crawldb.image ( content_hash );
+
 CREATE TABLE crawldb.link ( 
 	from_page            integer  NOT NULL,
 	to_page              integer  NOT NULL,
@@ -69,6 +90,34 @@ CREATE INDEX "idx_link_from_page" ON crawldb.link ( from_page );
 
 CREATE INDEX "idx_link_to_page" ON crawldb.link ( to_page );
 
+-- Shared frontier (crawler.frontier.PostgresFrontier). Every entry is a FRONTIER page.
+-- Crawled FRONTIER pages that were not stored have an accessed_time and are not added again.
+-- Workers lease a host and a batch of its URLs; leases expire so that the entries
+-- claimed by dead workers can be claimed again. Failed URLs are not claimed before not_before.
+CREATE TABLE crawldb.frontier ( 
+	page_id              integer  NOT NULL,
+	host                 varchar(500)  NOT NULL,
+	depth                integer  NOT NULL,
+	claimed_by           varchar(100)  ,
+	claimed_until        timestamp  ,
+	not_before           timestamp  ,
+	CONSTRAINT pk_frontier_page_id PRIMARY KEY ( page_id )
+ );
+
+CREATE INDEX "idx_frontier_host_depth" ON crawldb.frontier ( host, depth, page_id );
+
+CREATE TABLE crawldb.frontier_host ( 
+	"domain"             varchar(500)  NOT NULL,
+	claimed_by           varchar(100)  ,
+	claimed_until        timestamp  ,
+	next_fetch_at        timestamp  DEFAULT now() NOT NULL,
+	CONSTRAINT pk_frontier_host_domain PRIMARY KEY ( "domain" )
+ );
+
+CREATE INDEX "idx_frontier_host_next_fetch_at" ON crawldb.frontier_host ( next_fetch_at );
+
+ALTER TABLE crawldb.frontier ADD CONSTRAINT fk_frontier_page FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE CASCADE;
+
 ALTER TABLE crawldb.image ADD CONSTRAINT fk_image_page_data FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT;
 
 ALTER TABLE crawldb.link ADD CONSTRAINT fk_link_page FOREIGN KEY ( from_page ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT;
@@ -79,6 +128,8 @@ ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_site FOREIGN KEY ( site_id ) REF
 
 ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_page_type FOREIGN KEY ( page_type_code ) REFERENCES crawldb.page_type( code ) ON DELETE RESTRICT;
 
+ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_html_store FOREIGN KEY ( html_hash ) REFERENCES crawldb.html_store( hash ) ON DELETE RESTRICT;
+
 ALTER TABLE crawldb.page_data ADD CONSTRAINT fk_page_data_page FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT;
 
 ALTER TABLE crawldb.page_data ADD CONSTRAINT fk_page_data_data_type FOREIGN KEY ( data_type_code ) REFERENCES crawldb.data_type( code ) ON DELETE RESTRICT;
@@ -94,4 +145,15 @@ INSERT INTO crawldb.page_type VALUES
 	('HTML'),
 	('BINARY'),
 	('DUPLICATE'),
-	('FRONTIER');
\ No newline at end of file
+	('FRONTIER');
+
+-- Pages with their HTML, whichever way it is stored (see 'html_storage' in crawler/config.yaml).
+-- HTML that is compressed (html_compression = 'zlib') can only be decompressed by the client
+-- (e.g. zlib.decompress(html_compressed) in Python), so its html_content is NULL here.
+CREATE VIEW crawldb.page_html AS
+	SELECT p.id, p.site_id, p.page_type_code, p.lsh_hash, p.url,
+	       COALESCE(p.html_content,
+	                CASE WHEN h.compression = 'none' THEN convert_from(h.content, 'UTF8') END) AS html_content,
+	       h.compression AS html_compression, h.content AS html_compressed,
+	       p.http_status_code, p.accessed_time
+	FROM crawldb.page p LEFT JOIN crawldb.html_store h ON h.hash = p.html_hash;
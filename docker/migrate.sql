@@ -0,0 +1,75 @@
+-- Brings a crawldb that was created by an older baza.sql up to date with it, keeping the data.
+-- baza.sql only runs when the database is created, so run this on an existing database:
+--   psql -h localhost -U postgres -d crawldb -f docker/migrate.sql
+-- Every statement is skipped if it was already applied, so it is safe to run more than once.
+
+-- HTML stored once per distinct content (see 'html_storage' in crawler/config.yaml)
+CREATE TABLE IF NOT EXISTS crawldb.html_store (
+	hash                 char(64)  NOT NULL,
+	compression          varchar(10)  NOT NULL,
+	"size"               integer  ,
+	content              bytea  ,
+	CONSTRAINT pk_html_store_hash PRIMARY KEY ( hash )
+ );
+
+ALTER TABLE crawldb.page ADD COLUMN IF NOT EXISTS html_hash char(64);
+
+CREATE INDEX IF NOT EXISTS "idx_page_html_hash" ON crawldb.page ( html_hash );
+
+-- Images and files are kept in the blob store (crawler.blobstore.BlobStore), under content_hash
+ALTER TABLE crawldb.page_data ADD COLUMN IF NOT EXISTS content_hash char(64);
+
+ALTER TABLE crawldb.page_data ADD COLUMN IF NOT EXISTS "size" bigint;
+
+CREATE INDEX IF NOT EXISTS "idx_page_data_content_hash" ON crawldb.page_data ( content_hash );
+
+ALTER TABLE crawldb.image ADD COLUMN IF NOT EXISTS content_hash char(64);
+
+ALTER TABLE crawldb.image ADD COLUMN IF NOT EXISTS "size" bigint;
+
+CREATE INDEX IF NOT EXISTS "idx_image_content_hash" ON crawldb.image ( content_hash );
+
+-- Shared frontier (crawler.frontier.PostgresFrontier), see baza.sql
+CREATE TABLE IF NOT EXISTS crawldb.frontier (
+	page_id              integer  NOT NULL,
+	host                 varchar(500)  NOT NULL,
+	depth                integer  NOT NULL,
+	claimed_by           varchar(100)  ,
+	claimed_until        timestamp  ,
+	not_before           timestamp  ,
+	CONSTRAINT pk_frontier_page_id PRIMARY KEY ( page_id )
+ );
+
+ALTER TABLE crawldb.frontier ADD COLUMN IF NOT EXISTS not_before timestamp;
+
+CREATE INDEX IF NOT EXISTS "idx_frontier_host_depth" ON crawldb.frontier ( host, depth, page_id );
+
+CREATE TABLE IF NOT EXISTS crawldb.frontier_host (
+	"domain"             varchar(500)  NOT NULL,
+	claimed_by           varchar(100)  ,
+	claimed_until        timestamp  ,
+	next_fetch_at        timestamp  DEFAULT now() NOT NULL,
+	CONSTRAINT pk_frontier_host_domain PRIMARY KEY ( "domain" )
+ );
+
+CREATE INDEX IF NOT EXISTS "idx_frontier_host_next_fetch_at" ON crawldb.frontier_host ( next_fetch_at );
+
+-- Postgres has no ADD CONSTRAINT IF NOT EXISTS
+DO $$
+BEGIN
+	IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'fk_frontier_page') THEN
+		ALTER TABLE crawldb.frontier ADD CONSTRAINT fk_frontier_page FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE CASCADE;
+	END IF;
+	IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'fk_page_html_store') THEN
+		ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_html_store FOREIGN KEY ( html_hash ) REFERENCES crawldb.html_store( hash ) ON DELETE RESTRICT;
+	END IF;
+END
+$$;
+
+CREATE OR REPLACE VIEW crawldb.page_html AS
+	SELECT p.id, p.site_id, p.page_type_code, p.lsh_hash, p.url,
+	       COALESCE(p.html_content,
+	                CASE WHEN h.compression = 'none' THEN convert_from(h.content, 'UTF8') END) AS html_content,
+	       h.compression AS html_compression, h.content AS html_compressed,
+	       p.http_status_code, p.accessed_time
+	FROM crawldb.page p LEFT JOIN crawldb.html_store h ON h.hash = p.html_hash;
@@ -0,0 +1,52 @@
+import unittest
+from os.path import abspath, join, dirname
+from crawler.analysis import Analyzer, analyze_html, build_lsh, init_worker, read_vocab_file
+from crawler.page import Page
+
+VOCAB_PATH = abspath(join(dirname(__file__), '..', 'crawler', 'data', 'test2.txt'))
+HTML = '<base href="http://evem.gov.si/podjetje/"><a href="vloge">Vloge</a>' \
+       '<img src="/logo.png"><p>Podjetniški portal</p>'
+
+
+class TestAnalysis(unittest.TestCase):
+    def testSameAsPage(self):
+        init_worker(VOCAB_PATH)
+        analysis = analyze_html("http://evem.gov.si", HTML)
+        page = Page("http://evem.gov.si", text=HTML)
+        self.assertListEqual(analysis.extracted.links, page.extracted.links)
+        self.assertEqual(analysis.fingerprint, page.fingerprint)
+        self.assertEqual(analysis.signature, page.lsh_hash(build_lsh(read_vocab_file(VOCAB_PATH))))
+
+    def testAnalyzerStoresResultsIntoPage(self):
+        analyzer = Analyzer(VOCAB_PATH, max_workers=1)
+        try:
+            page = Page("http://evem.gov.si", text=HTML)
+            self.assertTrue(analyzer.analyze(page))
+            self.assertFalse(analyzer.analyze(Page("http://evem.gov.si/vloga.pdf")))
+        finally:
+            analyzer.shutdown()
+
+        local_page = Page("http://evem.gov.si", text=HTML)
+        self.assertListEqual(page.extracted.links, ["http://evem.gov.si/podjetje/vloge"])
+        self.assertListEqual(page.extracted.images, local_page.extracted.images)
+        self.assertEqual(page.fingerprint, local_page.fingerprint)
+        # signatures from worker processes match the ones computed by the crawler itself
+        self.assertEqual(page.signature,
+                         local_page.lsh_hash(build_lsh(read_vocab_file(VOCAB_PATH))))
+
+    def testStartDoesNotWait(self):
+        analyzer = Analyzer(VOCAB_PATH, max_workers=2)
+        try:
+            pages = [Page("http://evem.gov.si/{}".format(idx), text=HTML) for idx in range(3)]
+            # all pages are submitted before the results of any of them are needed
+            for page in pages:
+                self.assertTrue(analyzer.start(page))
+                self.assertIsNotNone(page.analysis)
+            for page in pages:
+                self.assertTrue(analyzer.finish(page))
+                self.assertIsNone(page.analysis)
+            # nothing is left to wait for
+            self.assertFalse(analyzer.finish(pages[0]))
+        finally:
+            analyzer.shutdown()
+        self.assertListEqual(pages[2].extracted.links, ["http://evem.gov.si/podjetje/vloge"])
@@ -0,0 +1,44 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from crawler.blobstore import BlobStore
+from crawler.download import DownloadTooLarge
+from tests.test_download import FakeResponse
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = BlobStore(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(path, name), self.directory.name)
+                      for path, _, names in os.walk(self.directory.name) for name in names)
+
+    def testStoredByHash(self):
+        sha256 = hashlib.sha256(b"logo").hexdigest()
+        blob = self.store.put_stream(FakeResponse([b"lo", b"go"]))
+        self.assertEqual(blob.sha256, sha256)
+        self.assertEqual(blob.size, 4)
+        self.assertEqual(blob.path, os.path.join(self.directory.name, sha256[:2], sha256[2:4], sha256))
+        self.assertTrue(self.store.contains(sha256))
+        with self.store.open(sha256) as f:
+            self.assertEqual(f.read(), b"logo")
+
+    def testIdenticalContentStoredOnce(self):
+        first = self.store.put_stream(FakeResponse([b"logo"]))
+        second = self.store.put_bytes(b"logo")
+        third = self.store.put_stream(FakeResponse([b"logo"]))
+        other = self.store.put_bytes(b"other logo")
+        self.assertEqual(first, second)
+        self.assertEqual(first, third)
+        self.assertListEqual(self.files(), sorted([os.path.relpath(first.path, self.directory.name),
+                                                   os.path.relpath(other.path, self.directory.name)]))
+
+    def testFailedWritesLeaveNothing(self):
+        self.assertRaises(DownloadTooLarge, self.store.put_stream, FakeResponse([b"x" * 10]), max_bytes=5)
+        self.assertListEqual(self.files(), [])
@@ -0,0 +1,72 @@
+import threading
+import unittest
+from contextlib import contextmanager
+from time import sleep
+from unittest import mock
+
+from crawler import core
+from crawler.page import Page
+
+
+class SlowRobots:
+    """ robots.txt that takes a while to download, so concurrent pages overlap."""
+    created = []
+
+    def __init__(self, url):
+        SlowRobots.created.append(url)
+        sleep(0.1)
+
+    def unavailable(self):
+        return False
+
+    def explicit_delay(self):
+        return None
+
+    @property
+    def sitemap_location(self):
+        raise AttributeError("No sitemap")
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.sites = []
+
+    def add_site_info_to_db(self, domain, robots, sitemap):
+        self.sites.append(domain)
+
+
+def fake_agent(database):
+    agent = core.Agent.__new__(core.Agent)
+    agent.sites = set()
+    agent.site_locks = {}
+    agent.robots_file = {}
+    agent.last_crawled = {}
+    agent.rate_controller = None
+    agent.archive = None
+
+    @contextmanager
+    def fake_database():
+        yield database
+    agent.database = fake_database
+    return agent
+
+
+class TestRegisterSite(unittest.TestCase):
+    def testConcurrentPagesOfNewSite(self):
+        database = FakeDatabase()
+        agent = fake_agent(database)
+        SlowRobots.created = []
+        urls = ["http://evem.gov.si/a", "http://evem.gov.si/b"]
+        with mock.patch.object(core.rb, "Robots", SlowRobots), \
+                mock.patch.object(core.sm, "Sitemap", side_effect=IOError("No sitemap")):
+            threads = [threading.Thread(target=agent.register_site, args=(Page(url),))
+                       for url in urls]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # the site is registered (and its robots.txt fetched) once
+        self.assertListEqual(SlowRobots.created, ["http://evem.gov.si"])
+        self.assertListEqual(database.sites, ["evem.gov.si"])
+        self.assertSetEqual(agent.sites, {"evem.gov.si"})
@@ -1,5 +1,208 @@
+import threading
+import time
 import unittest
-from crawler.db import Database
+from unittest import mock
+
+import psycopg2
+
+from crawler import db
+from crawler.db import (BulkWriter, Database, IdCache, Pool, WriterFailed, decode_html, encode_html,
+                        html_hash, write_edges)
+
+
+class FakeConnection:
+    """ Connection of a `FakePool` that only supports what `crawler.db.write_rows` needs."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = False
+        self.batch = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def execute(self, statement, rows):
+        self.pool.gate.wait()
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        if self.pool.failures > 0:
+            self.pool.failures -= 1
+            # like a connection that the server closed
+            self.closed = True
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.batch.append(list(rows))
+
+    def commit(self):
+        self.pool.batches.extend(self.batch)
+        self.batch = []
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.batch = []
+
+    def close(self):
+        self.closed = True
+
+
+class FakePoolConnection:
+    """ Connection that `Pool.connect` opens in the tests of the pool."""
+    def __init__(self):
+        self.closed = False
+        self.in_transaction = False
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        if self.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        # rows of every committed statement
+        self.batches = []
+        # number of statements that fail
+        self.failures = 0
+        # statements wait while this is not set
+        self.gate = threading.Event()
+        self.gate.set()
+        self.leased = 0
+        self.connections = 0
+
+    def getconn(self):
+        self.leased += 1
+        self.connections += 1
+        return FakeConnection(self)
+
+    def putconn(self, connection):
+        self.leased -= 1
+
+    def rows(self):
+        return [row for batch in self.batches for row in batch]
+
+
+class FakeServerCursor:
+    """ Cursor that runs the `crawler.db.PREPARED_STATEMENTS` that `Database.add_page` uses on
+    in-memory tables and records the statements."""
+    def __init__(self, server):
+        self.server = server
+        self.result = None
+
+    def execute(self, query, parameters=None):
+        name = query.split()[1]
+        self.server.statements.append(name)
+        self.result = None
+        if name == "site_id_by_domain":
+            site_id = self.server.sites.get(parameters[0])
+            self.result = (site_id,) if site_id is not None else None
+        elif name == "page_id_by_url":
+            page = self.server.pages.get(parameters[0])
+            self.result = (page[0],) if page is not None else None
+        elif name == "insert_page":
+            url, page_type_code = parameters[2], parameters[1]
+            page = self.server.pages.get(url)
+            if page is None or page[1] == "FRONTIER":
+                # ON CONFLICT (url) DO UPDATE ... WHERE page.page_type_code = 'FRONTIER'
+                page_id = page[0] if page is not None else len(self.server.pages) + 1
+                self.server.pages[url] = (page_id, page_type_code)
+                # html_content and html_hash of the page
+                self.server.page_html[url] = (parameters[3], parameters[7])
+                self.result = (page_id,)
+        elif name == "insert_html":
+            self.server.html.add(parameters[0])
+
+    def fetchone(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeServer:
+    def __init__(self):
+        self.sites = {"evem.gov.si": 1}
+        # url -> (id, page type)
+        self.pages = {}
+        self.html = set()
+        self.page_html = {}
+        self.statements = []
+        self.html_storage = "inline"
+        self.page_ids = IdCache(2)
+        self.site_ids = IdCache(2)
+        self.html_hashes = IdCache(2)
+
+    # the pool of the session
+    def getconn(self):
+        return self
+
+    def putconn(self, connection):
+        pass
+
+    def cursor(self):
+        return FakeServerCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeCopyConnection:
+    """ Connection that records the rows copied by `crawler.db.write_edges`. COPY fails for data
+    that contains `bad`."""
+    def __init__(self, bad=None):
+        self.bad = bad
+        self.copied = []
+        self.committed = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        pass
+
+    def copy_expert(self, statement, data):
+        data = data.getvalue()
+        if self.bad is not None and self.bad in data:
+            raise psycopg2.DataError("value too long for type character varying(3000)")
+        self.copied.append(data.splitlines())
+
+    def commit(self):
+        self.committed.extend(self.copied)
+        self.copied = []
+
+    def rollback(self):
+        self.copied = []
+
+    def close(self):
+        pass
+
+
+def fake_execute_values(cursor, statement, rows, template=None, page_size=100):
+    cursor.connection.execute(statement, rows)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
 
 
 class TestDatabase(unittest.TestCase):
@@ -39,3 +242,326 @@ class TestDatabase(unittest.TestCase):
 
         self.db.alter(delete_test)
         self.db.close_connection()
+
+
+class TestHtmlStorage(unittest.TestCase):
+    HTML = "<html><body>" + "<p>Podjetniški portal</p>" * 200 + "</body></html>"
+
+    def testRoundTrip(self):
+        for compression in ("none", "zlib"):
+            content = encode_html(self.HTML, compression)
+            self.assertEqual(decode_html(compression, memoryview(content)), self.HTML)
+        # repetitive HTML takes a fraction of its size
+        self.assertLess(len(encode_html(self.HTML, "zlib")) * 10, len(self.HTML.encode("utf-8")))
+
+    def testHashIdentifiesContent(self):
+        self.assertEqual(html_hash(self.HTML), html_hash(str(self.HTML)))
+        self.assertNotEqual(html_hash(self.HTML), html_hash(self.HTML + " "))
+        self.assertEqual(len(html_hash(self.HTML)), 64)
+
+    def testUnknownStorage(self):
+        with self.assertRaises(ValueError):
+            Pool(max_connections=1, html_storage="gzip")
+
+
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(Pool, "connect", side_effect=FakePoolConnection)
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testExhaustion(self):
+        pool = Pool(max_connections=2, timeout=0.1)
+        first, second = pool.getconn(), pool.getconn()
+        self.assertIsNot(first, second)
+        with self.assertRaises(psycopg2.pool.PoolError):
+            pool.getconn()
+        pool.putconn(second)
+        # returned connections are handed out again
+        self.assertIs(pool.getconn(), second)
+        self.assertEqual(self.connect.call_count, 2)
+
+    def testBlocking(self):
+        pool = Pool(max_connections=1)
+        connection = pool.getconn()
+        leased = []
+        waiting = threading.Thread(target=lambda: leased.append(pool.getconn()))
+        waiting.start()
+        waiting.join(0.2)
+        # waits for the leased connection instead of failing
+        self.assertTrue(waiting.is_alive())
+        pool.putconn(connection)
+        waiting.join(2)
+        self.assertListEqual(leased, [connection])
+
+    def testReturnedConnections(self):
+        pool = Pool(max_connections=1)
+        with pool.connection() as connection:
+            pass
+        # no round trip for a connection without an open transaction
+        self.assertEqual(connection.rollbacks, 0)
+        with pool.connection() as connection:
+            connection.in_transaction = True
+        self.assertEqual(connection.rollbacks, 1)
+        # a connection that was closed is replaced
+        with pool.connection() as connection:
+            connection.close()
+        with pool.connection() as new_connection:
+            self.assertIsNot(new_connection, connection)
+
+
+class TestWriteEdges(unittest.TestCase):
+    EDGES = [("http://evem.gov.si/", "http://evem.gov.si/a", "evem.gov.si"),
+             ("http://evem.gov.si/", "http://evem.gov.si/b", "evem.gov.si"),
+             ("http://evem.gov.si/", "http://evem.gov.si/a", "evem.gov.si"),
+             ("http://evem.gov.si/", "http://evem.gov.si/tab\tnew\nline", "evem.gov.si")]
+
+    def testDeduplication(self):
+        connection = FakeCopyConnection()
+        self.assertEqual(write_edges(connection, self.EDGES), 0)
+        # a single COPY, without the repeated edge and with escaped values
+        self.assertListEqual(connection.committed, [[
+            "http://evem.gov.si/\thttp://evem.gov.si/a\tevem.gov.si",
+            "http://evem.gov.si/\thttp://evem.gov.si/b\tevem.gov.si",
+            "http://evem.gov.si/\thttp://evem.gov.si/tab\\tnew\\nline\tevem.gov.si"]])
+
+    def testBadEdge(self):
+        connection = FakeCopyConnection(bad="/b")
+        # the other edges are written one by one
+        self.assertEqual(write_edges(connection, self.EDGES), 1)
+        self.assertEqual(len(connection.committed), 2)
+        self.assertListEqual([line.split("\t")[1] for copy in connection.committed for line in copy],
+                             ["http://evem.gov.si/a", "http://evem.gov.si/tab\\tnew\\nline"])
+
+
+class TestWriteEdgesInDatabase(unittest.TestCase):
+    """ Runs `write_edges` on the crawler's database (skipped if it is not running)."""
+    SOURCE = "http://test-edges.gov.si/"
+
+    def setUp(self):
+        try:
+            self.db = Database()
+        except psycopg2.Error as e:
+            self.skipTest("no database ({})".format(e))
+        self.addCleanup(self.db.close_connection)
+        self.addCleanup(self.cleanUp)
+        site_id = self.db.add_site_info_to_db("test-edges.gov.si", "", "")
+        self.db.add_page("test-edges.gov.si", "HTML", self.SOURCE, "<html></html>", 200, None)
+        self.db.add_page("test-edges.gov.si", "HTML", self.SOURCE + "a", "<html></html>", 200, None)
+        self.site_id = site_id
+
+    def cleanUp(self):
+        self.db.alter("""DELETE FROM link WHERE from_page IN (SELECT id FROM page WHERE url LIKE
+                         'http://test-edges.%%')""")
+        self.db.alter("DELETE FROM page WHERE url LIKE 'http://test-edges.%%'")
+        self.db.alter("DELETE FROM site WHERE domain LIKE 'test-edges.%%'")
+
+    def links(self):
+        return self.db.return_all("""SELECT t.url, t.page_type_code, t.site_id FROM link
+                                     JOIN page f ON f.id = link.from_page JOIN page t ON t.id = link.to_page
+                                     WHERE f.url = %s ORDER BY t.url""", [self.SOURCE])
+
+    def testUnknownTargets(self):
+        edges = [(self.SOURCE, self.SOURCE + "a", "test-edges.gov.si"),
+                 (self.SOURCE, self.SOURCE + "b", "test-edges.gov.si"),
+                 (self.SOURCE, self.SOURCE + "b", "test-edges.gov.si"),
+                 # a host that has no site yet
+                 (self.SOURCE, "http://test-edges.si/", "test-edges.si"),
+                 # the source is not in the database
+                 (self.SOURCE + "c", self.SOURCE + "d", "test-edges.gov.si")]
+        self.assertEqual(write_edges(self.db.connection, edges), 0)
+        self.assertListEqual(self.links(), [("http://test-edges.gov.si/a", "HTML", self.site_id),
+                                            ("http://test-edges.gov.si/b", "FRONTIER", self.site_id),
+                                            ("http://test-edges.si/", "FRONTIER", None)])
+        # its target is still a page to crawl, but there is no link to it
+        self.assertEqual(self.db.return_one("""SELECT count(*) FROM link JOIN page t ON t.id = link.to_page
+                                               WHERE t.url = %s""", [self.SOURCE + "d"]), (0,))
+
+    def testBadEdge(self):
+        edges = [(self.SOURCE, self.SOURCE + "a", "test-edges.gov.si"),
+                 (self.SOURCE, self.SOURCE + "x" * 3000, "test-edges.gov.si")]
+        self.assertEqual(write_edges(self.db.connection, edges), 1)
+        self.assertListEqual(self.links(), [("http://test-edges.gov.si/a", "HTML", self.site_id)])
+
+
+class TestIdCache(unittest.TestCase):
+    def testEviction(self):
+        cache = IdCache(max_size=2)
+        self.assertIsNone(cache.get("http://evem.gov.si/a"))
+        cache.put("http://evem.gov.si/a", 1)
+        cache.put("http://evem.gov.si/b", 2)
+        # a hit makes an entry the most recently used one
+        self.assertEqual(cache.get("http://evem.gov.si/a"), 1)
+        cache.put("http://evem.gov.si/c", 3)
+        self.assertIsNone(cache.get("http://evem.gov.si/b"))
+        self.assertEqual(cache.get("http://evem.gov.si/a"), 1)
+        self.assertEqual(cache.get("http://evem.gov.si/c"), 3)
+        # misses are not cached
+        cache.put("http://evem.gov.si/d", None)
+        self.assertEqual(len(cache.ids), 2)
+        cache.clear()
+        self.assertIsNone(cache.get("http://evem.gov.si/a"))
+
+
+class TestAddPage(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.db = Database(pool=self.server)
+
+    def testReturningId(self):
+        page_id = self.db.add_page("evem.gov.si", "HTML", "http://evem.gov.si/a", "<html></html>", 200, "ab")
+        self.assertEqual(page_id, 1)
+        self.assertListEqual(self.server.statements, ["site_id_by_domain", "insert_page"])
+        # the ids come from the caches, without a query
+        self.server.statements = []
+        self.assertEqual(self.db.page_id("http://evem.gov.si/a"), 1)
+        self.assertEqual(self.db.site_id("evem.gov.si"), 1)
+        self.assertListEqual(self.server.statements, [])
+
+    def testExistingPage(self):
+        self.server.pages["http://evem.gov.si/a"] = (7, "HTML")
+        # no row is returned for a page that was already crawled, so its id is looked up
+        page_id = self.db.add_page("evem.gov.si", "HTML", "http://evem.gov.si/a", "<html></html>", 200, "ab")
+        self.assertEqual(page_id, 7)
+        self.assertListEqual(self.server.statements, ["site_id_by_domain", "insert_page", "page_id_by_url"])
+        self.assertEqual(self.server.pages["http://evem.gov.si/a"], (7, "HTML"))
+
+    def testFrontierPage(self):
+        self.server.pages["http://evem.gov.si/a"] = (7, "FRONTIER")
+        self.assertIsNone(self.db.page_id("http://evem.gov.si/b"))
+        page_id = self.db.add_page("evem.gov.si", "HTML", "http://evem.gov.si/a", "<html></html>", 200, "ab")
+        self.assertEqual(page_id, 7)
+        self.assertEqual(self.server.pages["http://evem.gov.si/a"], (7, "HTML"))
+        # the miss was not cached, so a page added later is found
+        self.server.pages["http://evem.gov.si/b"] = (8, "FRONTIER")
+        self.assertEqual(self.db.page_id("http://evem.gov.si/b"), 8)
+
+    def testCacheEviction(self):
+        for idx in range(3):
+            self.db.add_page("evem.gov.si", "HTML", "http://evem.gov.si/{}".format(idx), None, 200, None)
+        self.server.statements = []
+        # the first page was evicted from the cache (of 2 entries)
+        self.assertEqual(self.db.page_id("http://evem.gov.si/0"), 1)
+        self.assertEqual(self.db.page_id("http://evem.gov.si/2"), 3)
+        self.assertListEqual(self.server.statements, ["page_id_by_url"])
+
+    def testStoredHtml(self):
+        self.server.html_storage = "zlib"
+        for url in ("http://evem.gov.si/a", "http://evem.gov.si/b"):
+            self.db.add_page("evem.gov.si", "HTML", url, "<html></html>", 200, "ab")
+        # the same HTML is only sent once
+        self.assertEqual(self.server.statements.count("insert_html"), 1)
+        self.assertSetEqual(self.server.html, {html_hash("<html></html>")})
+
+    def testInlineHtml(self):
+        self.db.add_page("evem.gov.si", "HTML", "http://evem.gov.si/a", "<html></html>", 200, "ab")
+        self.assertTupleEqual(self.server.page_html["http://evem.gov.si/a"], ("<html></html>", None))
+
+    def testGivenHash(self):
+        # the hash the crawler already computed (`crawler.page.Page.fingerprint`) is used as it is
+        self.server.html_storage = "none"
+        self.db.add_page("evem.gov.si", "HTML", "http://evem.gov.si/a", "<html></html>", 200, "ab",
+                         "f" * 64)
+        self.assertTupleEqual(self.server.page_html["http://evem.gov.si/a"], (None, "f" * 64))
+        self.assertSetEqual(self.server.html, {"f" * 64})
+
+
+class TestBulkWriter(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(db, "execute_values", fake_execute_values)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = FakePool()
+
+    def writer(self, **kwargs):
+        writer = BulkWriter(self.pool, **kwargs)
+        self.addCleanup(self.pool.gate.set)
+        return writer
+
+    def testBatchSize(self):
+        writer = self.writer(batch_size=3, flush_interval=10)
+        for idx in range(4):
+            writer.add("link", (1, idx))
+        self.assertTrue(wait_for(lambda: self.pool.batches))
+        time.sleep(0.1)
+        # a single statement for the first three rows, the fourth one waits
+        self.assertListEqual(self.pool.batches, [[(1, 0), (1, 1), (1, 2)]])
+        writer.close()
+        self.assertListEqual(self.pool.batches, [[(1, 0), (1, 1), (1, 2)], [(1, 3)]])
+        self.assertEqual(writer.num_written, 4)
+        self.assertEqual(self.pool.leased, 0)
+
+    def testFlushInterval(self):
+        writer = self.writer(batch_size=100, flush_interval=0.1)
+        writer.add("link", (1, 2))
+        self.assertTrue(wait_for(lambda: self.pool.batches))
+        self.assertListEqual(self.pool.rows(), [(1, 2)])
+        writer.close()
+
+    def testBackpressure(self):
+        writer = self.writer(batch_size=1, flush_interval=10, max_pending=2)
+        self.pool.gate.clear()
+        writer.add("link", (1, 0))
+        # the writer is stuck on the first row, so the queue fills up
+        self.assertTrue(wait_for(lambda: writer.queue.empty()))
+        writer.add("link", (1, 1))
+        writer.add("link", (1, 2))
+        blocked = threading.Thread(target=writer.add, args=("link", (1, 3)))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+
+        self.pool.gate.set()
+        blocked.join(2)
+        self.assertFalse(blocked.is_alive())
+        writer.close()
+        self.assertListEqual(self.pool.rows(), [(1, idx) for idx in range(4)])
+
+    def testFlushAndClose(self):
+        writer = self.writer(batch_size=100, flush_interval=10)
+        writer.add("link", (1, 2))
+        writer.add("image", (1, "a.png", "PNG", "ab12", 10, None))
+        writer.flush()
+        self.assertEqual(len(self.pool.batches), 2)
+        writer.add("link", (2, 3))
+        writer.close()
+        self.assertEqual(len(self.pool.batches), 3)
+        self.assertEqual(writer.num_written, 3)
+        # closing again and flushing after closing do nothing
+        writer.close()
+        writer.flush()
+        with self.assertRaises(ValueError):
+            writer.add("page", (1,))
+
+    def testWriteFailure(self):
+        writer = self.writer(batch_size=100, flush_interval=0.01)
+        # the server closed the connection (and rolling back fails too)
+        self.pool.failures = 2
+        writer.add("link", (1, 2))
+        writer.add("link", (1, 3))
+        writer.flush()
+        # written with a new connection
+        self.assertListEqual(self.pool.rows(), [(1, 2), (1, 3)])
+        self.assertEqual(self.pool.connections, 3)
+        writer.add("link", (1, 4))
+        writer.close()
+        self.assertEqual(writer.num_written, 3)
+        self.assertEqual(writer.num_failed, 0)
+        self.assertEqual(self.pool.leased, 0)
+
+    def testGivingUp(self):
+        writer = self.writer(batch_size=1, flush_interval=0.01, max_pending=1, max_failures=2)
+        self.pool.failures = 100
+        writer.add("link", (1, 2))
+        self.assertTrue(wait_for(lambda: writer.error is not None))
+        # neither blocks on the writer that is gone
+        with self.assertRaises(WriterFailed):
+            for idx in range(5):
+                writer.add("link", (1, idx))
+        with self.assertRaises(WriterFailed):
+            writer.flush()
+        with self.assertRaises(WriterFailed):
+            writer.close()
+        self.assertEqual(writer.num_failed, 1)
+        self.assertEqual(self.pool.leased, 0)
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from crawler.download import stream_to_file, DownloadTooLarge
+
+
+class FakeResponse:
+    def __init__(self, chunks, headers=None, error=None):
+        self.url = "http://evem.gov.si/vloga.pdf"
+        self.headers = headers if headers is not None else {}
+        self.chunks = chunks
+        self.error = error
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+class TestStreamToFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.directory.name, "evem.gov.si", "vloga.pdf")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def files(self):
+        return [name for _, _, names in os.walk(self.directory.name) for name in names]
+
+    def testSavesAndHashes(self):
+        response = FakeResponse([b"%PDF-", b"1.4", b"\n"])
+        download = stream_to_file(response, self.destination, max_bytes=100)
+        with open(self.destination, "rb") as f:
+            self.assertEqual(f.read(), b"%PDF-1.4\n")
+        self.assertEqual(download.sha256, hashlib.sha256(b"%PDF-1.4\n").hexdigest())
+        self.assertEqual(download.size, 9)
+        self.assertListEqual(self.files(), ["vloga.pdf"])
+        self.assertTrue(response.closed)
+
+    def testSizeCapFromHeader(self):
+        response = FakeResponse([b"x" * 10], headers={"Content-Length": "1000"})
+        self.assertRaises(DownloadTooLarge, stream_to_file, response, self.destination, max_bytes=100)
+        self.assertListEqual(self.files(), [])
+        self.assertTrue(response.closed)
+
+    def testNoPartialFiles(self):
+        response = FakeResponse([b"x" * 60, b"x" * 60])
+        self.assertRaises(DownloadTooLarge, stream_to_file, response, self.destination, max_bytes=100)
+        response = FakeResponse([b"x" * 60], error=ConnectionError("reset"))
+        self.assertRaises(ConnectionError, stream_to_file, response, self.destination, max_bytes=100)
+        self.assertListEqual(self.files(), [])
+
+    def testReplacesExistingFile(self):
+        stream_to_file(FakeResponse([b"old"]), self.destination)
+        stream_to_file(FakeResponse([b"new"]), self.destination)
+        with open(self.destination, "rb") as f:
+            self.assertEqual(f.read(), b"new")
@@ -0,0 +1,77 @@
+import unittest
+from bs4 import BeautifulSoup
+from crawler.core import find_links, get_base_href
+from crawler.extract import extract_page
+
+TEST_PAGE = """
+<html>
+<head><base href="http://www.evem.gov.si/sl/"><title>eVEM</title></head>
+<body>
+    <a href="/podjetje/">Podjetje</a>
+    <a href="#top">Na vrh</a>
+    <a href="?stran=2">Naslednja</a>
+    <a href="http://www.e-prostor.gov.si/ena/dva/tri/stiri/pet/sest/sedem/osem/devet/deset/enajst">Globoko</a>
+    <a href="/obrazci/vloga.pdf">Vloga</a>
+    <a>Brez povezave</a>
+    <a href="obrazci.html">Obrazci</a>
+    <a href="mailto:info@gov.si">Pisite nam</a>
+    <a href="/kontakt" onclick="window.location.href = 'http://evem.gov.si/kontakt/'">Kontakt</a>
+    <button onclick="top.location = 'http://evem.gov.si/prijava'">Prijava</button>
+    <button onclick="window.location.replace('http://evem.gov.si/odjava')">Odjava</button>
+    <img src="/fileadmin/logo.png">
+    <img src="http://evem.gov.si/slika.JPG">
+    <img src="#">
+    <img src="/ikona.gif">
+    <img>
+</body>
+</html>
+"""
+
+# links of TEST_PAGE: relative hrefs are resolved against the base href and hrefs that are not
+# http(s) URLs are dropped
+TEST_PAGE_LINKS = ["http://evem.gov.si/podjetje", "http://evem.gov.si/sl/?stran=2",
+                   "http://e-prostor.gov.si/ena/dva/tri/stiri/pet/sest/sedem/osem/devet/deset",
+                   "http://evem.gov.si/obrazci/vloga.pdf", "http://evem.gov.si/sl/obrazci.html",
+                   "http://evem.gov.si/kontakt"]
+TEST_PAGE_REDIRECTS = ["http://evem.gov.si/kontakt", "http://evem.gov.si/prijava",
+                       "http://evem.gov.si/odjava"]
+
+
+class TestExtractPage(unittest.TestCase):
+    def setUp(self):
+        self.soup = BeautifulSoup(TEST_PAGE, "lxml")
+        self.url = "http://evem.gov.si"
+
+    def testBaseHref(self):
+        self.assertEqual(extract_page(TEST_PAGE, self.url).base_href,
+                         get_base_href(self.soup, fallback=self.url))
+        self.assertEqual(extract_page("<a href='/x'>x</a>", self.url).base_href, self.url)
+
+    def testLinks(self):
+        self.assertListEqual(extract_page(TEST_PAGE, self.url).links, TEST_PAGE_LINKS)
+        self.assertListEqual(extract_page(TEST_PAGE, self.url, parse_js_redirects=True).links,
+                             TEST_PAGE_LINKS + TEST_PAGE_REDIRECTS)
+
+    def testFindLinks(self):
+        base_href = get_base_href(self.soup, fallback=self.url)
+        self.assertListEqual(find_links(base_href, self.soup), TEST_PAGE_LINKS)
+        self.assertListEqual(find_links(base_href, self.soup, parse_js_redirects=True),
+                             TEST_PAGE_LINKS + TEST_PAGE_REDIRECTS)
+
+    def testRedirects(self):
+        extracted = extract_page(TEST_PAGE, self.url, parse_js_redirects=True)
+        self.assertListEqual(extracted.redirects, TEST_PAGE_REDIRECTS)
+
+    def testImages(self):
+        # only .png, .jpeg and .jpg images are kept (case-sensitive, like `find_images`)
+        self.assertListEqual(extract_page(TEST_PAGE, self.url).images,
+                             ["http://www.evem.gov.si/fileadmin/logo.png"])
+
+    def testDocuments(self):
+        self.assertListEqual(extract_page(TEST_PAGE, self.url).documents,
+                             ["http://evem.gov.si/obrazci/vloga.pdf"])
+
+    def testEmptyPage(self):
+        extracted = extract_page("", self.url)
+        self.assertEqual(extracted.base_href, self.url)
+        self.assertListEqual(extracted.links, [])
@@ -0,0 +1,70 @@
+import unittest
+from os.path import dirname, join
+
+import requests
+
+from benchmarks.farm import FarmServer, generate_farm, load_recorded_farm, with_crawl_delay
+from crawler.page import Page
+
+
+class TestFarm(unittest.TestCase):
+    def testGenerateFarm(self):
+        farm = generate_farm(num_sites=2, pages_per_site=30, seed=1)
+        self.assertListEqual(farm.seeds, ["http://site-0.farm.gov.si/", "http://site-1.farm.gov.si/"])
+        self.assertEqual(farm.documents, generate_farm(num_sites=2, pages_per_site=30, seed=1).documents)
+
+        # every page can be reached from the root of its site
+        reached = set()
+        stack = [farm.seeds[0]]
+        while stack:
+            url = stack.pop()
+            document = farm.get(url)
+            if url in reached or document is None or not document.content_type.startswith("text/html"):
+                continue
+            reached.add(url)
+            stack.extend(Page(url, 200, {"Content-Type": document.content_type},
+                              document.body).extracted.links)
+        self.assertEqual(len(reached), 30)
+
+    def testCrawlDelay(self):
+        robots = with_crawl_delay("User-agent: *\nCrawl-delay: 10\nDisallow: /admin/\n", 0)
+        self.assertEqual(robots, "User-agent: *\nCrawl-delay: 0\nDisallow: /admin/\n")
+        self.assertTrue(with_crawl_delay("", 2).startswith("User-agent: *\nCrawl-delay: 2\n"))
+
+    def testRecordedFarm(self):
+        farm = load_recorded_farm(join(dirname(__file__), "..", "crawl_9_sites"), crawl_delay=0)
+        self.assertIn("http://evem.gov.si/", farm.seeds)
+        self.assertIsNotNone(farm.get("http://e-prostor.gov.si/robots.txt"))
+        self.assertEqual(farm.get("http://evem.gov.si").status, 200)
+        # crawl_2_sites has no URLs of its pages
+        with self.assertRaises(ValueError):
+            load_recorded_farm(join(dirname(__file__), "..", "crawl_2_sites"))
+
+    def testServer(self):
+        farm = generate_farm(num_sites=1, pages_per_site=10, crawl_delay=1)
+        server = FarmServer(farm)
+        try:
+            url = "http://{}:{}".format(*server.address)
+            response = requests.get(url + "/", headers={"Host": "site-0.farm.gov.si"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, farm.get(farm.seeds[0]).body)
+            response = requests.get(url + "/missing", headers={"Host": "site-0.farm.gov.si"})
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(server.requests["site-0.farm.gov.si"], 2)
+            response = requests.get(url + "/robots.txt", headers={"Host": "site-0.farm.gov.si"})
+            self.assertIn("Crawl-delay: 1\n", response.text)
+        finally:
+            server.close()
+
+    def testOutage(self):
+        farm = generate_farm(num_sites=2, pages_per_site=10)
+        server = FarmServer(farm, outages={"site-0.farm.gov.si": 60})
+        try:
+            url = "http://{}:{}/".format(*server.address)
+            response = requests.get(url, headers={"Host": "site-0.farm.gov.si"})
+            self.assertEqual(response.status_code, 503)
+            response = requests.get(url, headers={"Host": "site-1.farm.gov.si"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(server.failed["site-0.farm.gov.si"], 1)
+        finally:
+            server.close()
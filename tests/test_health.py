@@ -0,0 +1,175 @@
+import unittest
+from unittest import mock
+
+from crawler import health
+from crawler.health import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, RetryQueue
+from crawler.robots import Robots
+
+
+class ServerErrorRobots(Robots):
+    def read(self):
+        # like `RobotFileParser.read` after a 5xx response
+        pass
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestHealth(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(health, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testCircuitOpens(self):
+        breaker = CircuitBreaker(failure_threshold=3, open_seconds=10)
+        breaker.failure("evem.gov.si")
+        breaker.failure("evem.gov.si")
+        # a success resets the consecutive failures
+        breaker.success("evem.gov.si")
+        self.assertFalse(breaker.failure("evem.gov.si"))
+        self.assertFalse(breaker.failure("evem.gov.si"))
+        self.assertTrue(breaker.allow("evem.gov.si"))
+        self.assertTrue(breaker.failure("evem.gov.si"))
+        self.assertEqual(breaker.state("evem.gov.si"), OPEN)
+        # requests that were already made when the circuit opened fail too
+        self.assertTrue(breaker.failure("evem.gov.si"))
+        self.assertFalse(breaker.allow("evem.gov.si"))
+        self.assertEqual(breaker.blocked_until("evem.gov.si"), 1010)
+        # other hosts are not affected
+        self.assertTrue(breaker.allow("e-prostor.gov.si"))
+
+        breaker = CircuitBreaker(failure_threshold=0)
+        for _ in range(100):
+            breaker.failure("evem.gov.si")
+        self.assertTrue(breaker.allow("evem.gov.si"))
+
+    def testProbe(self):
+        breaker = CircuitBreaker(failure_threshold=1, open_seconds=10, max_open_seconds=30)
+        breaker.failure("evem.gov.si")
+        self.clock.now += 10
+        # only a single probe is let through
+        self.assertTrue(breaker.allow("evem.gov.si"))
+        self.assertEqual(breaker.state("evem.gov.si"), HALF_OPEN)
+        self.assertFalse(breaker.allow("evem.gov.si"))
+        self.assertEqual(breaker.blocked_until("evem.gov.si"), self.clock.now + 10)
+        # a probe without an outcome is replaced by another one
+        self.clock.now += 10
+        self.assertTrue(breaker.allow("evem.gov.si"))
+
+        # a failed probe opens the circuit for twice as long
+        self.assertTrue(breaker.failure("evem.gov.si"))
+        self.assertEqual(breaker.blocked_until("evem.gov.si"), self.clock.now + 20)
+        self.clock.now += 20
+        self.assertTrue(breaker.allow("evem.gov.si"))
+        breaker.failure("evem.gov.si")
+        self.assertEqual(breaker.blocked_until("evem.gov.si"), self.clock.now + 30)
+
+        self.clock.now += 30
+        self.assertTrue(breaker.allow("evem.gov.si"))
+        breaker.success("evem.gov.si")
+        self.assertEqual(breaker.state("evem.gov.si"), CLOSED)
+        self.assertTrue(breaker.allow("evem.gov.si"))
+        self.assertLess(breaker.blocked_until("evem.gov.si"), self.clock.now)
+
+    def testRetryBackoff(self):
+        retries = RetryQueue(max_attempts=4, base_delay=10, max_delay=30)
+        url = "http://evem.gov.si/a"
+        delays = []
+        for _ in range(3):
+            self.assertTrue(retries.retry(url, "timeout"))
+            self.assertIn(url, retries)
+            delays.append(retries.wait_time())
+            self.assertListEqual(retries.pop_due(), [])
+            self.clock.now += retries.wait_time()
+            self.assertListEqual(retries.pop_due(), [url])
+        self.assertListEqual(delays, [10, 20, 30])
+        # the fourth attempt was the last one
+        self.assertFalse(retries.retry(url, "timeout"))
+        self.assertEqual(len(retries), 0)
+        self.assertEqual(retries.wait_time(), 0)
+
+        retries.forget(url)
+        self.assertTrue(retries.retry(url, "503", not_before=self.clock.now + 60))
+        self.assertEqual(retries.wait_time(), 60)
+
+    def testRetryQueue(self):
+        retries = RetryQueue(max_attempts=3, base_delay=10)
+        retries.retry("http://evem.gov.si/b", "503", not_before=self.clock.now + 15)
+        retries.retry("http://evem.gov.si/a", "timeout")
+        retries.retry("http://evem.gov.si/c", "timeout")
+        self.assertEqual(retries.take("http://evem.gov.si/c"), self.clock.now + 10)
+        self.assertIsNone(retries.take("http://evem.gov.si/c"))
+        self.assertEqual(len(retries), 2)
+        self.clock.now += 20
+        self.assertListEqual(retries.pop_due(), ["http://evem.gov.si/a", "http://evem.gov.si/b"])
+
+        self.assertFalse(RetryQueue(max_attempts=1).retry("http://evem.gov.si/a", "timeout"))
+
+    def testRobotsUnavailable(self):
+        robots = ServerErrorRobots("http://evem.gov.si")
+        self.assertTrue(robots.unavailable())
+        self.assertFalse(robots.can_fetch("/"))
+        robots.parse(["User-agent: *", "Disallow: /admin/"])
+        self.assertFalse(robots.unavailable())
+        self.assertTrue(robots.can_fetch("/"))
+
+    def testPark(self):
+        retries = RetryQueue(max_attempts=2, base_delay=10, max_park_seconds=100)
+        url = "http://evem.gov.si/a"
+        # parking does not use up attempts
+        for _ in range(5):
+            self.assertTrue(retries.park(url, self.clock.now + 20))
+            self.assertEqual(retries.wait_time(), 20)
+            self.clock.now += 20
+            self.assertListEqual(retries.pop_due(), [url])
+        # but a URL is not parked forever
+        self.assertFalse(retries.park(url, self.clock.now + 20))
+        self.assertEqual(len(retries), 0)
+
+        self.assertTrue(retries.park(url, self.clock.now - 5))
+        self.assertEqual(retries.wait_time(), 0)
+        self.assertListEqual(retries.pop_due(), [url])
+        retries.forget(url)
+        self.assertTrue(retries.retry(url, "timeout"))
+
+    def testLongOutage(self):
+        # crawls the pages of a host that is down for two hours, like `crawler.core.Agent`
+        breaker = CircuitBreaker()
+        retries = RetryQueue()
+        down_until = self.clock.now + 2 * 3600
+        urls = ["http://evem.gov.si/{}".format(idx) for idx in range(20)]
+        crawled = []
+        dropped = []
+
+        def crawl(url):
+            if not breaker.allow("evem.gov.si"):
+                scheduled = retries.park(url, breaker.blocked_until("evem.gov.si"))
+            elif self.clock.now < down_until:
+                if breaker.failure("evem.gov.si"):
+                    scheduled = retries.park(url, breaker.blocked_until("evem.gov.si"))
+                else:
+                    scheduled = retries.retry(url, "timeout")
+            else:
+                breaker.success("evem.gov.si")
+                retries.forget(url)
+                crawled.append(url)
+                return
+            if not scheduled:
+                dropped.append(url)
+
+        for url in urls:
+            crawl(url)
+        while retries:
+            self.clock.now += retries.wait_time()
+            for url in retries.pop_due():
+                crawl(url)
+        self.assertListEqual(dropped, [])
+        self.assertCountEqual(crawled, urls)
+        self.assertEqual(breaker.state("evem.gov.si"), CLOSED)
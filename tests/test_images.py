@@ -0,0 +1,104 @@
+import threading
+import unittest
+from time import time
+from crawler.blobstore import Blob
+from crawler.db import WriterFailed
+from crawler.images import HOST_PRUNE_INTERVAL, ImageDownloader
+
+
+class FakeWriter:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, table, row):
+        self.rows.append((table, row))
+
+
+class FailingWriter:
+    def add(self, table, row):
+        raise WriterFailed("The database writer gave up")
+
+
+class CountingDownloader(ImageDownloader):
+    def __init__(self, *args, **kwargs):
+        self.downloads = []
+        self.release = threading.Event()
+        self.release.set()
+        super().__init__(*args, **kwargs)
+
+    def download(self, image_url):
+        self.release.wait()
+        self.downloads.append(image_url)
+        if "broken" in image_url:
+            raise IOError("404")
+        return Blob(image_url.rsplit('/', 1)[-1] + "-hash", 100, None)
+
+
+class TestImageDownloader(unittest.TestCase):
+    def setUp(self):
+        self.writer = FakeWriter()
+
+    def testEveryImageDownloadedOnce(self):
+        images = CountingDownloader(self.writer, None, workers=2)
+        images.release.clear()
+        images.submit("http://evem.gov.si/", ["http://evem.gov.si/logo.png", "http://evem.gov.si/a.jpg",
+                                              "http://evem.gov.si/logo.png"])
+        # submitted while the logo is still downloading
+        images.submit("http://evem.gov.si/b", ["http://evem.gov.si/logo.png", "http://evem.gov.si/broken.png"])
+        images.release.set()
+        images.join()
+        # submitted after the logo was downloaded
+        images.submit("http://evem.gov.si/c", ["http://evem.gov.si/logo.png", "http://evem.gov.si/broken.png"])
+        images.close()
+
+        self.assertEqual(sorted(images.downloads), ["http://evem.gov.si/a.jpg", "http://evem.gov.si/broken.png",
+                                                    "http://evem.gov.si/logo.png"])
+        self.assertEqual(sorted((row[0], row[1], row[3]) for table, row in self.writer.rows),
+                         [("http://evem.gov.si/", "a.jpg", "a.jpg-hash"),
+                          ("http://evem.gov.si/", "logo.png", "logo.png-hash"),
+                          ("http://evem.gov.si/b", "logo.png", "logo.png-hash"),
+                          ("http://evem.gov.si/c", "logo.png", "logo.png-hash")])
+        self.assertTrue(all(table == "image_by_url" for table, row in self.writer.rows))
+        self.assertEqual((images.num_downloaded, images.num_failed, images.num_reused), (2, 1, 1))
+
+    def testFullQueueDropsImages(self):
+        images = CountingDownloader(self.writer, None, workers=0, max_pending=1)
+        images.submit("http://evem.gov.si/", ["http://evem.gov.si/a.png", "http://evem.gov.si/b.png"])
+        self.assertEqual(images.num_dropped, 1)
+        # dropped images can be submitted again later
+        self.assertNotIn("http://evem.gov.si/b.png", images.states)
+
+    def testHostDelay(self):
+        images = ImageDownloader(self.writer, None, workers=0, host_delay=0.1)
+        start = time()
+        for _ in range(3):
+            images.wait_for_host("evem.gov.si")
+        images.wait_for_host("e-prostor.gov.si")
+        self.assertGreaterEqual(time() - start, 0.2)
+        self.assertLess(time() - start, 0.3)
+
+    def testForgetsOldImages(self):
+        images = CountingDownloader(self.writer, None, workers=1, max_images=2)
+        for name in ("a", "b", "c", "a"):
+            images.submit("http://evem.gov.si/", ["http://evem.gov.si/{}.png".format(name)])
+            images.join()
+        images.close()
+        # a.png was forgotten when c.png was downloaded
+        self.assertEqual(images.downloads, ["http://evem.gov.si/{}.png".format(name) for name in "abca"])
+        self.assertEqual(len(images.states), 2)
+
+    def testIdleHostsRemoved(self):
+        images = ImageDownloader(self.writer, None, workers=0, host_delay=0)
+        for idx in range(HOST_PRUNE_INTERVAL):
+            images.wait_for_host("site-{}.gov.si".format(idx))
+        self.assertLess(len(images.next_request), HOST_PRUNE_INTERVAL)
+
+    def testWriterFails(self):
+        images = CountingDownloader(FailingWriter(), None, workers=1)
+        images.submit("http://evem.gov.si/", ["http://evem.gov.si/a.png", "http://evem.gov.si/b.png"])
+        # the worker keeps going and close returns
+        closing = threading.Thread(target=images.close)
+        closing.start()
+        closing.join(2)
+        self.assertFalse(closing.is_alive())
+        self.assertEqual(images.num_downloaded, 2)
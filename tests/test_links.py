@@ -1,5 +1,5 @@
 import unittest
-from crawler.links import Links
+from crawler.links import Links, CanonicalizationRules
 
 
 class TestLocalitySensitiveHashing(unittest.TestCase):
@@ -40,3 +40,111 @@ class TestLocalitySensitiveHashing(unittest.TestCase):
 
         self.assertEqual(
             pruned, sanitized_short_link)
+
+    def testCanonicalizeMatchesSanitizePruneRemoveWww(self):
+        for url in ['http://www.evem.gov.si/',
+                    'http://evem.gov.si',
+                    'http://www.e-prostor.gov.si/ena/dva/',
+                    'https://evem.gov.si/ena/dva/tri/stiri/pet/sest/sedem/osem/devet/deset/enajst',
+                    'http://evem.gov.si/iskanje/?q=obrazec',
+                    'http://evem.gov.si/iskanje?']:
+            self.assertEqual(
+                Links.canonicalize(url).url,
+                Links.remove_www(Links.prune_to_max_depth(Links.sanitize(url), 10)))
+
+    def testCanonicalizeRecord(self):
+        canonical = Links.canonicalize('HTTP://www.Python.org/doc/?q=1#top')
+        self.assertEqual(canonical.scheme, 'http')
+        self.assertEqual(canonical.host, 'python.org')
+        self.assertEqual(canonical.path, '/doc/')
+        self.assertEqual(canonical.query, 'q=1')
+        self.assertEqual(canonical.url, 'http://python.org/doc/?q=1')
+        # hosts of different URLs on the same site are the same (interned) object
+        self.assertIs(Links.canonicalize('http://python.org/a').host,
+                      Links.canonicalize('http://www.python.org/b').host)
+
+    def testCanonicalizeAllSkipsNonHttpLinks(self):
+        canonical = Links.canonicalize_all(['mailto:info@gov.si', 'javascript:void(0)',
+                                            'http://evem.gov.si/', 'tel:+386'])
+        self.assertListEqual([c.url for c in canonical], ['http://evem.gov.si/'])
+
+
+class TestCanonicalizationRules(unittest.TestCase):
+    def testQueryParametersSortedAndIgnored(self):
+        rules = CanonicalizationRules(host_ignored_params={'evem.gov.si': ['stran']})
+        self.assertEqual(rules.apply('http://evem.gov.si/iskanje?b=2&a=1'),
+                         rules.apply('http://evem.gov.si/iskanje?a=1&b=2'))
+        self.assertEqual(rules.apply('http://www.evem.gov.si/iskanje?q=a&stran=2&utm_source=x&fbclid=1'),
+                         'http://evem.gov.si/iskanje?q=a')
+        # per-host parameters are only ignored on their host
+        self.assertEqual(rules.apply('http://e-prostor.gov.si/iskanje?stran=2'),
+                         'http://e-prostor.gov.si/iskanje?stran=2')
+
+    def testSessionIdInPathRemoved(self):
+        rules = CanonicalizationRules()
+        self.assertEqual(rules.apply('http://evem.gov.si/index.jsp;jsessionid=A1B2?PHPSESSID=3&id=1'),
+                         'http://evem.gov.si/index.jsp?id=1')
+
+    def testSchemeAndHostAliasesFolded(self):
+        rules = CanonicalizationRules(host_aliases={'e-prostor.si': 'e-prostor.gov.si'})
+        self.assertEqual(rules.apply('http://e-prostor.gov.si/a'), 'http://e-prostor.gov.si/a')
+        # first seen scheme for a host wins
+        self.assertEqual(rules.apply('https://www.e-prostor.si/a'), 'http://e-prostor.gov.si/a')
+
+        rules = CanonicalizationRules(scheme='https')
+        self.assertEqual(rules.apply('http://evem.gov.si/a'), 'https://evem.gov.si/a')
+
+    def testApplyAllRemovesVariants(self):
+        rules = CanonicalizationRules()
+        self.assertListEqual(rules.apply_all(['http://evem.gov.si/?a=1&b=2', 'mailto:info@gov.si',
+                                              'https://evem.gov.si/?b=2&a=1&utm_medium=email']),
+                             ['http://evem.gov.si/?a=1&b=2'])
+
+    def testLearningFromDuplicates(self):
+        rules = CanonicalizationRules(learn_threshold=2)
+        self.assertEqual(rules.apply('http://evem.gov.si/novica?id=1&tab=2'),
+                         'http://evem.gov.si/novica?id=1&tab=2')
+        self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/novica?id=1&tab=2',
+                                                     'http://evem.gov.si/novica?id=1&tab=1'), [])
+        # different path, so this one does not count
+        self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/drugo?tab=2',
+                                                     'http://evem.gov.si/novica?tab=1'), [])
+        self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/novica?id=7&tab=3',
+                                                     'http://evem.gov.si/novica?id=7'), ['tab'])
+        self.assertEqual(rules.apply('http://evem.gov.si/novica?id=1&tab=2'),
+                         'http://evem.gov.si/novica?id=1')
+
+    def testLearningGuards(self):
+        rules = CanonicalizationRules(learn_threshold=2)
+        # the same two values every time
+        for _ in range(5):
+            self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/a?tab=2',
+                                                         'http://evem.gov.si/a?tab=1'), [])
+        self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/a?tab=3',
+                                                     'http://evem.gov.si/a?tab=1'), ['tab'])
+        # more than one differing parameter (tracking parameters are not counted)
+        for idx in range(5):
+            self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/b?view={}&sort=a'.format(idx),
+                                                         'http://evem.gov.si/b?sort=b'), [])
+        self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/b?view=7&utm_source=x',
+                                                     'http://evem.gov.si/b'), [])
+        self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/b?view=8',
+                                                     'http://evem.gov.si/b?view=9'), ['view'])
+        # e.g. empty search results and pages past the last one
+        for idx in range(5):
+            self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/iskanje?q={}'.format(idx),
+                                                         'http://evem.gov.si/iskanje?q=x'), [])
+            self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/novice?page={}'.format(idx),
+                                                         'http://evem.gov.si/novice?page=99'), [])
+        self.assertEqual(rules.apply('http://evem.gov.si/iskanje?q=1&page=2'),
+                         'http://evem.gov.si/iskanje?page=2&q=1')
+
+        rules = CanonicalizationRules(learn_threshold=1, learn_min_values=1, never_learned_params=[])
+        self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/novice?page=2',
+                                                     'http://evem.gov.si/novice'), ['page'])
+
+    def testLearningDisabledByDefault(self):
+        rules = CanonicalizationRules()
+        for _ in range(10):
+            self.assertListEqual(rules.observe_duplicate('http://evem.gov.si/a?tab=2',
+                                                         'http://evem.gov.si/a?tab=1'), [])
@@ -0,0 +1,77 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from crawler.memory import LinkSpill, MemoryMonitor, descendant_pids, estimate_size, process_rss
+
+
+class TestMemory(unittest.TestCase):
+    def testLinkSpill(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spill = LinkSpill(directory)
+            self.assertListEqual(spill.load(10), [])
+            spill.add(["http://evem.gov.si/{}".format(idx) for idx in range(5)])
+            spill.add(["http://e-prostor.gov.si/"])
+            self.assertEqual(len(spill), 6)
+            self.assertListEqual(spill.load(4), ["http://evem.gov.si/{}".format(idx) for idx in range(4)])
+            self.assertListEqual(spill.load(4), ["http://evem.gov.si/4", "http://e-prostor.gov.si/"])
+            # the file is removed once everything was loaded
+            self.assertEqual(len(spill), 0)
+            self.assertListEqual(os.listdir(directory), [])
+            # spills with different names do not share a file
+            next_spill = LinkSpill(directory, name="next-links")
+            spill.add(["http://evem.gov.si/"])
+            next_spill.add(["http://e-prostor.gov.si/"])
+            self.assertListEqual(next_spill.load(10), ["http://e-prostor.gov.si/"])
+            self.assertListEqual(spill.load(10), ["http://evem.gov.si/"])
+        finally:
+            shutil.rmtree(directory)
+
+    def testEstimateSize(self):
+        small = {"http://evem.gov.si/{}".format(idx) for idx in range(100)}
+        large = {"http://evem.gov.si/{}".format(idx) for idx in range(10000)}
+        self.assertGreater(estimate_size(small), sys.getsizeof(small))
+        self.assertGreater(estimate_size(large), 50 * estimate_size(small))
+        self.assertGreater(estimate_size({"evem.gov.si": 1.0}), sys.getsizeof({}))
+
+    def testProcesses(self):
+        self.assertGreater(process_rss(), 0)
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+        try:
+            self.assertIn(child.pid, descendant_pids())
+            self.assertGreater(process_rss(child.pid), 0)
+        finally:
+            child.kill()
+            child.wait()
+
+    def testBrowserProcesses(self):
+        browser = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+        worker = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+        try:
+            # only the processes of the browsers count, not e.g. analysis workers
+            browser_pids = [browser.pid]
+            monitor = MemoryMonitor({}, browser_pids=lambda: browser_pids)
+            self.assertAlmostEqual(monitor.measure()["browser_rss_mb"],
+                                   process_rss(browser.pid) / 2 ** 20, delta=1)
+            browser_pids = []
+            self.assertEqual(monitor.measure()["browser_rss_mb"], 0)
+        finally:
+            for child in (browser, worker):
+                child.kill()
+                child.wait()
+
+    def testSoftLimits(self):
+        calls = []
+        monitor = MemoryMonitor({}, limits={"rss_mb": 100, "browser_rss_mb": 0},
+                                actions={"rss_mb": (lambda: calls.append("pause"),
+                                                    lambda: calls.append("resume"))})
+        monitor.check({"rss_mb": 50, "browser_rss_mb": 5000})
+        monitor.check({"rss_mb": 150, "browser_rss_mb": 0})
+        monitor.check({"rss_mb": 120, "browser_rss_mb": 0})
+        # between 90% of the limit and the limit nothing changes
+        monitor.check({"rss_mb": 95, "browser_rss_mb": 0})
+        monitor.check({"rss_mb": 80, "browser_rss_mb": 0})
+        self.assertListEqual(calls, ["pause", "pause", "resume"])
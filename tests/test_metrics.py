@@ -0,0 +1,50 @@
+import json
+import unittest
+from urllib.request import urlopen
+from crawler.metrics import Histogram, Metrics, MetricsServer
+
+
+class TestMetrics(unittest.TestCase):
+    def testHistogramQuantiles(self):
+        histogram = Histogram()
+        for idx in range(1, 101):
+            histogram.add(idx / 1000)
+        stats = histogram.stats()
+        self.assertEqual(stats["count"], 100)
+        self.assertAlmostEqual(stats["mean"], 0.0505)
+        self.assertEqual(stats["max"], 0.1)
+        # estimates are within their (power of two) bucket
+        self.assertTrue(0.032 <= stats["p50"] <= 0.064)
+        self.assertTrue(0.064 <= stats["p99"] <= 0.1)
+
+    def testTimerLabels(self):
+        metrics = Metrics()
+        with metrics.timer("fetch", host="evem.gov.si") as labels:
+            labels["status"] = 200
+        with self.assertRaises(IOError):
+            with metrics.timer("fetch", host="evem.gov.si"):
+                raise IOError("connection reset")
+        metrics.count("pages", host="evem.gov.si", status=200)
+        metrics.count("pages", host="evem.gov.si", status=200)
+
+        snapshot = metrics.snapshot()
+        self.assertListEqual(sorted(histogram["labels"]["status"] for histogram in snapshot["histograms"]),
+                             ["200", "error"])
+        self.assertListEqual(snapshot["counters"], [{"name": "pages", "value": 2,
+                                                     "labels": {"host": "evem.gov.si", "status": "200"}}])
+        self.assertEqual(metrics.totals()["fetch"]["count"], 2)
+
+    def testServer(self):
+        metrics = Metrics()
+        metrics.observe("render", 0.3, host="evem.gov.si", status="ok")
+        server = MetricsServer(metrics, port=0)
+        try:
+            base_url = "http://{}:{}".format(*server.address)
+            text = urlopen(base_url + "/metrics").read().decode("utf-8")
+            self.assertIn('crawler_render_seconds_count{host="evem.gov.si",status="ok"} 1', text)
+            self.assertIn('crawler_render_seconds_bucket{host="evem.gov.si",status="ok",le="+Inf"} 1',
+                          text)
+            snapshot = json.loads(urlopen(base_url + "/metrics.json").read())
+            self.assertEqual(snapshot["histograms"][0]["sum"], 0.3)
+        finally:
+            server.close()
@@ -0,0 +1,36 @@
+import unittest
+from unittest import mock
+
+from benchmarks.micro import BENCHMARKS, FIXTURE_SIZES, compare, html_fixture, measure, run_suite, \
+    save_images_stub
+from crawler import core
+
+
+class TestMicro(unittest.TestCase):
+    def testFixtures(self):
+        self.assertEqual(html_fixture(10), html_fixture(10))
+        self.assertGreater(len(html_fixture(100)), 5 * len(html_fixture(10)))
+
+    def testBenchmarksRun(self):
+        # every benchmarked function works on the smallest fixtures
+        with mock.patch.object(core, "save_images", save_images_stub):
+            for name, (sizes, setup) in BENCHMARKS.items():
+                with self.subTest(name=name):
+                    setup(FIXTURE_SIZES["small"])()
+
+    def testMeasure(self):
+        result = measure(lambda: sum(range(100)), min_time=0.001, repeat=3)
+        self.assertEqual(result["repeat"], 3)
+        self.assertGreater(result["loops"], 1)
+        self.assertLessEqual(result["best"], result["median"])
+        run = run_suite(r"^links_remove_www\[small\]$", min_time=0.001, repeat=1)
+        self.assertListEqual(list(run["results"]), ["links_remove_www[small]"])
+
+    def testCompare(self):
+        baseline = {"results": {"a": {"best": 1.0}, "b": {"best": 1.0}, "c": {"best": 1.0},
+                                "d": {"best": 1.0}}}
+        current = {"results": {"a": {"best": 1.05}, "b": {"best": 1.2}, "c": {"best": 0.5},
+                               "e": {"best": 1.0}}}
+        statuses = {row[0]: row[-1] for row in compare(baseline, current, threshold=0.1)}
+        self.assertDictEqual(statuses, {"a": "ok", "b": "regression", "c": "improvement",
+                                        "d": "missing", "e": "new"})
@@ -0,0 +1,55 @@
+import unittest
+from crawler.db import html_hash
+from crawler.page import Page
+from crawler.lsh import LocalitySensitiveHashing
+
+
+class CountingLSH(LocalitySensitiveHashing):
+    def __init__(self):
+        super().__init__(vocab=["a", "b", "c"], num_hash=1, hash_funcs=[lambda idx: idx],
+                         num_bands=1)
+        self.num_calls = 0
+
+    def compute_signature(self, doc):
+        self.num_calls += 1
+        return super().compute_signature(doc)
+
+
+class TestPage(unittest.TestCase):
+    def testTextDecodedFromRaw(self):
+        page = Page("http://evem.gov.si", raw="<p>Čžš</p>".encode("utf-8"))
+        self.assertEqual(page.text, "<p>Čžš</p>")
+        self.assertEqual(page.lowered, "<p>čžš</p>")
+
+    def testRenderedTextOverridesRaw(self):
+        page = Page("http://evem.gov.si", raw=b"<p>raw</p>")
+        page.text = "<p>Rendered</p>"
+        self.assertEqual(page.html, "<p>Rendered</p>")
+
+    def testSignatureComputedOnce(self):
+        lsh_obj = CountingLSH()
+        page = Page("http://evem.gov.si", text="abc")
+        self.assertEqual(page.lsh_hash(lsh_obj), page.lsh_hash(lsh_obj))
+        self.assertEqual(lsh_obj.num_calls, 1)
+
+    def testBinaryPage(self):
+        page = Page("http://evem.gov.si/vloga.pdf", headers={"Content-Type": "application/pdf"})
+        self.assertIsNone(page.html)
+        self.assertIsNone(page.fingerprint)
+        self.assertIsNone(page.lsh_hash(CountingLSH()))
+        self.assertEqual(page.content_type, "application/pdf")
+
+    def testExtractedLinks(self):
+        page = Page("http://evem.gov.si", text='<a href="/podjetje/">Podjetje</a>')
+        self.assertListEqual(page.extracted.links, ["http://evem.gov.si/podjetje"])
+
+    def testParsedUrl(self):
+        page = Page("http://evem.gov.si/podjetje?stran=2")
+        self.assertIs(page.parsed_url, page.parsed_url)
+        self.assertEqual(page.site_url, "evem.gov.si")
+        self.assertEqual(page.parsed_url.path, "/podjetje")
+
+    def testFingerprint(self):
+        page = Page("http://evem.gov.si", raw="<p>Čžš</p>".encode("utf-8"))
+        # the key of the page's HTML in html_store
+        self.assertEqual(page.fingerprint, html_hash("<p>Čžš</p>"))
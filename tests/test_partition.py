@@ -0,0 +1,99 @@
+import unittest
+from queue import Queue
+from crawler.partition import HashRing, PartitionWorker, LINKS, VISITED, RING, STOP
+
+
+class FakeAgent:
+    def __init__(self):
+        self.visited = set()
+
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.hosts = ["host{}.gov.si".format(idx) for idx in range(2000)]
+
+    def testDeterministic(self):
+        ring, other_ring = HashRing([0, 1, 2]), HashRing([2, 1, 0])
+        self.assertListEqual([ring.node_for(host) for host in self.hosts],
+                             [other_ring.node_for(host) for host in self.hosts])
+        self.assertIsNone(HashRing().node_for("evem.gov.si"))
+
+    def testBalanced(self):
+        ring = HashRing(range(4))
+        counts = [0] * 4
+        for host in self.hosts:
+            counts[ring.node_for(host)] += 1
+        for count in counts:
+            self.assertGreater(count, len(self.hosts) / 4 * 0.7)
+
+    def testAddingNodeOnlyMovesHostsToIt(self):
+        ring = HashRing(range(4))
+        before = {host: ring.node_for(host) for host in self.hosts}
+        ring.add(4)
+        moved = [host for host in self.hosts if ring.node_for(host) != before[host]]
+        self.assertTrue(all(ring.node_for(host) == 4 for host in moved))
+        self.assertLess(len(moved), len(self.hosts) / 5 * 1.3)
+
+    def testRemovingNodeOnlyMovesItsHosts(self):
+        ring = HashRing(range(4))
+        before = {host: ring.node_for(host) for host in self.hosts}
+        ring.remove(2)
+        for host in self.hosts:
+            if before[host] != 2:
+                self.assertEqual(ring.node_for(host), before[host])
+            else:
+                self.assertNotEqual(ring.node_for(host), 2)
+
+    def testPartition(self):
+        ring = HashRing([0, 1])
+        partitions = ring.partition(["http://evem.gov.si/a", "http://www.evem.gov.si/b", "mailto:a@b.si"])
+        self.assertListEqual(list(partitions.values()),
+                             [["http://evem.gov.si/a", "http://www.evem.gov.si/b"]])
+
+
+class TestPartitionWorker(unittest.TestCase):
+    def setUp(self):
+        self.ring = HashRing([0, 1])
+        self.hosts = ["host{}.gov.si".format(idx) for idx in range(20)]
+        self.own = [host for host in self.hosts if self.ring.node_for(host) == 0]
+        self.foreign = [host for host in self.hosts if self.ring.node_for(host) == 1]
+        self.outbox = Queue()
+        self.worker = PartitionWorker(0, self.ring, Queue(), self.outbox, FakeAgent(), batch_size=2)
+
+    def sent(self, kind):
+        urls = []
+        while not self.outbox.empty():
+            message = self.outbox.get()
+            if message[0] == kind:
+                self.assertLessEqual(len(message[2]), 2)
+                urls.extend(message[2])
+        return urls
+
+    def testRoute(self):
+        self.worker.agent.visited.add("http://{}/crawled".format(self.own[0]))
+        urls = ["http://{}/".format(host) for host in self.hosts] + \
+               ["http://{}/crawled".format(self.own[0])]
+        self.worker.handle((LINKS, urls))
+        self.assertSetEqual(self.worker.pending, {"http://{}/".format(host) for host in self.own})
+        self.assertListEqual(self.sent(LINKS), ["http://{}/".format(host) for host in self.foreign])
+        self.assertEqual(self.worker.num_received, 1)
+
+    def testHandOverOnNewRing(self):
+        urls = ["http://{}/".format(host) for host in self.own]
+        self.worker.agent.visited.update(url + "crawled" for url in urls)
+        self.worker.handle((LINKS, urls))
+
+        self.worker.handle((RING, [0, 1, 2]))
+        new_ring = HashRing([0, 1, 2])
+        moved = [url for url in urls if new_ring.node_for(url[7:-1]) == 2]
+        self.assertSetEqual(self.worker.pending, set(urls) - set(moved))
+        self.assertSetEqual(set(self.sent(LINKS)), set(moved))
+
+    def testStopHandsOverEverything(self):
+        urls = ["http://{}/".format(host) for host in self.own]
+        self.worker.agent.visited.add("http://{}/crawled".format(self.own[0]))
+        self.worker.handle((LINKS, urls))
+        self.worker.handle((STOP,))
+        self.assertFalse(self.worker.running)
+        self.assertSetEqual(self.worker.pending, set())
+        self.assertListEqual(self.sent(VISITED), ["http://{}/crawled".format(self.own[0])])
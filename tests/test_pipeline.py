@@ -0,0 +1,52 @@
+import threading
+import unittest
+from time import sleep
+from crawler.pipeline import Pipeline, Stage
+
+
+class TestPipeline(unittest.TestCase):
+    def testItemsPassAllStages(self):
+        finished = []
+        lock = threading.Lock()
+
+        def finish(item):
+            with lock:
+                finished.append(item)
+
+        pipeline = Pipeline([Stage("double", lambda item: item.append(item[0] * 2) or True, workers=3),
+                             # odd numbers finish early
+                             Stage("filter", lambda item: item[0] % 2 == 0, workers=2),
+                             Stage("fail", lambda item: item[0] != 4 or 1 / 0, workers=1)],
+                            on_finish=finish)
+        pipeline.start()
+        for number in range(10):
+            pipeline.put([number])
+        pipeline.join()
+        pipeline.stop()
+
+        self.assertListEqual(sorted(finished), [[number, number * 2] for number in range(10)])
+        stats = pipeline.stats()
+        self.assertEqual(stats["double"]["processed"], 10)
+        self.assertEqual(stats["double"]["finished"], 0)
+        self.assertEqual(stats["filter"]["finished"], 5)
+        self.assertEqual(stats["fail"]["processed"], 5)
+        self.assertEqual(stats["fail"]["failed"], 1)
+
+    def testBoundedQueues(self):
+        release = threading.Event()
+        pipeline = Pipeline([Stage("fast", lambda item: True, workers=1, queue_size=2),
+                             Stage("slow", lambda item: release.wait() or True, workers=1, queue_size=2)])
+        pipeline.start()
+        producer = threading.Thread(target=lambda: [pipeline.put(idx) for idx in range(20)])
+        producer.start()
+        sleep(0.2)
+        # 1 item in the slow worker, 2 in its queue, 1 blocked in the fast worker, 2 in its queue
+        stats = pipeline.stats()
+        self.assertEqual(stats["slow"]["queued"], 2)
+        self.assertEqual(stats["fast"]["queued"], 2)
+        self.assertTrue(producer.is_alive())
+
+        release.set()
+        producer.join()
+        pipeline.stop()
+        self.assertEqual(pipeline.stats()["slow"]["processed"], 20)
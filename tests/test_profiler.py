@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from crawler.profiler import SamplingProfiler, thread_role
+
+
+def spin(stopped):
+    while not stopped.is_set():
+        sum(range(1000))
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testThreadRole(self):
+        self.assertEqual(thread_role("fetch-3"), "fetch")
+        self.assertEqual(thread_role("frontier-worker-12"), "frontier-worker")
+        self.assertEqual(thread_role("Thread-7 (worker_task)"), "worker_task")
+        self.assertEqual(thread_role("MainThread"), "MainThread")
+
+    def testSamplesPerRole(self):
+        stopped = threading.Event()
+        workers = [threading.Thread(target=spin, args=(stopped,), name="parse-{}".format(idx))
+                   for idx in range(2)]
+        for worker in workers:
+            worker.start()
+        try:
+            profiler = SamplingProfiler(self.directory, duration=0.2, interval=0.005)
+            self.assertTrue(profiler.start())
+            # only one profile at a time
+            self.assertFalse(profiler.start())
+            profiler.join()
+        finally:
+            stopped.set()
+            for worker in workers:
+                worker.join()
+
+        names = os.listdir(self.directory)
+        self.assertIn("MainThread", " ".join(names))
+        parse_name, = [name for name in names if name.endswith("-parse.collapsed")]
+        with open(os.path.join(self.directory, parse_name)) as output:
+            lines = output.read().splitlines()
+        # stacks start with the outermost frame and end with the number of samples
+        self.assertTrue(all(line.startswith("_bootstrap (threading.py:") for line in lines))
+        self.assertTrue(any(";spin (test_profiler.py:" in line for line in lines))
+        # samples of both threads are in the same file
+        self.assertGreater(sum(int(line.rsplit(" ", 1)[1]) for line in lines), 20)
@@ -0,0 +1,78 @@
+import unittest
+from datetime import datetime, timezone
+from time import time
+
+from crawler.ratelimit import RateController, parse_retry_after
+from crawler.robots import Robots
+
+
+class TextRobots(Robots):
+    text = ""
+
+    def read(self):
+        self.parse(self.text.splitlines())
+
+
+class TestRateLimit(unittest.TestCase):
+    def testAdditiveIncrease(self):
+        controller = RateController(initial_delay=2, min_delay=0.5, increase=0.5)
+        self.assertEqual(controller.delay("evem.gov.si"), 2)
+        controller.feedback("evem.gov.si", 200, 0.1)
+        # rate 0.5 -> 1 request per second
+        self.assertAlmostEqual(controller.delay("evem.gov.si"), 1.0)
+        for _ in range(10):
+            controller.feedback("evem.gov.si", 200, 0.1)
+        self.assertEqual(controller.delay("evem.gov.si"), 0.5)
+        # other hosts are not affected
+        self.assertEqual(controller.delay("e-prostor.gov.si"), 2)
+
+    def testMultiplicativeBackoff(self):
+        controller = RateController(initial_delay=1, min_delay=0.5, max_delay=10, backoff=2,
+                                    slow_latency=5)
+        controller.feedback("evem.gov.si", 503, 0.1)
+        self.assertEqual(controller.delay("evem.gov.si"), 2)
+        controller.feedback("evem.gov.si", timeout=True)
+        self.assertEqual(controller.delay("evem.gov.si"), 4)
+        controller.feedback("evem.gov.si", 200, 6.0)
+        self.assertEqual(controller.delay("evem.gov.si"), 8)
+        controller.feedback("evem.gov.si", 429)
+        self.assertEqual(controller.delay("evem.gov.si"), 10)
+
+    def testSlowerThanUsual(self):
+        controller = RateController(initial_delay=1, min_delay=0, increase=0, latency_factor=3)
+        controller.feedback("evem.gov.si", 200, 0.5)
+        # slower than usual, but faster than MIN_SLOW_LATENCY
+        controller.feedback("evem.gov.si", 200, 0.9)
+        self.assertEqual(controller.delay("evem.gov.si"), 1)
+        controller.feedback("evem.gov.si", 200, 2.0)
+        self.assertEqual(controller.delay("evem.gov.si"), 2)
+
+    def testRobotsDelay(self):
+        controller = RateController(initial_delay=3, min_delay=0.5, increase=10, max_delay=2)
+        controller.set_robots_delay("evem.gov.si", 5)
+        self.assertEqual(controller.delay("evem.gov.si"), 5)
+        controller.feedback("evem.gov.si", 200, 0.1)
+        self.assertEqual(controller.delay("evem.gov.si"), 5)
+        # backing off never goes below the robots delay either
+        controller.feedback("evem.gov.si", 503, 0.1)
+        self.assertEqual(controller.delay("evem.gov.si"), 5)
+
+        TextRobots.text = "User-agent: *\nCrawl-delay: 2\nRequest-rate: 1/10\n"
+        self.assertEqual(TextRobots("http://evem.gov.si").explicit_delay(), 10)
+        TextRobots.text = "User-agent: *\nDisallow: /admin/\n"
+        robots = TextRobots("http://evem.gov.si")
+        self.assertIsNone(robots.explicit_delay())
+        self.assertEqual(robots.crawl_delay(), 3)
+
+    def testRetryAfter(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertIsNone(parse_retry_after(None))
+        now = datetime(2019, 4, 2, 10, 0, 0, tzinfo=timezone.utc)
+        self.assertEqual(parse_retry_after("Tue, 02 Apr 2019 10:01:30 GMT", now=now), 90)
+
+        controller = RateController(initial_delay=1, min_delay=0, max_retry_after=60)
+        self.assertEqual(controller.wait_time("evem.gov.si", None), 0)
+        controller.feedback("evem.gov.si", 429, 0.1, retry_after="3600")
+        self.assertAlmostEqual(controller.wait_time("evem.gov.si", None), 60, delta=1)
+        self.assertAlmostEqual(controller.wait_time("e-prostor.gov.si", time()), 1, delta=0.1)
@@ -0,0 +1,47 @@
+import unittest
+from crawler.scope import Scope, ScopeRule
+
+
+class TestScope(unittest.TestCase):
+    def setUp(self):
+        self.scope = Scope([ScopeRule('gov.si', max_depth=3),
+                            ScopeRule('e-prostor.gov.si', exclude=['^/fileadmin/global/']),
+                            ScopeRule('evem.gov.si', include=['^/$', '^/podjetje'])])
+
+    def testHostSuffix(self):
+        self.assertTrue(self.scope.allows('http://gov.si'))
+        self.assertTrue(self.scope.allows('http://www.mz.gov.si/ena'))
+        self.assertTrue(self.scope.allows('https://podatki.gov.si:443/ena'))
+        # substring matching would let these in
+        self.assertFalse(self.scope.allows('http://evem.gov.si.example.com/'))
+        self.assertFalse(self.scope.allows('http://notgov.si/'))
+        self.assertFalse(self.scope.allows('http://google.com/?q=evem.gov.si'))
+        self.assertFalse(self.scope.allows('mailto:info@gov.si'))
+
+    def testMostSpecificRuleWins(self):
+        self.assertFalse(self.scope.allows('http://e-prostor.gov.si/fileadmin/global/x.pdf'))
+        self.assertTrue(self.scope.allows('http://e-prostor.gov.si/fileadmin/drugo/x.pdf'))
+        # depth cap of 'gov.si' does not apply to 'e-prostor.gov.si'
+        self.assertTrue(self.scope.allows('http://e-prostor.gov.si/a/b/c/d/e'))
+        self.assertTrue(self.scope.allows('http://evem.gov.si/'))
+        self.assertTrue(self.scope.allows('http://evem.gov.si/podjetje/vloge'))
+        self.assertFalse(self.scope.allows('http://evem.gov.si/iskanje'))
+
+    def testDepthCap(self):
+        self.assertTrue(self.scope.allows('http://mz.gov.si/a/b/c'))
+        self.assertTrue(self.scope.allows('http://mz.gov.si/a/b/c/'))
+        self.assertFalse(self.scope.allows('http://mz.gov.si/a/b/c/d'))
+
+    def testFilter(self):
+        links = ['http://evem.gov.si/podjetje', 'http://google.com', 'http://mz.gov.si/a',
+                 'http://evem.gov.si/iskanje', 'javascript:void(0)']
+        self.assertListEqual(self.scope.filter(links),
+                             ['http://evem.gov.si/podjetje', 'http://mz.gov.si/a'])
+
+    def testFromConfig(self):
+        scope = Scope.from_config({'scope': [{'host': 'evem.gov.si'},
+                                             {'host': 'e-prostor.gov.si', 'max_depth': 1}]})
+        self.assertListEqual(scope.filter(['http://evem.gov.si/a/b', 'http://e-prostor.gov.si/a/b',
+                                           'http://mz.gov.si/']),
+                             ['http://evem.gov.si/a/b'])
+        self.assertListEqual(Scope.from_config({}).filter(['http://evem.gov.si/']), [])
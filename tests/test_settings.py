@@ -0,0 +1,59 @@
+import unittest
+from os.path import dirname, join
+from tempfile import NamedTemporaryFile
+
+from crawler.links import CanonicalizationRules
+from crawler.scope import Scope
+from crawler.settings import SettingsReader, merge
+
+CONFIG_PATH = join(dirname(__file__), "..", "crawler", "config.yaml")
+
+
+class TestSettings(unittest.TestCase):
+    def testMerge(self):
+        defaults = {"database": {"batch_size": 500, "max_pending": 10000},
+                    "pipeline": {"enabled": False,
+                                 "stages": {"fetch": {"workers": 10, "queue_size": 100}}},
+                    "scope": [{"host": "evem.gov.si"}, {"host": "e-prostor.gov.si"}]}
+        custom = {"database": {"batch_size": 50},
+                  "pipeline": {"stages": {"fetch": {"workers": 2}}},
+                  "scope": [{"host": "gov.si"}],
+                  "workers": 2}
+        merged = merge(defaults, custom)
+        # options that a section does not set keep their defaults
+        self.assertDictEqual(merged["database"], {"batch_size": 50, "max_pending": 10000})
+        self.assertDictEqual(merged["pipeline"], {"enabled": False,
+                                                  "stages": {"fetch": {"workers": 2, "queue_size": 100}}})
+        # lists are replaced
+        self.assertListEqual(merged["scope"], [{"host": "gov.si"}])
+        self.assertEqual(merged["workers"], 2)
+        self.assertEqual(defaults["database"]["batch_size"], 500)
+
+    def testPartialSection(self):
+        with NamedTemporaryFile("w", suffix=".yaml") as config_file:
+            config_file.write("database:\n  batch_size: 50\n")
+            config_file.flush()
+            config = SettingsReader(config_file.name).config
+        self.assertEqual(config["database"]["batch_size"], 50)
+        self.assertEqual(config["database"]["max_connections"], 100)
+        self.assertIn("politeness", config)
+
+    def testConfigFileIsLoaded(self):
+        # the crawler reads config.yaml, not just the defaults
+        expected = SettingsReader(CONFIG_PATH).config
+        self.assertListEqual(SettingsReader.config["scope"], expected["scope"])
+        scope = Scope.from_config(SettingsReader.config)
+        self.assertListEqual(scope.filter(["http://www.gov.si/", "http://e-prostor.gov.si/fileadmin/global/a.pdf",
+                                           "http://www.google.com/"]), ["http://www.gov.si/"])
+
+    def testCanonicalizationConfig(self):
+        rules = CanonicalizationRules.from_config(SettingsReader.config)
+        self.assertEqual(rules.apply("http://www.e-prostor.si/novice?id=2&cHash=ab12&utm_source=x"),
+                         "http://e-prostor.gov.si/novice?id=2")
+        self.assertEqual(rules.learn_threshold, 5)
+        self.assertEqual(rules.learn_min_values, 3)
+
+    def testHtmlIsReadableInDatabase(self):
+        # compressed HTML is NULL in page.html_content and the page_html view
+        for config in (SettingsReader.config, SettingsReader(CONFIG_PATH).config):
+            self.assertIn(config["database"]["html_storage"], ("inline", "none"))
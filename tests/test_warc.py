@@ -0,0 +1,75 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from crawler.warc import WarcWriter, archive_paths, read_pages, read_records
+
+
+class TestWarc(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        writer = WarcWriter(self.directory, max_file_size=1)
+        headers = {"Content-Type": "text/html; charset=utf-8", "Content-Encoding": "gzip"}
+        body = "<p>Podjetniški portal</p>".encode("utf-8")
+        writer.write_metadata("http://evem.gov.si/", {"domain": "evem.gov.si", "robots": "",
+                                                       "sitemap": None})
+        writer.write_response("http://evem.gov.si/", 200, headers, body,
+                              rendered="<html><p>Podjetniški portal</p></html>")
+        writer.write_response("http://evem.gov.si/vloga.pdf", 200, {"Content-Type": "application/pdf"},
+                              (io.BytesIO(b"%PDF" * 1000), 4000))
+        writer.write_response("http://evem.gov.si/video.mp4", 200, {"Content-Type": "video/mp4"},
+                              truncated=True)
+        writer.close()
+
+        # every write filled an archive, so each is in its own (complete) file
+        paths = archive_paths(self.directory)
+        self.assertEqual(len(paths), 4)
+        self.assertTrue(all(name.endswith(".warc.gz") for name in os.listdir(self.directory)))
+
+        pages = [page for path in paths for page in read_pages(path)]
+        self.assertListEqual([kind for kind, _, _, _ in pages],
+                             ["metadata", "response", "response", "response"])
+        self.assertEqual(pages[0][2]["domain"], "evem.gov.si")
+
+        _, record, response, rendered = pages[1]
+        self.assertEqual(record.headers["WARC-Target-URI"], "http://evem.gov.si/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, body)
+        self.assertEqual(rendered, "<html><p>Podjetniški portal</p></html>")
+        # the stored body is decoded, so it must not claim to be compressed
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.headers["Content-Length"], str(len(body)))
+
+        self.assertEqual(pages[2][2].body, b"%PDF" * 1000)
+        self.assertIsNone(pages[2][3])
+        self.assertEqual(pages[3][1].headers["WARC-Truncated"], "unspecified")
+        self.assertEqual(pages[3][2].body, b"")
+
+    def testRecordsAreGzipMembers(self):
+        writer = WarcWriter(self.directory)
+        for idx in range(3):
+            writer.write_response("http://evem.gov.si/{}".format(idx), 404, {}, b"")
+        writer.close()
+
+        path, = archive_paths(self.directory)
+        with open(path, "rb") as archive:
+            data = archive.read()
+        self.assertTrue(gzip.decompress(data).startswith(b"WARC/1.0\r\nWARC-Type: warcinfo"))
+        # warcinfo and 3 responses, each compressed on its own
+        members = 0
+        while data:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            decompressor.decompress(data)
+            data = decompressor.unused_data
+            members += 1
+        self.assertEqual(members, 4)
+        self.assertListEqual([record.type for record in read_records(path)],
+                             ["warcinfo", "response", "response", "response"])